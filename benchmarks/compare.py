@@ -0,0 +1,81 @@
+"""Compare two benchmarks.run, or two benchmarks.micro, result files.
+
+    python -m benchmarks.compare before.json after.json --threshold 10
+
+Prints the change in throughput and p99 latency of each scenario in both
+(time and memory allocated per op, for microbenchmarks); with
+``--threshold`` exits with status 1 if any got worse by more than that many
+percent.
+"""
+
+from __future__ import print_function
+
+import json
+import sys
+from optparse import OptionParser
+
+
+def change(before, after):
+    """Relative change from ``before`` to ``after``, in percent."""
+    if not before:
+        return 0.0
+    return (after - before) * 100.0 / before
+
+
+# (label, value of a result, whether more is better)
+LOAD_MEASURES = [
+    ("calls/s", lambda result: result["calls_per_sec"], True),
+    ("p99", lambda result: result["latency_us"]["p99"], False)]
+MICRO_MEASURES = [
+    ("ns/op", lambda result: result["ns_per_op"], False),
+    ("bytes/op", lambda result: result["bytes_per_op"], False)]
+
+
+def compare(before, after):
+    """
+    :return: (scenario key, [(label, change, worse)]) of the scenarios in
+        both result sets, changes in percent; ``worse`` is the change
+        counted against the scenario
+    """
+    rows = []
+    for key in sorted(set(before["results"]) & set(after["results"])):
+        old, new = before["results"][key], after["results"][key]
+        changes = []
+        for label, value, more_is_better in (
+                MICRO_MEASURES if "ns_per_op" in old else LOAD_MEASURES):
+            if value(old) is None or value(new) is None:
+                continue
+            delta = change(value(old), value(new))
+            changes.append((label, delta,
+                            -delta if more_is_better else delta))
+        rows.append((key, changes))
+    return rows
+
+
+def main(argv=None):
+    parser = OptionParser(usage="%prog [options] BEFORE AFTER")
+    parser.add_option("--threshold", type="float",
+                      help="percent of throughput lost, or of latency, time "
+                      "or memory gained, counted as a regression")
+    options, args = parser.parse_args(argv)
+    if len(args) != 2:
+        parser.error("expected two result files")
+    with open(args[0]) as f:
+        before = json.load(f)
+    with open(args[1]) as f:
+        after = json.load(f)
+
+    regressions = 0
+    for key, changes in compare(before, after):
+        regressed = options.threshold is not None and any(
+            worse > options.threshold for _, _, worse in changes)
+        regressions += regressed
+        print("%-45s %s%s" % (
+            key, "  ".join("%s %+7.1f%%" % (label, delta)
+                           for label, delta, _ in changes),
+            "  REGRESSION" if regressed else ""))
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
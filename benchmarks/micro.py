@@ -0,0 +1,239 @@
+"""Microbenchmarks of the envelope and dispatch path of tx channels.
+
+    python -m benchmarks.micro
+    python -m benchmarks.micro -n 20000 --size 1024 -o micro.json
+
+Each benchmark repeats one step of a call, in process and without sockets
+(the channel writes to a twisted StringTransport):
+
+    encode_response      a Response record into the Rpc frame bytes
+    decode_rpc           envelope.decode_rpc of an Rpc frame with one Echo
+                         request
+    call_method          BaseChannel._call_method: a request into an Rpc
+    serialize_rpc        a Response into the Rpc frame sent back
+    serialize_response   a service's response message into a Response
+    dispatch_request     TcpChannel.stringReceived of an Rpc frame with one
+                         Echo request, through to the response frame written
+    dispatch_response    TcpChannel.stringReceived of an Rpc frame with one
+                         Echo response, through to the caller's Deferred
+
+and reports the time per op and, where tracemalloc is available (Python
+3.4+), the memory allocated: ``bytes/op`` is the peak memory allocated
+during one op and ``retained blocks/op`` the memory blocks it leaves
+allocated. The tx module being Python 2 code, only the first two
+benchmarks, on the envelope module, run where allocations are measured.
+Results saved with -o can be compared with benchmarks.compare.
+"""
+
+from __future__ import print_function
+
+import json
+import platform
+import sys
+import timeit
+from optparse import OptionParser
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    from twisted.internet.defer import Deferred
+    from twisted.test.proto_helpers import StringTransport
+    from protobufrpc import tx
+except (ImportError, SyntaxError):
+    tx = None
+
+from protobufrpc.common import Controller, ResponseCoalescer
+from protobufrpc.envelope import ResponseRecord, decode_rpc
+from protobufrpc.protobufrpc_pb2 import Rpc
+from benchmarks.services import EchoRequest, EchoResponse, TestService, \
+    services
+
+ENVELOPE_BENCHMARKS = ("encode_response", "decode_rpc")
+TX_BENCHMARKS = ("call_method", "serialize_rpc", "serialize_response",
+                 "dispatch_request", "dispatch_response")
+BENCHMARKS = ENVELOPE_BENCHMARKS + TX_BENCHMARKS
+
+
+def channel():
+    """A TcpChannel serving the example services, connected to nothing."""
+    protocol = tx.TcpChannel()
+    for service in services():
+        protocol.add_service(service)
+    # Flush every response straight away, as if each op were a turn of the
+    # reactor.
+    protocol._coalescer = ResponseCoalescer(protocol.sendString,
+                                            lambda flush: flush())
+    protocol.makeConnection(StringTransport())
+    return protocol
+
+
+def echo_request(size):
+    request = EchoRequest()
+    request.text = "x" * size
+    return request
+
+
+def _echo_request_frame(size):
+    rpc = Rpc()
+    serializedRequest = rpc.request.add()
+    serializedRequest.id = 1
+    serializedRequest.method = "Test.Echo"
+    serializedRequest.serialized_request = \
+        echo_request(size).SerializeToString()
+    return rpc.SerializeToString()
+
+
+def bench_encode_response(size):
+    response = _echo_response(size)
+    return response.encode
+
+
+def bench_decode_rpc(size):
+    data = _echo_request_frame(size)
+    return lambda: decode_rpc(data)
+
+
+def bench_call_method(size):
+    protocol = channel()
+    method = TestService.GetDescriptor().FindMethodByName("Echo")
+    request = echo_request(size)
+
+    def op():
+        protocol._call_method(method, Controller(), request, EchoResponse,
+                              Deferred())
+        protocol._pending.pop(protocol.id)
+    return op
+
+
+def _echo_response(size):
+    return ResponseRecord(
+        id=1, serialized_response=echo_request(size).SerializeToString())
+
+
+def bench_serialize_rpc(size):
+    protocol = channel()
+    response = _echo_response(size)
+    return lambda: protocol.serialize_rpc(response)
+
+
+def bench_serialize_response(size):
+    protocol = channel()
+    entry = protocol._methods["Test.Echo"]
+    rpc = Rpc()
+    serializedRequest = rpc.request.add()
+    serializedRequest.id = 1
+    serializedRequest.method = "Test.Echo"
+    controller = Controller()
+    response = EchoResponse()
+    response.text = "x" * size
+    return lambda: protocol.serialize_response(response, serializedRequest,
+                                               controller, entry)
+
+
+def bench_dispatch_request(size):
+    protocol = channel()
+    data = _echo_request_frame(size)
+
+    def op():
+        protocol.stringReceived(data)
+        protocol.transport.clear()
+    return op
+
+
+def bench_dispatch_response(size):
+    protocol = channel()
+    data = _echo_response(size).encode()
+
+    def op():
+        d = Deferred()
+        d.addCallback(protocol.unserialize_response, EchoResponse,
+                      Controller())
+        protocol._pending.add(1, d)
+        protocol.stringReceived(data)
+    return op
+
+
+def measure(op, number):
+    """
+    :return: (seconds per op, peak bytes allocated per op, blocks left
+        allocated per op), the last two None without tracemalloc
+    """
+    for _ in range(min(number, 1000)):
+        op()
+    started = timeit.default_timer()
+    for _ in range(number):
+        op()
+    seconds = (timeit.default_timer() - started) / number
+
+    if tracemalloc is None:
+        return seconds, None, None
+
+    def sample(op, samples):
+        peak = blocks = 0
+        for _ in range(samples):
+            # Only what the op allocates is traced, from zero.
+            tracemalloc.clear_traces()
+            op()
+            peak += tracemalloc.get_traced_memory()[1]
+            blocks += len(tracemalloc.take_snapshot().traces)
+        return float(peak) / samples, float(blocks) / samples
+
+    samples = min(number, 200)
+    tracemalloc.start()
+    try:
+        # Less what measuring itself allocates.
+        base_peak, base_blocks = sample(lambda: None, samples)
+        peak, blocks = sample(op, samples)
+    finally:
+        tracemalloc.stop()
+    return seconds, max(peak - base_peak, 0.0), max(blocks - base_blocks, 0.0)
+
+
+def main(argv=None):
+    parser = OptionParser(usage="%prog [options] [BENCHMARK ...]")
+    parser.add_option("-n", "--number", type="int", default=10000,
+                      help="ops timed per benchmark")
+    parser.add_option("--size", type="int", default=64,
+                      help="bytes of Echo text")
+    parser.add_option("-o", "--output", help="save the results as JSON")
+    options, names = parser.parse_args(argv)
+    available = BENCHMARKS if tx is not None else ENVELOPE_BENCHMARKS
+    for name in names:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark %r" % (name,))
+        if name not in available:
+            parser.error("benchmark %r needs the tx module, which does not "
+                         "import on Python %s" %
+                         (name, platform.python_version()))
+    if tx is None and not names:
+        print("tx does not import on Python %s: only running %s" % (
+            platform.python_version(), ", ".join(ENVELOPE_BENCHMARKS)))
+
+    results = {}
+    for name in names or available:
+        op = globals()["bench_" + name](options.size)
+        seconds, allocated, blocks = measure(op, options.number)
+        results[name] = {"ns_per_op": seconds * 1e9,
+                         "bytes_per_op": allocated,
+                         "retained_blocks_per_op": blocks}
+        print("%-20s %10.0f ns/op%s" % (
+            name, seconds * 1e9, "" if allocated is None else
+            "  %8.0f bytes/op  %6.1f retained blocks/op" %
+            (allocated, blocks)))
+        sys.stdout.flush()
+
+    if options.output:
+        from google.protobuf.internal import api_implementation
+        meta = {"python": platform.python_version(),
+                "protobuf_implementation": api_implementation.Type(),
+                "number": options.number, "size": options.size}
+        with open(options.output, "w") as f:
+            json.dump({"meta": meta, "results": results}, f, indent=2,
+                      sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+"""Run the benchmark scenarios and save their results.
+
+    python -m benchmarks.run -o results.json
+    python -m benchmarks.run --backends sync,tx-tcp --sizes 16,65536 \\
+        --connections 1,8 --depth 1,16 -o before.json
+
+Every combination of backend, method, payload size (of Echo's text),
+connections and depth (calls in flight per connection, pipelined on one
+connection by the asynchronous channels) is a scenario. Each runs a fresh
+server and client, each in a process of its own, over loopback, and is
+reported as calls per second, latency percentiles, CPU time per call and
+peak RSS. Compare two result files with benchmarks.compare.
+
+The output file is rewritten as each scenario completes, so an interrupted
+run keeps what it measured. A scenario whose worker fails is reported and
+listed under "failed" instead of stopping the run. The aio backend is only
+run by default when the workers' interpreter has asyncio.
+"""
+
+from __future__ import print_function
+
+import json
+import os
+import platform
+import signal
+import subprocess
+import sys
+import time
+from optparse import OptionParser
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BACKENDS = ("sync", "tx-tcp", "tx-udp", "aio")
+
+# Largest Echo text sent in a single datagram.
+MAX_UDP_SIZE = 60000
+
+
+def scenarios(options):
+    for backend in options.backends:
+        for method in options.methods:
+            for size in (options.sizes if method == "Echo" else [0]):
+                if backend == "tx-udp" and size > MAX_UDP_SIZE:
+                    continue
+                for connections in options.connections:
+                    for depth in options.depth:
+                        yield {"backend": backend, "method": method,
+                               "size": size, "connections": connections,
+                               "depth": depth, "warmup": options.warmup,
+                               "duration": options.duration}
+
+
+def key(scenario):
+    return "%(backend)s/%(method)s/size=%(size)d/conns=%(connections)d/" \
+        "depth=%(depth)d" % scenario
+
+
+def worker(python, *args):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [ROOT, os.path.join(ROOT, "examples")] +
+        ([env["PYTHONPATH"]] if env.get("PYTHONPATH") else []))
+    return subprocess.Popen([python, "-m", "benchmarks.worker"] +
+                            [str(arg) for arg in args],
+                            cwd=ROOT, env=env, stdout=subprocess.PIPE,
+                            universal_newlines=True)
+
+
+def default_backends(python):
+    """The BACKENDS the ``python`` interpreter can run."""
+    with open(os.devnull, "w") as devnull:
+        has_asyncio = subprocess.call([python, "-c", "import asyncio"],
+                                      stderr=devnull) == 0
+    return [backend for backend in BACKENDS
+            if backend != "aio" or has_asyncio]
+
+
+def read_json(process, role):
+    line = process.stdout.readline()
+    if not line:
+        raise RuntimeError("benchmark %s exited with %s" %
+                           (role, process.wait()))
+    return json.loads(line)
+
+
+def stop(process):
+    """Terminate ``process`` unless it has already exited."""
+    if process.poll() is None:
+        process.send_signal(signal.SIGTERM)
+
+
+def percentile(ordered, q):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q / 100.0))]
+
+
+def run(python, scenario):
+    """
+    :raise RuntimeError: when a worker fails
+    """
+    server = worker(python, "server", scenario["backend"])
+    client = None
+    try:
+        port = read_json(server, "server")["port"]
+        client = worker(python, "client", scenario["backend"], port,
+                        json.dumps(scenario))
+        load = read_json(client, "client")
+        client.wait()
+        if server.poll() is not None:
+            raise RuntimeError("benchmark server exited with %s" %
+                               server.returncode)
+    finally:
+        if client is not None:
+            stop(client)
+        stop(server)
+    served = read_json(server, "server")
+    server.wait()
+
+    latencies = sorted(load["latencies"])
+    total = max(load["total_calls"], 1)
+    return {
+        "scenario": scenario,
+        "calls": load["measured_calls"],
+        "errors": load["errors"],
+        "calls_per_sec": load["measured_calls"] / load["duration"],
+        "latency_us": dict(
+            [(name, percentile(latencies, q) * 1e6)
+             for name, q in (("p50", 50), ("p99", 99), ("p999", 99.9))] +
+            [("mean", sum(latencies) / len(latencies) * 1e6
+              if latencies else 0.0),
+             ("max", latencies[-1] * 1e6 if latencies else 0.0)]),
+        "cpu_us_per_call": {
+            "client": load["cpu"] / total * 1e6,
+            "server": served["cpu"] / total * 1e6,
+            "total": (load["cpu"] + served["cpu"]) / total * 1e6},
+        "rss_kb": {"client": load["maxrss"], "server": served["maxrss"]},
+    }
+
+
+def save(results, path):
+    # Replaced whole, so that an interrupted run leaves a valid file.
+    with open(path + ".tmp", "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    os.rename(path + ".tmp", path)
+
+
+def meta(python):
+    script = ("import json, platform, google.protobuf\n"
+              "from google.protobuf.internal import api_implementation\n"
+              "print(json.dumps({'python': platform.python_version(),\n"
+              "    'protobuf': google.protobuf.__version__,\n"
+              "    'protobuf_implementation': api_implementation.Type()}))\n")
+    info = json.loads(subprocess.check_output([python, "-c", script],
+                                              universal_newlines=True))
+    try:
+        info["commit"] = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=ROOT,
+            universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        info["commit"] = None
+    info.update(platform=platform.platform(), cpus=_cpu_count(),
+                time=time.strftime("%Y-%m-%dT%H:%M:%S"))
+    return info
+
+
+def _cpu_count():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return None
+
+
+def main(argv=None):
+    def ints(value):
+        return [int(v) for v in value.split(",")]
+
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("--backends",
+                      help="comma separated, of %s; all the interpreter "
+                      "can run by default" % ", ".join(BACKENDS))
+    parser.add_option("--methods", default="Echo,Ping,Add")
+    parser.add_option("--sizes", default="16,1024,65536",
+                      help="Echo payload sizes, in bytes")
+    parser.add_option("--connections", default="1,8")
+    parser.add_option("--depth", default="1,16",
+                      help="calls in flight per connection")
+    parser.add_option("--duration", type="float", default=5.0,
+                      help="seconds measured per scenario")
+    parser.add_option("--warmup", type="float", default=1.0,
+                      help="seconds run before measuring")
+    parser.add_option("--python", default=sys.executable,
+                      help="interpreter to run the workers with")
+    parser.add_option("-o", "--output", default="results.json")
+    options, _ = parser.parse_args(argv)
+    if options.backends:
+        options.backends = options.backends.split(",")
+    else:
+        options.backends = default_backends(options.python)
+    options.methods = options.methods.split(",")
+    options.sizes = ints(options.sizes)
+    options.connections = ints(options.connections)
+    options.depth = ints(options.depth)
+
+    results = {"meta": meta(options.python), "results": {}, "failed": {}}
+    for scenario in scenarios(options):
+        try:
+            result = run(options.python, scenario)
+        except RuntimeError as e:
+            results["failed"][key(scenario)] = str(e)
+            print("%-45s FAILED: %s" % (key(scenario), e))
+            save(results, options.output)
+            continue
+        results["results"][key(scenario)] = result
+        print("%-45s %10.0f calls/s  p50 %8.0fus  p99 %8.0fus  "
+              "%6.0fus cpu/call%s" % (
+                  key(scenario), result["calls_per_sec"],
+                  result["latency_us"]["p50"], result["latency_us"]["p99"],
+                  result["cpu_us_per_call"]["total"],
+                  "  %d errors" % result["errors"]
+                  if result["errors"] else ""))
+        sys.stdout.flush()
+        save(results, options.output)
+    return 1 if results["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,63 @@
+"""The example services (examples/test.proto) the benchmarks call."""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "examples"))
+
+from test_pb2 import Test, Test_Stub, Math, Math_Stub, EchoRequest, \
+    EchoResponse, PingRequest, PingResponse, MathBinaryOperationRequest, \
+    MathResponse
+
+METHODS = ("Echo", "Ping", "Add")
+
+
+class TestService(Test):
+    def Echo(self, rpc_controller, request, done):
+        response = EchoResponse()
+        response.text = request.text
+        done(response)
+
+    def Ping(self, rpc_controller, request, done):
+        done(PingResponse())
+
+
+class MathService(Math):
+    def Add(self, rpc_controller, request, done):
+        response = MathResponse()
+        response.result = request.first + request.second
+        done(response)
+
+    def Multiply(self, rpc_controller, request, done):
+        response = MathResponse()
+        response.result = request.first * request.second
+        done(response)
+
+
+def services():
+    return [TestService(), MathService()]
+
+
+def stubs(channel):
+    return Test_Stub(channel), Math_Stub(channel)
+
+
+def caller(proxy, method, size):
+    """
+    A function making one call of ``method`` through ``proxy``; Echo
+    sends ``size`` bytes of text.
+    """
+    if method == "Echo":
+        request = EchoRequest()
+        request.text = "x" * size
+        return lambda: proxy.Test.Echo(request)
+    if method == "Ping":
+        request = PingRequest()
+        return lambda: proxy.Test.Ping(request)
+    if method == "Add":
+        request = MathBinaryOperationRequest()
+        request.first = 1
+        request.second = 2
+        return lambda: proxy.Math.Add(request)
+    raise ValueError("unknown method %r" % (method,))
@@ -0,0 +1,271 @@
+"""One side of a benchmark run, in a process of its own.
+
+    python -m benchmarks.worker server BACKEND
+    python -m benchmarks.worker client BACKEND PORT SPEC
+
+A server prints {"port": ...} once listening, and its resource usage since
+then when sent SIGTERM. A client runs the scenario SPEC (JSON, see run.py)
+against PORT and prints its results. Either way the output is one JSON
+object per line.
+"""
+
+from __future__ import print_function
+
+import json
+import resource
+import signal
+import sys
+import time
+
+HOST = "127.0.0.1"
+
+
+def usage():
+    """CPU seconds used and peak RSS (KiB on Linux) of this process."""
+    ru = resource.getrusage(resource.RUSAGE_SELF)
+    return {"cpu": ru.ru_utime + ru.ru_stime, "maxrss": ru.ru_maxrss}
+
+
+def emit(obj):
+    print(json.dumps(obj))
+    sys.stdout.flush()
+
+
+class Recorder(object):
+    """Latencies of the calls started after the warmup."""
+
+    def __init__(self, warmup, duration):
+        self.started = time.time()
+        self.measure_from = self.started + warmup
+        self.stop_at = self.measure_from + duration
+        self.duration = duration
+        self.latencies = []
+        self.calls = 0
+        self.errors = 0
+
+    def running(self, now):
+        return now < self.stop_at
+
+    def record(self, started, ok):
+        self.calls += 1
+        if not ok:
+            self.errors += 1
+        elif started >= self.measure_from:
+            self.latencies.append(time.time() - started)
+
+    def results(self, before):
+        after = usage()
+        return {"measured_calls": len(self.latencies),
+                "total_calls": self.calls,
+                "errors": self.errors,
+                "duration": self.duration,
+                "latencies": self.latencies,
+                "cpu": after["cpu"] - before["cpu"],
+                "maxrss": after["maxrss"]}
+
+
+# Servers
+
+def serve_sync():
+    import gevent.monkey
+    gevent.monkey.patch_all()
+    import gevent
+    from protobufrpc.synchronous import GeventTCPServer
+    from benchmarks.services import services
+
+    server = GeventTCPServer((HOST, 0), services())
+    server.start()
+    before = usage()
+    gevent.signal(signal.SIGTERM, server.stop)
+    emit({"port": server.server_port})
+    server.serve_forever()
+    return before
+
+
+def _serve_tx(listen):
+    from twisted.internet import reactor
+    from benchmarks.services import services
+
+    port = listen(reactor, services())
+    before = []
+    reactor.callWhenRunning(lambda: (
+        before.append(usage()), emit({"port": port.getHost().port})))
+    reactor.run()
+    return before[0]
+
+
+def serve_tx_tcp():
+    from protobufrpc import tx
+    return _serve_tx(lambda reactor, services: reactor.listenTCP(
+        0, tx.Factory(services), interface=HOST))
+
+
+def serve_tx_udp():
+    from protobufrpc import tx
+
+    def listen(reactor, services):
+        protocol = tx.UdpChannel()
+        for service in services:
+            protocol.add_service(service)
+        return reactor.listenUDP(0, protocol, interface=HOST)
+    return _serve_tx(listen)
+
+
+def serve_aio():
+    import asyncio
+    from protobufrpc import aio
+    from benchmarks.services import services
+
+    loop = asyncio.get_event_loop()
+    server = aio.TcpServer(services())
+    loop.run_until_complete(server.start(HOST, 0))
+    before = usage()
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    emit({"port": server.server.sockets[0].getsockname()[1]})
+    loop.run_forever()
+    server.close()
+    return before
+
+
+# Clients: ``connections`` channels, each with ``depth`` calls in flight.
+
+def load_sync(port, spec, recorder):
+    import gevent.monkey
+    gevent.monkey.patch_all()
+    import gevent
+    from protobufrpc.synchronous import TcpChannel, Proxy
+    from benchmarks.services import caller, stubs
+
+    def lane(call):
+        while recorder.running(time.time()):
+            started = time.time()
+            try:
+                call()
+            except Exception:
+                recorder.record(started, False)
+            else:
+                recorder.record(started, True)
+
+    lanes = []
+    for _ in range(spec["connections"]):
+        proxy = Proxy(*stubs(TcpChannel((HOST, port))))
+        call = caller(proxy, spec["method"], spec["size"])
+        lanes.extend(gevent.spawn(lane, call) for _ in range(spec["depth"]))
+    gevent.joinall(lanes)
+
+
+def _load_twisted(connect, spec, recorder):
+    from twisted.internet import defer, reactor
+    from protobufrpc import tx
+    from benchmarks.services import caller, stubs
+
+    def lane(call):
+        finished = defer.Deferred()
+
+        def next_call(_=None):
+            if not recorder.running(time.time()):
+                finished.callback(None)
+                return
+            started = time.time()
+            d = call()
+            d.addCallbacks(lambda _: recorder.record(started, True),
+                           lambda _: recorder.record(started, False))
+            d.addCallback(next_call)
+        next_call()
+        return finished
+
+    def connected(channels):
+        lanes = []
+        for channel in channels:
+            proxy = tx.Proxy(*stubs(channel), timeout=spec.get("timeout"))
+            call = caller(proxy, spec["method"], spec["size"])
+            lanes.extend(lane(call) for _ in range(spec["depth"]))
+        return defer.gatherResults(lanes)
+
+    d = defer.gatherResults([connect(reactor, tx)
+                             for _ in range(spec["connections"])])
+    d.addCallback(connected)
+    d.addErrback(lambda failure: failure.printTraceback(file=sys.stderr))
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
+
+
+def load_tx_tcp(port, spec, recorder):
+    from twisted.internet.protocol import ClientCreator
+    _load_twisted(lambda reactor, tx: ClientCreator(
+        reactor, tx.TcpChannel).connectTCP(HOST, port), spec, recorder)
+
+
+def load_tx_udp(port, spec, recorder):
+    from twisted.internet import defer
+
+    def connect(reactor, tx):
+        channel = tx.UdpChannel(HOST, port)
+        reactor.listenUDP(0, channel, interface=HOST)
+        return defer.succeed(channel)
+    # Lost datagrams are never answered: time them out as errors.
+    spec = dict(spec, timeout=spec.get("timeout") or 1.0)
+    _load_twisted(connect, spec, recorder)
+
+
+def load_aio(port, spec, recorder):
+    import asyncio
+    from protobufrpc import aio
+    from benchmarks.services import caller, stubs
+
+    loop = asyncio.get_event_loop()
+    lanes = []
+    finished = loop.create_future()
+
+    def lane(call):
+        def next_call(future=None):
+            if future is not None:
+                recorder.record(started[0], not future.exception())
+            if not recorder.running(time.time()):
+                lanes.remove(call)
+                if not lanes:
+                    finished.set_result(None)
+                return
+            started[0] = time.time()
+            call().add_done_callback(next_call)
+        started = [None]
+        next_call()
+
+    for _ in range(spec["connections"]):
+        channel = aio.TcpChannel()
+        loop.run_until_complete(channel.connect(HOST, port))
+        proxy = aio.Proxy(*stubs(channel))
+        calls = [caller(proxy, spec["method"], spec["size"])
+                 for _ in range(spec["depth"])]
+        lanes.extend(calls)
+    for call in list(lanes):
+        lane(call)
+    loop.run_until_complete(finished)
+
+
+BACKENDS = {
+    "sync": (serve_sync, load_sync),
+    "tx-tcp": (serve_tx_tcp, load_tx_tcp),
+    "tx-udp": (serve_tx_udp, load_tx_udp),
+    "aio": (serve_aio, load_aio),
+}
+
+
+def main(argv):
+    role, backend = argv[1], argv[2]
+    serve, load = BACKENDS[backend]
+    if role == "server":
+        before = serve()
+        after = usage()
+        emit({"cpu": after["cpu"] - before["cpu"],
+              "maxrss": after["maxrss"]})
+    else:
+        port, spec = int(argv[3]), json.loads(argv[4])
+        before = usage()
+        recorder = Recorder(spec["warmup"], spec["duration"])
+        load(port, spec, recorder)
+        emit(recorder.results(before))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
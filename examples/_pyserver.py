@@ -30,7 +30,6 @@ class TestService(Test):
     def Echo(self, rpc_controller, request, done):
         response = EchoResponse()
         response.text = request.text
-        print 'gevent sleep 3'
         gevent.sleep(3)
         done(response)
 
@@ -30,7 +30,6 @@ class TestService(Test):
     def Echo(self, rpc_controller, request, done):
         response = EchoResponse()
         response.text = request.text
-        print 'gevent sleep 3'
         gevent.sleep(3)
         rpc_controller.SetFailed("error")
         done(response)
@@ -55,13 +54,8 @@ class MathService(Math):
 testService = TestService()
 mathService = MathService()
 
-
-def pri(socket, addr):
-    print 'new conn'
-
 #server = TcpServer(("localhost", 8080), testService, mathService)
 #server.serve_forever()
 
 server = GeventTCPServer(("localhost", 8080), [testService, mathService])
-#server = GeventTCPServer(("localhost", 8080), pri)
 server.serve_forever()
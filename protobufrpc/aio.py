@@ -0,0 +1,470 @@
+"""asyncio backend, for Python 3.7 and later.
+
+Calls return futures, so a coroutine simply awaits them::
+
+    channel = TcpChannel()
+    await channel.connect("127.0.0.1", 8080)
+    proxy = Proxy(Test_Stub(channel))
+    response = await proxy.Test.Echo(request)
+
+and a server is started from a running loop::
+
+    server = TcpServer([TestService(), MathService()])
+    await server.start("127.0.0.1", 8080)
+
+Service methods either call ``done`` like with the other backends, now or
+later from another callback, or are coroutines returning their response.
+The wire format is the same ``Rpc`` envelope, so these channels and servers
+talk to the gevent and Twisted ones. Call use_uvloop() before creating the
+loop to run on uvloop when it is installed.
+"""
+
+import asyncio
+import queue
+from functools import partial
+
+import google.protobuf.service
+from google.protobuf.message import DecodeError
+from protobufrpc.common import INLINE, PROCESS, Controller, MethodIds, \
+    PendingCalls, ResponseCoalescer, RPCException, RpcErrors, TimerWheel, \
+    acknowledge_method_id, call_in_worker, call_method, dispatch_error, \
+    index_service, lookup_method, process_pool, request_deadline, \
+    set_timeout, unless_expired
+from protobufrpc.envelope import ErrorRecord, ResponseRecord, decode_rpc
+from protobufrpc.framing import HEADER, FrameReader, FrameTooLarge
+from protobufrpc.protobufrpc_pb2 import Rpc
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+__all__ = ["TcpChannel", "TcpServer", "Proxy", "RPCException", "use_uvloop"]
+
+
+def use_uvloop():
+    """
+    Make loops created from now on uvloop ones, if uvloop is installed.
+
+    :return: whether uvloop will be used
+    """
+    if uvloop is None:
+        return False
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return True
+
+
+class FrameProtocol(asyncio.BufferedProtocol):
+    """Length-prefixed frames received straight into a FrameReader."""
+
+    def __init__(self):
+        self.transport = None
+        self._reader = FrameReader()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        self.transport = None
+
+    def get_buffer(self, sizehint):
+        return self._reader.get_buffer()
+
+    def buffer_updated(self, nbytes):
+        try:
+            self._reader.buffer_updated(nbytes, self.string_received)
+        except FrameTooLarge:
+            self.transport.abort()
+
+    def send_string(self, data):
+        if self.transport is not None:
+            self.transport.writelines([HEADER.pack(len(data)), data])
+
+    def string_received(self, data):
+        raise NotImplementedError
+
+
+class TcpChannel(google.protobuf.service.RpcChannel, FrameProtocol):
+    """Multiplexed client channel.
+
+    CallMethod sends the request at once and returns a future for the
+    response; any number of calls may be in flight on one connection. A
+    failed call sets the controller failed and the future's exception to
+    an RPCException.
+
+    With ``method_ids`` set, methods are named by a small integer bound on
+    the connection instead of their full name once the server agrees.
+
+    A call fails once the deadline of its controller passes or the
+    controller is cancelled; cancelling the future drops the call too.
+
+    With ``max_in_flight`` set, calls beyond that many outstanding ones
+    are held back and sent as earlier ones complete.
+    """
+
+    def __init__(self, method_ids=False, max_in_flight=None):
+        google.protobuf.service.RpcChannel.__init__(self)
+        FrameProtocol.__init__(self)
+        self.id = 0
+        self._method_ids = MethodIds() if method_ids else None
+        self._pending = PendingCalls(max_in_flight)
+        self._timers = TimerWheel()
+        self._expiry = None
+
+    def connect(self, host, port, **kwargs):
+        """Connect to a server, returning an awaitable."""
+        loop = asyncio.get_event_loop()
+        return loop.create_connection(lambda: self, host, port, **kwargs)
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+    @property
+    def connected(self):
+        return self.transport is not None
+
+    @property
+    def in_flight(self):
+        return len(self._pending)
+
+    def pending_stats(self):
+        """Size and age histogram of the calls waiting for a response."""
+        return self._pending.stats()
+
+    def connection_lost(self, exc):
+        FrameProtocol.connection_lost(self, exc)
+        if exc is None:
+            reason = "connection closed by peer"
+        else:
+            reason = "connection error: %s" % exc
+        if self._expiry is not None:
+            self._expiry.cancel()
+            self._expiry = None
+        self._timers = TimerWheel()
+        # Calls still waiting for room start, and fail, as these leave.
+        for future, controller, _, _ in self._pending.clear():
+            self._fail(future, controller, reason)
+
+    def CallMethod(self, methodDescriptor, rpcController, request,
+                   responseClass, done=None):
+        future = asyncio.get_event_loop().create_future()
+        self._pending.admit(partial(self._start_call, future,
+                                    methodDescriptor, rpcController, request,
+                                    responseClass, done))
+        return future
+
+    def _start_call(self, future, methodDescriptor, rpcController, request,
+                    responseClass, done):
+        if future.done():
+            # Cancelled while waiting for room.
+            return
+        if self.transport is None:
+            self._fail(future, rpcController, "channel is not connected")
+            return
+        if rpcController.IsCancelled():
+            self._fail(future, rpcController, "Cancelled")
+            return
+
+        self.id += 1
+        _id = self.id
+        rpc = Rpc()
+        rpcRequest = rpc.request.add()
+        methodName = methodDescriptor.containing_service.name + '.' + \
+            methodDescriptor.name
+        if self._method_ids is not None:
+            self._method_ids.fill(rpcRequest, methodName)
+        else:
+            rpcRequest.method = methodName
+        rpcRequest.serialized_request = request.SerializeToString()
+        rpcRequest.id = _id
+        if not set_timeout(rpcRequest, rpcController):
+            self._fail(future, rpcController,
+                       RpcErrors.msgs[RpcErrors.DEADLINE_EXCEEDED])
+            return
+
+        self._pending.add(_id, (future, rpcController, responseClass, done))
+        if rpcController.deadline is not None:
+            self._timers.add(_id, rpcController.deadline)
+            self._schedule_expiry()
+        rpcController.NotifyOnCancel(partial(self._fail_call, _id,
+                                             "Cancelled"))
+        future.add_done_callback(partial(self._call_done, _id))
+        self.send_string(rpc.SerializeToString())
+
+    def _call_done(self, _id, future):
+        # A caller cancelling the future gives up on the call.
+        if future.cancelled():
+            self._fail_call(_id, "Cancelled")
+
+    def _fail_call(self, _id, reason):
+        self._timers.cancel(_id)
+        call = self._pending.pop(_id)
+        if call is not None:
+            self._fail(call[0], call[1], reason)
+
+    def _schedule_expiry(self):
+        if self._expiry is None and self._timers:
+            self._expiry = asyncio.get_event_loop().call_later(
+                self._timers.resolution, self._expire)
+
+    def _expire(self):
+        self._expiry = None
+        for _id in self._timers.expire():
+            self._fail_call(_id, RpcErrors.msgs[RpcErrors.DEADLINE_EXCEEDED])
+        self._schedule_expiry()
+
+    def string_received(self, data):
+        # Responses are parsed before this returns, while the frame is
+        # still valid: their payloads can be parsed from it in place.
+        _, responses = decode_rpc(data, views=True)
+        for serializedResponse in responses:
+            if serializedResponse.method_id and self._method_ids is not None:
+                self._method_ids.acknowledged(serializedResponse.method_id)
+            call = self._pending.pop(serializedResponse.id)
+            if call is not None:
+                self._timers.cancel(serializedResponse.id)
+                self.response_received(serializedResponse, *call)
+
+    def response_received(self, serializedResponse, future, controller,
+                          responseClass, done):
+        if serializedResponse.HasField('error'):
+            self._fail(future, controller, serializedResponse.error.text)
+            return
+        response = responseClass()
+        response.ParseFromString(serializedResponse.serialized_response)
+        if not future.done():
+            future.set_result(response)
+        if done is not None:
+            done(response)
+
+    def _fail(self, future, controller, reason):
+        controller.SetFailed(reason)
+        if not future.done():
+            future.set_exception(RPCException(reason))
+
+
+class Proxy(object):
+    """
+    Call methods of ``stubs`` as ``proxy.Service.Method(request)``. The
+    ``timeout`` keyword, in seconds, bounds every call; a call may pass
+    its own ``timeout`` instead.
+    """
+
+    class _Proxy(object):
+        def __init__(self, stub, timeout=None):
+            self._stub = stub
+            self._timeout = timeout
+
+        def __getattr__(self, key):
+            def call(method, request, timeout):
+                return method(Controller(timeout=timeout), request, None)
+
+            return lambda request, timeout=self._timeout: call(
+                getattr(self._stub, key), request, timeout)
+
+    def __init__(self, *stubs, **options):
+        timeout = options.pop("timeout", None)
+        if options:
+            raise TypeError("unexpected options %s" % ", ".join(options))
+        self._stubs = {}
+        for s in stubs:
+            self._stubs[s.GetDescriptor().name] = self._Proxy(s, timeout)
+
+    def __getattr__(self, key):
+        return self._stubs[key]
+
+
+class TcpServer(object):
+    def __init__(self, services):
+        """
+        >>> TcpServer([TestService()])
+        """
+        self.services = {}
+        self.methods = {}
+        for s in services:
+            self.services[s.GetDescriptor().name] = s
+            index_service(self.methods, s)
+        self.server = None
+
+    def start(self, host, port, **kwargs):
+        """
+        Start listening, returning an awaitable for the asyncio Server,
+        also kept as ``self.server``.
+        """
+        loop = asyncio.get_event_loop()
+        task = asyncio.ensure_future(loop.create_server(
+            partial(TcpRequestHandler, self), host, port, **kwargs))
+        task.add_done_callback(self._started)
+        return task
+
+    def _started(self, task):
+        if not task.cancelled() and task.exception() is None:
+            self.server = task.result()
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+
+
+class TcpRequestHandler(FrameProtocol):
+    # Responses finished within one turn of the event loop are written as a
+    # single frame of at most this many responses / payload bytes.
+    coalesce_count = 64
+    coalesce_bytes = 64 * 1024
+
+    def __init__(self, server):
+        FrameProtocol.__init__(self)
+        self.server = server
+        self._method_ids = {}
+        self._coalescer = None
+
+    def connection_made(self, transport):
+        FrameProtocol.connection_made(self, transport)
+        self._coalescer = ResponseCoalescer(
+            self.send_string, asyncio.get_event_loop().call_soon,
+            self.coalesce_count, self.coalesce_bytes)
+
+    def string_received(self, data):
+        try:
+            requests, _ = decode_rpc(data)
+        except DecodeError:
+            return
+        for serializedRequest in requests:
+            self.request_received(serializedRequest)
+
+    def request_received(self, serializedRequest):
+        entry = lookup_method(self.server.methods, self._method_ids,
+                              serializedRequest)
+        if entry is None:
+            self.send_error(serializedRequest.id,
+                            dispatch_error(self.server.services,
+                                           serializedRequest.method))
+            return
+        if entry.streaming:
+            self.send_error(serializedRequest.id, RpcErrors.METHOD_ERROR,
+                            "Streams are not served over asyncio")
+            return
+
+        if entry.execution != INLINE:
+            self.offload(entry, serializedRequest)
+            return
+
+        service, method, request_class = entry[:3]
+        request = request_class()
+        try:
+            request.ParseFromString(serializedRequest.serialized_request)
+        except DecodeError:
+            self.send_error(serializedRequest.id,
+                            RpcErrors.CANNOT_DESERIALIZE_REQUEST)
+            return
+
+        done = MethodCall(self, method, serializedRequest)
+        done.controller.deadline = request_deadline(serializedRequest)
+        try:
+            result = service.CallMethod(method, done.controller, request,
+                                        done)
+        except Exception as e:
+            done.failed(e)
+            return
+        if asyncio.iscoroutine(result) or asyncio.isfuture(result):
+            asyncio.ensure_future(result).add_done_callback(done.task_done)
+
+    def offload(self, entry, serializedRequest):
+        loop = asyncio.get_event_loop()
+        deadline = request_deadline(serializedRequest)
+        args = (entry.service, entry.method.name,
+                serializedRequest.serialized_request)
+        if entry.execution == PROCESS:
+            future = loop.run_in_executor(None, _call_worker, process_pool(),
+                                          deadline, *args)
+        else:
+            future = loop.run_in_executor(None, unless_expired, deadline,
+                                          call_method, *args)
+        future.add_done_callback(partial(self.offloaded, serializedRequest))
+
+    def offloaded(self, serializedRequest, future):
+        if future.cancelled():
+            return
+        try:
+            serialized, error = future.result()
+        except Exception as e:
+            # The executor itself failed: a broken process pool, a result
+            # that could not be serialized...
+            serialized, error = None, "%s: %s" % (type(e).__name__, e)
+        if error is not None:
+            self.send_error(serializedRequest.id, RpcErrors.METHOD_ERROR,
+                            error)
+        else:
+            self.send_response(self.encode_response(serialized,
+                                                    serializedRequest))
+
+    def send_response(self, serializedResponse):
+        if self.transport is not None:
+            self._coalescer.add(serializedResponse)
+
+    def encode_response(self, serialized, serialized_request):
+        serializedResponse = ResponseRecord(id=serialized_request.id,
+                                            serialized_response=serialized)
+        acknowledge_method_id(serializedResponse, serialized_request,
+                              self._method_ids)
+        return serializedResponse
+
+    def send_error(self, _id, code, msg=None):
+        self.send_response(ResponseRecord(
+            id=_id, error=ErrorRecord(code=code,
+                                      text=msg or RpcErrors.msgs[code])))
+
+
+class MethodCall(object):
+    """
+    The ``done`` callback of one served request. Whichever of done, an
+    exception or the result of a coroutine method comes first answers it.
+    """
+
+    def __init__(self, handler, method, serializedRequest):
+        self.handler = handler
+        self.method = method
+        self.request = serializedRequest
+        self.controller = Controller()
+        self.finished = False
+
+    def __call__(self, response):
+        if self.finished:
+            return
+        self.finished = True
+        if self.controller.Failed():
+            self.handler.send_error(self.request.id, RpcErrors.METHOD_ERROR,
+                                    self.controller.ErrorText())
+        elif response is None:
+            self.handler.send_error(self.request.id, RpcErrors.METHOD_ERROR,
+                                    "%s did not produce a response"
+                                    % self.method.full_name)
+        else:
+            self.handler.send_response(self.handler.encode_response(
+                response.SerializeToString(), self.request))
+
+    def failed(self, exception):
+        if not self.finished:
+            self.controller.SetFailed("%s: %s" % (type(exception).__name__,
+                                                  exception))
+            self(None)
+
+    def task_done(self, task):
+        if task.cancelled():
+            self.controller.SetFailed("cancelled")
+            self(None)
+        elif task.exception() is not None:
+            self.failed(task.exception())
+        else:
+            self(task.result())
+
+
+def _call_worker(pool, deadline, *args):
+    # Runs in an executor thread, where waiting for a worker is fine.
+    workers = pool.idle(queue.Queue)
+    worker = workers.get()
+    try:
+        return unless_expired(deadline, call_in_worker, worker, *args)
+    finally:
+        workers.put(pool.respawned(worker))
@@ -0,0 +1,134 @@
+"""Caching of responses to idempotent calls.
+
+A Cache holds values by key, least recently used first out, within a
+budget of bytes (and optionally of entries), each for at most ``ttl``
+seconds. Keys are ``(method full name, serialized request)`` pairs.
+
+Clients opt in per Proxy::
+
+    cache = Cache(max_bytes=16 << 20, ttl=30)
+    proxy = Proxy(Config_Stub(channel), Math_Stub(channel), cache=cache,
+                  cached=["Config", "Math.Add"])
+
+Identical calls made while the first is still in flight wait for its
+response rather than sending their own (single-flight); failures are not
+cached.
+
+Servers opt in per method, with the memoized decorator; the cache then
+holds serialized responses, which are sent again as they are::
+
+    class Config(config_pb2.Config):
+        @memoized(Cache(max_bytes=64 << 20, ttl=5))
+        def Get(self, controller, request, done):
+            ...
+
+Duplicate requests arriving while the first one runs share its result.
+"""
+
+import time
+from collections import OrderedDict
+
+__all__ = ["Cache", "memoized"]
+
+
+class Cache(object):
+    """
+    :param int max_bytes: total size of the cached keys and values
+    :param float ttl: seconds an entry stays valid, None for no limit
+    :param int max_entries: None for no limit other than ``max_bytes``
+    """
+
+    def __init__(self, max_bytes=1 << 20, ttl=None, max_entries=None,
+                 clock=time.time):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.clock = clock
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Fetches under way, by key; what waits on them is up to the
+        # caller (an AsyncResult, a list of Deferreds, ...).
+        self.in_flight = {}
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        """The value cached for ``key``, or None."""
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            value, size, expires = entry
+            if expires is None or expires > self.clock():
+                # Reinserted: most recently used last.
+                self._entries[key] = entry
+                self.hits += 1
+                return value
+            self.size -= size
+        self.misses += 1
+        return None
+
+    def put(self, key, value, size):
+        """
+        Cache ``value``, ``size`` bytes large, for ``key``. Values larger
+        than the whole budget are not cached.
+        """
+        self.discard(key)
+        if size > self.max_bytes:
+            return
+        expires = None if self.ttl is None else self.clock() + self.ttl
+        self._entries[key] = (value, size, expires)
+        self.size += size
+        while self.size > self.max_bytes or (
+                self.max_entries is not None and
+                len(self._entries) > self.max_entries):
+            _, (_, evicted, _) = self._entries.popitem(last=False)
+            self.size -= evicted
+            self.evictions += 1
+
+    def discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def stats(self):
+        return {"entries": len(self._entries), "bytes": self.size,
+                "hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions,
+                "in_flight": len(self.in_flight)}
+
+
+def caches_method(cached, method_name):
+    """
+    Whether ``cached``, a collection of "Service" and "Service.Method"
+    names or None for all of them, includes ``method_name``.
+    """
+    return cached is None or method_name in cached or \
+        method_name.split('.')[0] in cached
+
+
+def copy_message(message):
+    copy = message.__class__()
+    copy.CopyFrom(message)
+    return copy
+
+
+def memoized(cache):
+    """
+    Decorator caching a service method's serialized responses in
+    ``cache``, a Cache, by request.
+    """
+
+    def decorate(func):
+        func.response_cache = cache
+        return func
+    return decorate
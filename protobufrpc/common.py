@@ -18,9 +18,35 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import math
+import os
+import pickle
+import struct
+import time
+from collections import deque, namedtuple
 from google.protobuf.service import RpcController
 
 
+class RPCException(Exception):
+    pass
+
+
+class RpcErrors:
+    SUCCESS = 0
+    UNSERIALIZE_RPC = 1
+    SERVICE_NOT_FOUND = 2
+    METHOD_NOT_FOUND = 3
+    CANNOT_DESERIALIZE_REQUEST = 4
+    METHOD_ERROR = 5
+    OVERLOADED = 6
+    DEADLINE_EXCEEDED = 7
+
+    msgs = ['Success', 'Error when unserializing Rpc message',
+            'Service not found', 'Method not found',
+            'Cannot deserialized request', 'Method Error',
+            'Server overloaded', 'Deadline exceeded']
+
+
 def flatten(l):
     result = []
     for i in l:
@@ -33,9 +59,20 @@ def flatten(l):
 
 class Controller(RpcController):
     error = None
+    deadline = None
+    # tracing.SpanContext of the call: on the server, the span serving it;
+    # on a client, the one it is made from (by default the current one).
+    trace = None
 
-    def __init__(self, peer=None):
+    def __init__(self, peer=None, timeout=None):
+        """
+        :param float timeout: seconds the call may take, see SetTimeout
+        """
         self._peer = peer
+        self._cancelled = False
+        self._cancel_callbacks = []
+        if timeout is not None:
+            self.SetTimeout(timeout)
 
     @property
     def peer(self):
@@ -43,6 +80,10 @@ class Controller(RpcController):
 
     def Reset(self):
         self.error = None
+        self.deadline = None
+        self.trace = None
+        self._cancelled = False
+        self._cancel_callbacks = []
 
     def Failed(self):
         return self.error != None
@@ -50,19 +91,575 @@ class Controller(RpcController):
     def ErrorText(self):
         return self.error
 
+    def SetTimeout(self, timeout):
+        """
+        Fail the call unless it completes within ``timeout`` seconds. The
+        server is told, and skips the request once nobody waits for it.
+        """
+        self.deadline = time.time() + timeout
+
+    def TimeRemaining(self):
+        """Seconds left until the deadline, or None without one."""
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.time())
+
     def StartCancel(self):
-        pass
+        if self._cancelled:
+            return
+        self._cancelled = True
+        callbacks, self._cancel_callbacks = self._cancel_callbacks, []
+        for callback in callbacks:
+            callback()
 
     def SetFailed(self, reason):
         self.error = reason
 
     def IsCancelled(self):
-        pass
+        return self._cancelled
 
     def NotifyOnCancel(self, callback):
-        pass
+        if self._cancelled:
+            callback()
+        else:
+            self._cancel_callbacks.append(callback)
 
 
 class ServiceContainer(dict):
     def __getattr__(self, key):
         return self[key]
+
+
+# Where a service method runs, see execution().
+INLINE = "inline"
+THREAD = "thread"
+PROCESS = "process"
+
+
+def execution(policy):
+    """
+    Decorator choosing where a service method runs:
+
+    * INLINE (the default): on the event loop, like any other callback.
+    * THREAD: in a thread pool, for methods that block or release the GIL.
+    * PROCESS: in a process pool, which receives the serialized request; the
+      service instance must be picklable.
+
+    Offloaded methods must call ``done`` before returning.
+    """
+    if policy not in (INLINE, THREAD, PROCESS):
+        raise ValueError("unknown execution policy %r" % (policy,))
+
+    def decorate(func):
+        func.execution_policy = policy
+        return func
+    return decorate
+
+
+class MethodEntry(namedtuple("MethodEntry", ["service", "method",
+                                               "request_class",
+                                               "response_class",
+                                               "execution", "compression",
+                                               "cache", "streaming"])):
+    __slots__ = ()
+
+    @property
+    def name(self):
+        """The "Service.Method" name requests carry."""
+        return self.method.containing_service.name + '.' + self.method.name
+
+
+def index_service(methods, service):
+    """
+    Add every method of ``service`` to the ``methods`` dispatch index, keyed
+    by the "Service.Method" name requests carry on the wire, so dispatching
+    a request is a single dict lookup.
+    """
+    descriptor = service.GetDescriptor()
+    for method in descriptor.methods:
+        implementation = getattr(type(service), method.name, None)
+        methods[descriptor.name + '.' + method.name] = MethodEntry(
+            service, method, service.GetRequestClass(method),
+            service.GetResponseClass(method),
+            getattr(implementation, "execution_policy", INLINE),
+            getattr(implementation, "compression",
+                    getattr(service, "compression", None)),
+            getattr(implementation, "response_cache", None),
+            getattr(implementation, "streaming", None))
+
+
+def serves_streams(methods):
+    """Whether any method of a dispatch index streams."""
+    return any(entry.streaming for entry in methods.values())
+
+
+def call_method(service, method_name, serialized_request):
+    """
+    Run one method of ``service`` from and to serialized messages, as done
+    for offloaded methods.
+
+    :return: (serialized response, None) or (None, error text)
+    """
+    method = service.GetDescriptor().FindMethodByName(method_name)
+    request = service.GetRequestClass(method)()
+    controller = Controller()
+    result = []
+    try:
+        request.ParseFromString(serialized_request)
+        service.CallMethod(method, controller, request, result.append)
+    except Exception as e:
+        return None, "%s: %s" % (type(e).__name__, e)
+    if controller.Failed():
+        return None, controller.ErrorText()
+    if not result:
+        return None, "%s did not produce a response" % method.full_name
+    return result[0].SerializeToString(), None
+
+
+class ProcessWorker(object):
+    """
+    A forked process running call_method for PROCESS methods. Requests and
+    results travel as length-prefixed pickles over a pair of pipes.
+
+    ``exited`` is set once a call finds the process gone; ProcessPool
+    replaces such workers.
+    """
+
+    exited = False
+
+    def __init__(self):
+        requests_r, requests_w = os.pipe()
+        results_r, results_w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(requests_w)
+            os.close(results_r)
+            try:
+                _serve_offloaded(requests_r, results_w)
+            finally:
+                os._exit(0)
+        os.close(requests_r)
+        os.close(results_w)
+        self.pid = pid
+        self._requests = requests_w
+        self._results = results_r
+
+    def call(self, service, method_name, serialized_request):
+        """
+        Run call_method in the worker. This blocks on the pipes, so it
+        belongs in a thread, never on the event loop.
+
+        :raise RPCException: if the worker process has exited
+        """
+        try:
+            data = pickle.dumps((service, method_name, serialized_request),
+                                pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            return None, "cannot send %s to a worker process: %s" % (
+                method_name, e)
+        try:
+            _send_message(self._requests, data)
+            data = _recv_message(self._results)
+        except OSError:
+            # EPIPE: the process has already gone
+            data = None
+        if data is None:
+            self.exited = True
+            raise RPCException("worker exited")
+        return pickle.loads(data)
+
+    def close(self):
+        os.close(self._requests)
+        os.close(self._results)
+        os.waitpid(self.pid, 0)
+
+
+def call_in_worker(worker, *args):
+    """
+    ProcessWorker.call, reporting the worker's exit as an error the way
+    call_method reports one.
+    """
+    try:
+        return worker.call(*args)
+    except RPCException as e:
+        return None, str(e)
+
+
+def _serve_offloaded(requests, results):
+    while True:
+        data = _recv_message(requests)
+        if data is None:
+            return
+        result = call_method(*pickle.loads(data))
+        _send_message(results, pickle.dumps(result, pickle.HIGHEST_PROTOCOL))
+
+
+def _send_message(fd, data):
+    view = memoryview(struct.pack("!I", len(data)) + data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def _recv_message(fd):
+    header = _recv_exactly(fd, 4)
+    if header is None:
+        return None
+    return _recv_exactly(fd, struct.unpack("!I", header)[0])
+
+
+def _recv_exactly(fd, size):
+    chunks = []
+    while size:
+        chunk = os.read(fd, size)
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+class ProcessPool(object):
+    """Worker processes for PROCESS methods, forked on first use."""
+
+    def __init__(self, processes=None):
+        if processes is None:
+            import multiprocessing
+            processes = multiprocessing.cpu_count()
+        self.processes = processes
+        self._workers = None
+        self._idle = {}
+
+    @property
+    def workers(self):
+        if self._workers is None:
+            self._workers = [ProcessWorker() for _ in range(self.processes)]
+        return self._workers
+
+    def idle(self, queue_class):
+        """
+        The pool's idle workers, in a ``queue_class`` filled on first use.
+        Each backend waits for a worker with a queue of its own kind.
+        """
+        if queue_class not in self._idle:
+            idle = self._idle[queue_class] = queue_class()
+            for worker in self.workers:
+                idle.put(worker)
+        return self._idle[queue_class]
+
+    def respawned(self, worker):
+        """
+        ``worker``, or if its process has exited, a new worker taking its
+        place in the pool.
+        """
+        if not worker.exited:
+            return worker
+        worker.close()
+        replacement = ProcessWorker()
+        if self._workers is not None and worker in self._workers:
+            self._workers[self._workers.index(worker)] = replacement
+        return replacement
+
+    def close(self):
+        workers, self._workers = self._workers or [], None
+        self._idle = {}
+        for worker in workers:
+            worker.close()
+
+
+_process_pool = None
+
+
+def process_pool():
+    """The pool PROCESS methods run in."""
+    global _process_pool
+    if _process_pool is None:
+        _process_pool = ProcessPool()
+    return _process_pool
+
+
+def set_process_pool(pool):
+    """Use ``pool``, a ProcessPool, for PROCESS methods."""
+    global _process_pool
+    _process_pool = pool
+
+
+# Upper bound on the method ids one connection may bind.
+MAX_METHOD_IDS = 4096
+
+
+def lookup_method(methods, method_ids, serializedRequest):
+    """
+    Find the MethodEntry a request calls, by name or by a method id bound
+    earlier on the same connection. A request carrying both binds the id in
+    ``method_ids``; pass None where ids cannot be bound (e.g. over UDP).
+    """
+    if serializedRequest.HasField('method'):
+        entry = methods.get(serializedRequest.method)
+        if entry is not None and serializedRequest.method_id and \
+                method_ids is not None and len(method_ids) < MAX_METHOD_IDS:
+            method_ids[serializedRequest.method_id] = entry
+        return entry
+    if method_ids is None:
+        return None
+    return method_ids.get(serializedRequest.method_id)
+
+
+def dispatch_error(services, method_name):
+    """The RpcErrors code for a request lookup_method could not resolve."""
+    if not method_name or method_name.split('.')[0] in services:
+        return RpcErrors.METHOD_NOT_FOUND
+    return RpcErrors.SERVICE_NOT_FOUND
+
+
+def acknowledge_method_id(serializedResponse, serializedRequest, method_ids):
+    """Tell the client a method id it sent has been bound."""
+    if serializedRequest.method_id and serializedRequest.HasField('method') \
+            and method_ids and serializedRequest.method_id in method_ids:
+        serializedResponse.method_id = serializedRequest.method_id
+
+
+class MethodIds(object):
+    """
+    Client side of method id binding for one connection.
+
+    The first request for a method carries both its name and a small id;
+    once a response acknowledges the id, later requests carry only the id.
+    Servers that do not know about method ids never acknowledge, so they
+    keep receiving names.
+    """
+
+    def __init__(self):
+        self._ids = {}
+        self._bound = set()
+
+    def fill(self, rpcRequest, method_name):
+        _id = self._ids.get(method_name)
+        if _id is None:
+            _id = self._ids[method_name] = len(self._ids) + 1
+        rpcRequest.method_id = _id
+        if _id not in self._bound:
+            rpcRequest.method = method_name
+
+    def acknowledged(self, method_id):
+        self._bound.add(method_id)
+
+
+def set_timeout(rpcRequest, controller):
+    """
+    Carry what is left of the controller's deadline in ``rpcRequest``.
+
+    :return: False if the deadline has already passed
+    """
+    remaining = controller.TimeRemaining()
+    if remaining is None:
+        return True
+    if not remaining:
+        return False
+    rpcRequest.timeout_ms = max(1, int(remaining * 1000))
+    return True
+
+
+def request_deadline(serializedRequest):
+    """The local time after which nobody waits for a request, or None."""
+    if not serializedRequest.HasField('timeout_ms'):
+        return None
+    return time.time() + serializedRequest.timeout_ms / 1000.0
+
+
+def expired(deadline):
+    return deadline is not None and time.time() >= deadline
+
+
+def unless_expired(deadline, func, *args):
+    """
+    Call ``func``, which returns a (serialized response, error) pair like
+    call_method, unless ``deadline`` has passed while the call was queued.
+    """
+    if expired(deadline):
+        return None, RpcErrors.msgs[RpcErrors.DEADLINE_EXCEEDED]
+    return func(*args)
+
+
+class TimerWheel(object):
+    """
+    Deadlines of pending calls, bucketed by ``resolution`` seconds into a
+    ring of ``slots`` lists so that adding and cancelling one is O(1)
+    however many are pending. Deadlines are never reported early, and at
+    most one ``resolution`` late when expire() is called every tick.
+    """
+
+    def __init__(self, resolution=0.01, slots=512):
+        self.resolution = resolution
+        self._slots = [{} for _ in range(slots)]
+        self._ticks = {}
+        self._tick = int(time.time() / resolution)
+
+    def __len__(self):
+        return len(self._ticks)
+
+    def __contains__(self, key):
+        return key in self._ticks
+
+    def add(self, key, deadline):
+        tick = max(int(math.ceil(deadline / self.resolution)), self._tick)
+        self.cancel(key)
+        self._ticks[key] = tick
+        self._slots[tick % len(self._slots)][key] = tick
+
+    def cancel(self, key):
+        tick = self._ticks.pop(key, None)
+        if tick is not None:
+            del self._slots[tick % len(self._slots)][key]
+
+    def expire(self, now=None):
+        """Remove and return the keys whose deadline has passed."""
+        if now is None:
+            now = time.time()
+        target = int(now / self.resolution)
+        # After a long pause every slot is due for a look, but only once.
+        ticks = min(target - self._tick + 1, len(self._slots))
+        expired = []
+        for tick in range(target - ticks + 1, target + 1):
+            slot = self._slots[tick % len(self._slots)]
+            due = [key for key, when in slot.items() if when <= target]
+            for key in due:
+                del slot[key]
+                del self._ticks[key]
+            expired.extend(due)
+        self._tick = max(self._tick, target + 1)
+        return expired
+
+
+class PendingCalls(object):
+    """
+    The calls a channel waits on, by request id. A call leaves when it is
+    answered, fails or expires, so the table holds in-flight calls only.
+
+    With ``max_in_flight`` set, calls started through admit() beyond that
+    many wait in line and start, in order, as earlier ones leave.
+    """
+
+    # Upper bounds in seconds of the buckets of age_histogram().
+    age_buckets = (0.001, 0.01, 0.1, 1.0, 10.0, 60.0)
+
+    def __init__(self, max_in_flight=None):
+        self.max_in_flight = max_in_flight
+        self._calls = {}
+        self._waiting = deque()
+
+    def __len__(self):
+        return len(self._calls)
+
+    def __contains__(self, _id):
+        return _id in self._calls
+
+    @property
+    def waiting(self):
+        return len(self._waiting)
+
+    def admit(self, start):
+        """
+        Call ``start``, which should add a call, now if there is room for
+        it and otherwise once there is.
+        """
+        if not self._waiting and self._has_room():
+            start()
+        else:
+            self._waiting.append(start)
+
+    def add(self, _id, call):
+        self._calls[_id] = (time.time(), call)
+
+    def pop(self, _id):
+        """Remove and return the call for ``_id``, or None."""
+        entry = self._calls.pop(_id, None)
+        if entry is None:
+            return None
+        self._start_waiting()
+        return entry[1]
+
+    def clear(self):
+        """Remove and return every call, e.g. when the connection is lost."""
+        calls, self._calls = self._calls, {}
+        self._start_waiting()
+        return [call for _, call in calls.values()]
+
+    def _has_room(self):
+        return self.max_in_flight is None or \
+            len(self._calls) < self.max_in_flight
+
+    def _start_waiting(self):
+        while self._waiting and self._has_room():
+            self._waiting.popleft()()
+
+    def oldest(self, now=None):
+        """Age in seconds of the longest pending call, 0 without any."""
+        if not self._calls:
+            return 0.0
+        started = min(started for started, _ in self._calls.values())
+        return (now or time.time()) - started
+
+    def age_histogram(self, now=None):
+        """
+        How many calls have been pending for at most each of age_buckets,
+        then longer, as a list of (upper bound, count) with None last.
+        """
+        now = now or time.time()
+        counts = [0] * (len(self.age_buckets) + 1)
+        for started, _ in self._calls.values():
+            age = now - started
+            for i, bound in enumerate(self.age_buckets):
+                if age <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[-1] += 1
+        return list(zip(self.age_buckets + (None,), counts))
+
+    def stats(self):
+        now = time.time()
+        return {"size": len(self._calls), "waiting": len(self._waiting),
+                "oldest": self.oldest(now),
+                "ages": self.age_histogram(now)}
+
+
+class ResponseCoalescer(object):
+    """Gather outgoing responses into as few Rpc frames as possible.
+
+    Responses (envelope.ResponseRecords) added during one turn of the event
+    loop go out together in a single frame, written by ``write(data)`` from
+    the callback passed to ``schedule``. A frame is written straight away
+    once it holds ``max_count`` responses or ``max_bytes`` of payload.
+    """
+
+    def __init__(self, write, schedule, max_count=64, max_bytes=64 * 1024):
+        self._write = write
+        self._schedule = schedule
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        # Encoded responses: an Rpc frame is their concatenation.
+        self._frames = []
+        self._bytes = 0
+        self._scheduled = False
+
+    def add(self, serializedResponse):
+        frame = serializedResponse.encode()
+        self._frames.append(frame)
+        self._bytes += len(frame)
+        if len(self._frames) >= self.max_count or \
+                self._bytes >= self.max_bytes:
+            self.flush()
+        elif not self._scheduled:
+            self._scheduled = True
+            self._schedule(self._scheduled_flush)
+
+    def _scheduled_flush(self):
+        self._scheduled = False
+        self.flush()
+
+    def flush(self):
+        if not self._frames:
+            return
+        frames, self._frames = self._frames, []
+        self._bytes = 0
+        self._write(frames[0] if len(frames) == 1 else b"".join(frames))
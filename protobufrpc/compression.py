@@ -0,0 +1,254 @@
+"""Compression of serialized requests and responses.
+
+Payloads are compressed one by one, and the codec used is recorded in the
+envelope (``Request.compression`` / ``Response.compression``). Each side
+lists the codecs it can decompress in ``accept_compression``, and nothing
+is compressed for a peer before it has done so, which old peers never do.
+
+zlib is always available; lz4 and zstd are used when their packages
+(``lz4``, ``zstandard``) can be imported.
+
+Decompressed payloads are bounded, by MAX_SIZE unless a Compression says
+otherwise: a payload that would inflate beyond that is refused rather than
+decompressed, so that a small message cannot exhaust the receiver's memory.
+
+A Compression says when to compress. Clients pass one to their channel;
+servers take a default one and may override it per service, with a
+``compression`` attribute, or per method, with the compressed decorator::
+
+    class Store(store_pb2.Store):
+        compression = Compression(threshold=4096)
+
+        @compressed(Compression(codecs=[ZLIB], level=9))
+        def Get(self, controller, request, done):
+            ...
+
+        @compressed(False)
+        def Put(self, controller, request, done):
+            ...
+"""
+
+import io
+import zlib
+
+from protobufrpc.envelope import payload_bytes
+
+__all__ = ["NONE", "ZLIB", "LZ4", "ZSTD", "MAX_SIZE", "TooLarge",
+           "Compression", "compressed", "decompress"]
+
+NONE = 0
+ZLIB = 1
+LZ4 = 2
+ZSTD = 3
+
+# Default bound, in bytes, of a decompressed payload.
+MAX_SIZE = 64 * 1024 * 1024
+
+
+class TooLarge(ValueError):
+    """A payload decompresses to more than allowed."""
+
+
+class Codec(object):
+    """
+    ``decompress(data, max_size)`` returns at most ``max_size + 1`` bytes,
+    so that exceeding the bound shows without inflating any further.
+    """
+
+    def __init__(self, id, name, compress, decompress):
+        self.id = id
+        self.name = name
+        self.compress = compress
+        self.decompress = decompress
+
+
+def _zlib_compress(data, level=None):
+    return zlib.compress(data, 6 if level is None else level)
+
+
+def _zlib_decompress(data, max_size):
+    return zlib.decompressobj().decompress(data, max_size + 1)
+
+
+CODECS = {ZLIB: Codec(ZLIB, "zlib", _zlib_compress, _zlib_decompress)}
+
+try:
+    import lz4.frame
+except ImportError:
+    pass
+else:
+    def _lz4_compress(data, level=None):
+        return lz4.frame.compress(data, compression_level=level or 0)
+
+    def _lz4_decompress(data, max_size):
+        return lz4.frame.LZ4FrameDecompressor().decompress(
+            data, max_length=max_size + 1)
+
+    CODECS[LZ4] = Codec(LZ4, "lz4", _lz4_compress, _lz4_decompress)
+
+try:
+    import zstandard
+except ImportError:
+    pass
+else:
+    def _zstd_compress(data, level=None):
+        return zstandard.ZstdCompressor(level=level or 3).compress(data)
+
+    def _zstd_decompress(data, max_size):
+        # Streamed, as the one-shot decompress trusts the content size
+        # the frame header claims.
+        reader = zstandard.ZstdDecompressor().stream_reader(io.BytesIO(data))
+        return reader.read(max_size + 1)
+
+    CODECS[ZSTD] = Codec(ZSTD, "zstd", _zstd_compress, _zstd_decompress)
+
+# The accept_compression mask for the codecs available here.
+ACCEPTED = sum(1 << codec for codec in CODECS)
+
+
+def decompress(payload, codec, max_size=None):
+    """
+    :param int max_size: bound of the decompressed payload, None for
+        MAX_SIZE
+    :raise ValueError: for a codec not available here
+    :raise TooLarge: when the payload decompresses to more than max_size
+    """
+    if not codec:
+        return payload
+    if codec not in CODECS:
+        raise ValueError("unknown compression codec %d" % codec)
+    if max_size is None:
+        max_size = MAX_SIZE
+    data = CODECS[codec].decompress(payload_bytes(payload), max_size)
+    if len(data) > max_size:
+        raise TooLarge("payload decompresses to more than %d bytes"
+                       % max_size)
+    return data
+
+
+def decompression_limit(compression):
+    """The decompression bound ``compression`` (which may be None) sets."""
+    if compression is None:
+        return None
+    return compression.max_size
+
+
+class Compression(object):
+    """
+    When and how to compress payloads.
+
+    :param codecs: codec ids in order of preference; the first one the
+        peer accepts is used
+    :param int threshold: payloads smaller than this many bytes are sent
+        as they are
+    :param level: codec specific compression level, None for its default
+    :param dict methods: Compression, or None to not compress, to use
+        instead for a "Service" or "Service.Method"
+    :param int max_size: bound, in bytes, of the payloads decompressed
+        by the channel or server using this Compression, None for MAX_SIZE
+    """
+
+    def __init__(self, codecs=(ZSTD, LZ4, ZLIB), threshold=1024, level=None,
+                 methods=None, max_size=None):
+        self.codecs = [c for c in codecs if c in CODECS]
+        self.threshold = threshold
+        self.level = level
+        self.methods = methods or {}
+        self.max_size = max_size
+
+    def select(self, method_name):
+        """The Compression to use for ``method_name``, or None."""
+        if method_name in self.methods:
+            return self.methods[method_name]
+        service = method_name.split('.')[0]
+        return self.methods.get(service, self)
+
+    def compress(self, payload, accepted):
+        """
+        :param int accepted: the peer's accept_compression mask
+        :return: (payload, codec), payload being left alone with NONE when
+            too small, not accepted or not worth it
+        """
+        if len(payload) < self.threshold:
+            return payload, NONE
+        for codec in self.codecs:
+            if accepted & (1 << codec):
+                compressed = CODECS[codec].compress(payload, self.level)
+                if len(compressed) < len(payload):
+                    return compressed, codec
+                break
+        return payload, NONE
+
+
+def compressed(compression):
+    """
+    Decorator setting how a service method's responses are compressed: a
+    Compression, or False to never compress them.
+    """
+
+    def decorate(func):
+        func.compression = compression
+        return func
+    return decorate
+
+
+def method_compression(compression, default, method_name):
+    """
+    The Compression for a server method: ``compression``, from the method
+    or its service, or else what the server's ``default`` says.
+    """
+    if compression is False:
+        return None
+    if compression is not None:
+        return compression
+    if default is not None:
+        return default.select(method_name)
+    return None
+
+
+def decompress_request(serializedRequest, max_size=None):
+    """
+    Replace a compressed ``serialized_request`` by the plain payload.
+
+    :param int max_size: see decompress
+    :raise TooLarge: when the payload decompresses to more than max_size
+    :raise Exception: whatever the codec raises for a corrupt payload
+    """
+    if serializedRequest.compression:
+        serializedRequest.serialized_request = decompress(
+            serializedRequest.serialized_request,
+            serializedRequest.compression, max_size)
+        serializedRequest.ClearField('compression')
+
+
+def fill_request(compression, rpcRequest, method_name, payload, accepted):
+    """
+    Set ``rpcRequest.serialized_request`` to ``payload``, compressed as
+    ``compression`` (which may be None) says and ``accepted``, the
+    server's mask, allows.
+    """
+    if compression is not None:
+        rpcRequest.accept_compression = ACCEPTED
+        compression = compression.select(method_name)
+    if compression is not None:
+        payload, codec = compression.compress(payload, accepted)
+        if codec:
+            rpcRequest.compression = codec
+    rpcRequest.serialized_request = payload
+
+
+def fill_response(compression, serializedResponse, serializedRequest,
+                  payload):
+    """
+    Set ``serializedResponse.serialized_response`` to ``payload``,
+    compressed as ``compression`` (which may be None) says and the
+    request allows.
+    """
+    accepted = serializedRequest.accept_compression
+    if accepted:
+        serializedResponse.accept_compression = ACCEPTED
+        if compression is not None:
+            payload, codec = compression.compress(payload, accepted)
+            if codec:
+                serializedResponse.compression = codec
+    serializedResponse.serialized_response = payload
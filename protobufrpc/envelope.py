@@ -0,0 +1,376 @@
+"""Encoding and decoding of the Rpc envelope (protobufrpc.proto) by hand.
+
+The envelope only wraps payloads that are already serialized, so going
+through protobuf messages for it costs a copy of every payload into a
+Response, another into the Rpc holding it and a third into the frame, and
+as many on the way in. Here responses are records, plain objects with the
+fields of the message as attributes, written straight into the frame: the
+field tags and lengths around the payload, in one allocation::
+
+    record = ResponseRecord(id=request.id, serialized_response=payload)
+    frame = record.encode()
+
+The encoding of an Rpc made of several responses is the concatenation of
+theirs. decode_rpc() reads frames back into records, slicing the payloads
+out of the frame. Asked for views, it leaves payloads in the frame: they
+are memoryviews of it, which inner messages parse from without a copy::
+
+    requests, responses = decode_rpc(data, views=True)
+    request.ParseFromString(requests[0].serialized_request)
+
+Views of a frame in a reused buffer (as FrameReader hands out) are only
+valid as long as the frame is, and cannot be hashed or pickled:
+payload_bytes() turns them into bytes where needed.
+
+Records answer HasField() and ClearField() as messages do; fields never
+set read as their default. A response's error is set as a whole,
+``record.error = ErrorRecord(code=..., text=...)``, not field by field.
+"""
+
+from google.protobuf.internal import api_implementation
+from google.protobuf.message import DecodeError
+
+from protobufrpc.protobufrpc_pb2 import Error, Rpc
+
+__all__ = ["RequestRecord", "ResponseRecord", "ErrorRecord", "decode_rpc",
+           "encode_varint", "payload_bytes"]
+
+_VARINT, _FIXED64, _LENGTH, _FIXED32 = 0, 1, 2, 5
+
+
+def encode_varint(value):
+    if value < 0x80:
+        return _SMALL_VARINTS[value]
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+_SMALL_VARINTS = [bytes(bytearray([value])) for value in range(0x80)]
+
+
+if bytes is str:
+    def _read_varint(data, pos):
+        b = ord(data[pos])
+        pos += 1
+        if b < 0x80:
+            return b, pos
+        result = b & 0x7f
+        shift = 7
+        while True:
+            b = ord(data[pos])
+            pos += 1
+            result |= (b & 0x7f) << shift
+            if b < 0x80:
+                return result, pos
+            shift += 7
+            if shift > 63:
+                raise DecodeError("varint too long")
+else:
+    def _read_varint(data, pos):
+        b = data[pos]
+        pos += 1
+        if b < 0x80:
+            return b, pos
+        result = b & 0x7f
+        shift = 7
+        while True:
+            b = data[pos]
+            pos += 1
+            result |= (b & 0x7f) << shift
+            if b < 0x80:
+                return result, pos
+            shift += 7
+            if shift > 63:
+                raise DecodeError("varint too long")
+
+
+def _parses_views():
+    try:
+        Error().ParseFromString(memoryview(b"\x08\x02"))
+    except TypeError:
+        return False
+    return True
+
+# Whether messages parse from memoryviews, as the cpp and upb backends, and
+# the python one from protobuf 3.2 on, do.
+PARSES_VIEWS = _parses_views()
+
+# The cpp and upb backends parse an Rpc faster than decode_rpc() can, unless
+# its payloads are large enough for views of them to pay off.
+NATIVE = api_implementation.Type() != "python"
+
+
+def payload_bytes(payload):
+    """``payload``, a payload decode_rpc() returned, as bytes."""
+    if isinstance(payload, memoryview):
+        return payload.tobytes()
+    return payload
+
+
+def _key(number, wire_type):
+    return (number << 3) | wire_type
+
+
+def _utf8(text):
+    if isinstance(text, bytes):
+        return text
+    return text.encode("utf-8")
+
+
+class Record(object):
+    """A message's fields, as attributes."""
+
+    # {key: (attribute, kind)}, key being the field's tag and wire type.
+    _fields = {}
+
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+    def HasField(self, name):
+        return name in self.__dict__
+
+    def ClearField(self, name):
+        self.__dict__.pop(name, None)
+
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__.__name__, ", ".join(
+            "%s=%r" % item for item in sorted(self.__dict__.items())))
+
+
+class RequestRecord(Record):
+    method = u""
+    serialized_request = b""
+    id = 0
+    method_id = 0
+    timeout_ms = 0
+    compression = 0
+    accept_compression = 0
+    trace_id = b""
+    parent_span_id = 0
+    sampled = False
+    end_of_stream = False
+    window = 0
+
+
+class ErrorRecord(Record):
+    code = 0
+    text = u""
+
+    def encode_fields(self):
+        code = self.code
+        parts = [b"\x08", encode_varint(
+            code << 1 if code >= 0 else (-code << 1) - 1)]
+        if "text" in self.__dict__:
+            text = _utf8(self.text)
+            parts += [b"\x12", encode_varint(len(text)), text]
+        return b"".join(parts)
+
+
+class ResponseRecord(Record):
+    serialized_response = b""
+    error = ErrorRecord()
+    id = 0
+    method_id = 0
+    compression = 0
+    accept_compression = 0
+    span_id = 0
+    end_of_stream = False
+    window = 0
+
+    def encode(self):
+        """The Rpc frame carrying this response alone."""
+        d = self.__dict__
+        if "error" in d:
+            error = self.error.encode_fields()
+            parts = [b"\x12", encode_varint(len(error)), error]
+        elif "serialized_response" in d:
+            payload = self.serialized_response
+            parts = [b"\x0a", encode_varint(len(payload)), payload]
+        else:
+            parts = []
+        parts += [b"\x18", encode_varint(self.id)]
+        if "method_id" in d:
+            parts += [b"\x20", encode_varint(self.method_id)]
+        if "compression" in d:
+            parts += [b"\x28", encode_varint(self.compression)]
+        if "accept_compression" in d:
+            parts += [b"\x30", encode_varint(self.accept_compression)]
+        if "span_id" in d:
+            parts += [b"\x38", encode_varint(self.span_id)]
+        if "end_of_stream" in d:
+            parts += [b"\x40", b"\x01" if self.end_of_stream else b"\x00"]
+        if "window" in d:
+            parts += [b"\x48", encode_varint(self.window)]
+        size = 0
+        for part in parts:
+            size += len(part)
+        parts[:0] = [b"\x12", encode_varint(size)]
+        return b"".join(parts)
+
+
+# Kinds of fields
+_UINT, _BOOL, _SINT, _BYTES, _STRING, _ERROR, _PAYLOAD = range(7)
+
+RequestRecord._fields = {
+    _key(1, _LENGTH): ("method", _STRING),
+    _key(2, _LENGTH): ("serialized_request", _PAYLOAD),
+    _key(3, _VARINT): ("id", _UINT),
+    _key(4, _VARINT): ("method_id", _UINT),
+    _key(5, _VARINT): ("timeout_ms", _UINT),
+    _key(6, _VARINT): ("compression", _UINT),
+    _key(7, _VARINT): ("accept_compression", _UINT),
+    _key(8, _LENGTH): ("trace_id", _BYTES),
+    _key(9, _VARINT): ("parent_span_id", _UINT),
+    _key(10, _VARINT): ("sampled", _BOOL),
+    _key(11, _VARINT): ("end_of_stream", _BOOL),
+    _key(12, _VARINT): ("window", _UINT),
+}
+
+ErrorRecord._fields = {
+    _key(1, _VARINT): ("code", _SINT),
+    _key(2, _LENGTH): ("text", _STRING),
+}
+
+ResponseRecord._fields = {
+    _key(1, _LENGTH): ("serialized_response", _PAYLOAD),
+    _key(2, _LENGTH): ("error", _ERROR),
+    _key(3, _VARINT): ("id", _UINT),
+    _key(4, _VARINT): ("method_id", _UINT),
+    _key(5, _VARINT): ("compression", _UINT),
+    _key(6, _VARINT): ("accept_compression", _UINT),
+    _key(7, _VARINT): ("span_id", _UINT),
+    _key(8, _VARINT): ("end_of_stream", _BOOL),
+    _key(9, _VARINT): ("window", _UINT),
+}
+
+
+_REQUEST = _key(1, _LENGTH)
+_RESPONSE = _key(2, _LENGTH)
+
+# Payloads smaller than this are copied out of the frame even when views
+# are asked for: parsing a message from a view costs more than copying a
+# small one.
+VIEW_THRESHOLD = 16 * 1024
+
+# Strings decoded (method names, error texts), by their encoding.
+_strings = {}
+
+
+def _string(encoded):
+    value = _strings.get(encoded)
+    if value is None:
+        value = encoded.decode("utf-8")
+        if len(_strings) < 1024:
+            _strings[encoded] = value
+    return value
+
+
+# Records decoded are filled in directly, without __init__.
+_new = object.__new__
+
+
+def _decode(record, data, pos, end, view, views):
+    fields = record._fields
+    values = record.__dict__
+    while pos < end:
+        key, pos = _read_varint(data, pos)
+        wire_type = key & 7
+        if wire_type == _VARINT:
+            value, pos = _read_varint(data, pos)
+            field = fields.get(key)
+            if field is None:
+                continue
+            name, kind = field
+            if kind == _BOOL:
+                value = bool(value)
+            elif kind == _SINT:
+                value = (value >> 1) ^ -(value & 1)
+            values[name] = value
+        elif wire_type == _LENGTH:
+            length, pos = _read_varint(data, pos)
+            start, pos = pos, pos + length
+            if pos > end:
+                raise DecodeError("truncated message")
+            field = fields.get(key)
+            if field is None:
+                continue
+            name, kind = field
+            if kind == _ERROR:
+                values[name] = _decode(_new(ErrorRecord), data, start, pos,
+                                       view, False)
+            elif kind == _PAYLOAD and views and length >= VIEW_THRESHOLD:
+                values[name] = (data if view else memoryview(data))[start:pos]
+            else:
+                value = data[start:pos]
+                if view:
+                    value = value.tobytes()
+                if kind == _STRING:
+                    value = _string(value)
+                values[name] = value
+        elif wire_type == _FIXED64:
+            pos += 8
+        elif wire_type == _FIXED32:
+            pos += 4
+        else:
+            raise DecodeError("unexpected wire type %d" % wire_type)
+    if pos != end:
+        raise DecodeError("truncated message")
+    return record
+
+
+def decode_rpc(data, views=False):
+    """
+    Decode an Rpc frame, ``data`` being bytes or a memoryview. With the
+    cpp or upb backend, frames without payloads to leave in place are
+    parsed into messages, which read as records do.
+
+    :param bool views: leave the payloads of requests and responses (of at
+        least VIEW_THRESHOLD bytes) as memoryviews of ``data``, if
+        messages can parse them
+    :return: (RequestRecords, ResponseRecords)
+    :raises DecodeError: if ``data`` is not a valid Rpc
+    """
+    views = views and PARSES_VIEWS
+    if NATIVE and not (views and len(data) >= VIEW_THRESHOLD):
+        rpc = Rpc()
+        rpc.ParseFromString(data)
+        return rpc.request, rpc.response
+
+    requests = []
+    responses = []
+    view = isinstance(data, memoryview)
+    end = len(data)
+    pos = 0
+    try:
+        while pos < end:
+            key, pos = _read_varint(data, pos)
+            wire_type = key & 7
+            if wire_type == _LENGTH:
+                length, pos = _read_varint(data, pos)
+                start, pos = pos, pos + length
+                if pos > end:
+                    raise DecodeError("truncated message")
+                if key == _REQUEST:
+                    requests.append(
+                        _decode(_new(RequestRecord), data, start, pos, view,
+                                views))
+                elif key == _RESPONSE:
+                    responses.append(
+                        _decode(_new(ResponseRecord), data, start, pos, view,
+                                views))
+            elif wire_type == _VARINT:
+                _, pos = _read_varint(data, pos)
+            elif wire_type == _FIXED64:
+                pos += 8
+            elif wire_type == _FIXED32:
+                pos += 4
+            else:
+                raise DecodeError("unexpected wire type %d" % wire_type)
+        if pos != end:
+            raise DecodeError("truncated message")
+    except (IndexError, UnicodeDecodeError) as e:
+        raise DecodeError(str(e))
+    return requests, responses
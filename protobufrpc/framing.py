@@ -0,0 +1,121 @@
+"""Length-prefixed framing for socket based channels.
+
+Every frame is a 4 byte big-endian length followed by that many bytes of
+payload, the same wire format as Twisted's Int32StringReceiver.
+"""
+
+import struct
+
+__all__ = ["FrameReader", "FrameTooLarge", "write_frame"]
+
+HEADER = struct.Struct("!I")
+
+# Payloads up to this size are sent together with their header in one
+# write; copying them is cheaper than a second system call.
+COPY_THRESHOLD = 32 * 1024
+
+
+class FrameTooLarge(Exception):
+    pass
+
+
+class FrameReader(object):
+    """Reassemble frames from a socket into one reusable buffer.
+
+    Data is received straight into a ``bytearray`` with ``recv_into`` and
+    complete frames are handed out as ``memoryview`` slices of it, so a
+    payload is never copied on its way to the parser. Partial frames stay
+    in the buffer until the rest arrives; the buffer only grows when a
+    single frame does not fit.
+    """
+
+    def __init__(self, size=64 * 1024, max_frame_size=64 * 1024 * 1024):
+        self.max_frame_size = max_frame_size
+        self._buffer = bytearray(size)
+        self._start = 0
+        self._end = 0
+        self._needed = 0
+
+    def read(self, sock, on_frame):
+        """
+        Receive once from ``sock`` and call ``on_frame`` with every frame
+        completed by that data.
+
+        The view passed to ``on_frame`` is only valid during the call: it
+        must be parsed or copied, not kept.
+
+        :return: False once the peer has closed the connection.
+        """
+        received = sock.recv_into(self.get_buffer())
+        if not received:
+            return False
+        self.buffer_updated(received, on_frame)
+        return True
+
+    def get_buffer(self):
+        """
+        The free space at the end of the buffer, for the caller to receive
+        into before calling buffer_updated. The view must be released by
+        the next call to get_buffer.
+        """
+        if self._end == len(self._buffer):
+            self._make_room()
+        return memoryview(self._buffer)[self._end:]
+
+    def buffer_updated(self, received, on_frame):
+        """
+        Account for ``received`` bytes written into the last get_buffer
+        view and call ``on_frame`` as read does.
+        """
+        self._end += received
+        view = memoryview(self._buffer)
+        try:
+            while self._end - self._start >= HEADER.size:
+                length, = HEADER.unpack_from(self._buffer, self._start)
+                if length > self.max_frame_size:
+                    raise FrameTooLarge("frame of %d bytes exceeds limit of %d"
+                                        % (length, self.max_frame_size))
+                begin = self._start + HEADER.size
+                if self._end - begin < length:
+                    self._needed = HEADER.size + length
+                    break
+                self._start = begin + length
+                on_frame(view[begin:self._start])
+        finally:
+            # No view may outlive this call, or the buffer could not grow.
+            del view
+
+        if self._start == self._end:
+            self._start = self._end = 0
+
+    def _make_room(self):
+        pending = self._end - self._start
+        if self._start:
+            self._buffer[:pending] = self._buffer[self._start:self._end]
+            self._start, self._end = 0, pending
+        if pending == len(self._buffer) or self._needed > len(self._buffer):
+            size = max(len(self._buffer) * 2, self._needed)
+            self._buffer.extend(bytearray(size - len(self._buffer)))
+
+
+def write_frame(sock, payload):
+    """Send ``payload`` with its length prefix over ``sock``."""
+    header = HEADER.pack(len(payload))
+    if len(payload) <= COPY_THRESHOLD:
+        sock.sendall(header + payload)
+    elif hasattr(sock, "sendmsg"):
+        _sendmsg_all(sock, [header, payload])
+    else:
+        sock.sendall(header)
+        sock.sendall(payload)
+
+
+def _sendmsg_all(sock, buffers):
+    views = [memoryview(b) for b in buffers]
+    while views:
+        sent = sock.sendmsg(views)
+        while views and sent >= len(views[0]):
+            sent -= len(views[0])
+            views.pop(0)
+        if views and sent:
+            views[0] = views[0][sent:]
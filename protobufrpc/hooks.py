@@ -0,0 +1,88 @@
+"""Hooks into the life of the requests a server serves.
+
+Subclass Hooks, override the callbacks wanted and pass an instance to a
+server (GeventTCPServer, tx.Factory, ...) as its ``hooks`` option::
+
+    class SlowCalls(Hooks):
+        def on_response_sent(self, event):
+            if event.finished - event.started > 0.1:
+                log.warning("slow %s from %s", event.method, event.peer)
+
+    server = GeventTCPServer(addr, services, hooks=SlowCalls(sample_rate=0.01))
+
+Without hooks servers skip all of this. With them, only a ``sample_rate``
+fraction of the requests is followed, decided when each one starts; each
+followed request gets one Event, passed to every callback.
+"""
+
+import random
+import time
+
+__all__ = ["Event", "Hooks"]
+
+
+class Event(object):
+    """
+    One sampled request. Times are time.time() values; ``error`` is the
+    RpcErrors code it failed with, if it did.
+    """
+
+    __slots__ = ("method", "id", "peer", "started", "dispatched",
+                 "finished", "error", "error_text")
+
+    def __init__(self, method, id, peer=None, started=None):
+        self.method = method
+        self.id = id
+        self.peer = peer
+        self.started = time.time() if started is None else started
+        self.dispatched = None
+        self.finished = None
+        self.error = None
+        self.error_text = None
+
+
+class Hooks(object):
+    """
+    :param float sample_rate: fraction of the requests to follow
+    """
+
+    def __init__(self, sample_rate=1.0):
+        self.sample_rate = sample_rate
+
+    def on_request_start(self, event):
+        """A request was received."""
+
+    def on_dispatch(self, event):
+        """The method it calls is about to run."""
+
+    def on_response_sent(self, event):
+        """Its response was handed to the transport."""
+
+    def on_error(self, event):
+        """It failed; ``event.error`` says why."""
+
+    def start(self, method, id, peer=None, started=None):
+        """
+        Start following a request, if sampled.
+
+        :rtype: Event or None
+        """
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return None
+        event = Event(method, id, peer, started)
+        self.on_request_start(event)
+        return event
+
+    def dispatched(self, event):
+        event.dispatched = time.time()
+        self.on_dispatch(event)
+
+    def sent(self, event):
+        event.finished = time.time()
+        self.on_response_sent(event)
+
+    def failed(self, event, code, text=None):
+        event.finished = time.time()
+        event.error = code
+        event.error_text = text
+        self.on_error(event)
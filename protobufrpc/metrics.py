@@ -0,0 +1,277 @@
+"""Per-method call metrics for channels and servers.
+
+A Registry keeps, for each side ("client" or "server") and "Service.Method"
+name, counters of calls, errors by RpcErrors code and payload bytes, a
+gauge of calls in flight and latency histograms: the whole call and its
+queue, deserialize, handler and serialize phases. Pass one to a channel or
+server with its ``metrics`` option and read it with snapshot() or
+prometheus()::
+
+    metrics = Registry()
+    server = GeventTCPServer(addr, services, metrics=metrics)
+    ...
+    print metrics.prometheus()
+
+Histograms are log-linear, as in HdrHistogram: each power of two is split
+into 8 buckets, so recorded values are exact to within 12.5%.
+"""
+
+import time
+
+from protobufrpc.common import RpcErrors
+
+__all__ = ["CLIENT", "SERVER", "LOCAL_ERROR", "Histogram", "Registry"]
+
+CLIENT = "client"
+SERVER = "server"
+
+# Error "code" of client calls that failed without a response: connection
+# lost, cancelled, ...
+LOCAL_ERROR = -1
+
+PHASES = ("queue", "deserialize", "handler", "serialize")
+
+
+class Histogram(object):
+    """
+    Log-linear histogram of durations, kept in microseconds.
+
+    :param int precision: bits of each value kept, 2 ** precision buckets
+        per power of two
+    """
+
+    def __init__(self, precision=3):
+        self.precision = precision
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = 0
+        self._linear = 1 << (precision + 1)
+        self._counts = {}
+
+    def _index(self, value):
+        if value < self._linear:
+            return value
+        shift = value.bit_length() - self.precision - 1
+        return (shift << self.precision) + (value >> shift)
+
+    def _lower_bound(self, index):
+        if index < self._linear:
+            return index
+        shift = (index >> self.precision) - 1
+        return ((index & ((1 << self.precision) - 1)) |
+                (1 << self.precision)) << shift
+
+    def record(self, seconds):
+        value = int(seconds * 1e6)
+        if value < 0:
+            value = 0
+        index = self._index(value)
+        self._counts[index] = self._counts.get(index, 0) + 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, q):
+        """
+        The value, in seconds, ``q`` percent of the recordings are at or
+        below (to within the histogram's precision).
+        """
+        if not self.count:
+            return 0.0
+        rank = self.count * q / 100.0
+        seen = 0
+        for index in sorted(self._counts):
+            seen += self._counts[index]
+            if seen >= rank:
+                upper = self._lower_bound(index + 1) - 1
+                return min(upper, self.max) / 1e6
+        return self.max / 1e6
+
+    def buckets(self):
+        """(upper bound in seconds, count) pairs of the non-empty buckets."""
+        return [((self._lower_bound(index + 1) - 1) / 1e6,
+                 self._counts[index]) for index in sorted(self._counts)]
+
+    def snapshot(self, percentiles=(50, 90, 99, 99.9)):
+        return {"count": self.count,
+                "sum": self.sum / 1e6,
+                "min": (self.min or 0) / 1e6,
+                "max": self.max / 1e6,
+                "percentiles": dict((q, self.percentile(q))
+                                    for q in percentiles)}
+
+
+class MethodMetrics(object):
+    def __init__(self):
+        self.calls = 0
+        self.errors = {}
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.in_flight = 0
+        self.latency = Histogram()
+        self.queue = Histogram()
+        self.deserialize = Histogram()
+        self.handler = Histogram()
+        self.serialize = Histogram()
+
+    def error(self, code):
+        self.errors[code] = self.errors.get(code, 0) + 1
+
+    def snapshot(self):
+        result = {"calls": self.calls, "errors": dict(self.errors),
+                  "bytes_received": self.bytes_received,
+                  "bytes_sent": self.bytes_sent,
+                  "in_flight": self.in_flight,
+                  "latency": self.latency.snapshot()}
+        for phase in PHASES:
+            result[phase] = getattr(self, phase).snapshot()
+        return result
+
+
+class Call(object):
+    """
+    Measures one call: lap() records the time since the previous lap (or
+    mark(), or the start) in one of the phase histograms.
+    """
+
+    def __init__(self, metrics, started):
+        self.metrics = metrics
+        self.started = self._last = started
+        self.finished = False
+        metrics.calls += 1
+        metrics.in_flight += 1
+
+    def mark(self):
+        self._last = time.time()
+
+    def lap(self, phase):
+        now = time.time()
+        getattr(self.metrics, phase).record(now - self._last)
+        self._last = now
+
+    def received(self, size):
+        self.metrics.bytes_received += size
+
+    def sent(self, size):
+        self.metrics.bytes_sent += size
+
+    def finish(self, error=None):
+        """Record the end of the call; only the first finish counts."""
+        if self.finished:
+            return
+        self.finished = True
+        metrics = self.metrics
+        metrics.in_flight -= 1
+        metrics.latency.record(time.time() - self.started)
+        if error is not None:
+            metrics.error(error)
+
+
+class Registry(object):
+    def __init__(self):
+        self._methods = {}
+
+    def method(self, side, name):
+        """The MethodMetrics of ``name`` on ``side``."""
+        key = (side, name)
+        metrics = self._methods.get(key)
+        if metrics is None:
+            metrics = self._methods[key] = MethodMetrics()
+        return metrics
+
+    def start(self, side, name, started=None):
+        """
+        Start measuring a call.
+
+        :param float started: when the call really started, e.g. when the
+            request was read, if earlier than now
+        :rtype: Call
+        """
+        return Call(self.method(side, name),
+                    time.time() if started is None else started)
+
+    def rejected(self, side, name, code):
+        """Count a call that failed before it could start."""
+        metrics = self.method(side, name)
+        metrics.calls += 1
+        metrics.error(code)
+
+    def reset(self):
+        self._methods.clear()
+
+    def snapshot(self):
+        """
+        :return: {side: {method name: metrics}}, as plain dicts
+        """
+        result = {}
+        for (side, name), metrics in self._methods.items():
+            result.setdefault(side, {})[name] = metrics.snapshot()
+        return result
+
+    def prometheus(self, prefix="protobufrpc"):
+        """The metrics in the Prometheus text exposition format."""
+        lines = []
+
+        def family(name, kind, help, samples):
+            lines.append("# HELP %s_%s %s" % (prefix, name, help))
+            lines.append("# TYPE %s_%s %s" % (prefix, name, kind))
+            for suffix, labels, value in samples:
+                lines.append("%s_%s%s{%s} %s" % (
+                    prefix, name, suffix,
+                    ",".join('%s="%s"' % label for label in labels),
+                    _format(value)))
+
+        methods = sorted(self._methods.items())
+        family("calls_total", "counter", "Calls started.",
+               [("", _labels(key), m.calls) for key, m in methods])
+        family("errors_total", "counter", "Calls failed, by error code.",
+               [("", _labels(key) + [("code", _code_name(code))], count)
+                for key, m in methods
+                for code, count in sorted(m.errors.items())])
+        family("received_bytes_total", "counter", "Payload bytes received.",
+               [("", _labels(key), m.bytes_received) for key, m in methods])
+        family("sent_bytes_total", "counter", "Payload bytes sent.",
+               [("", _labels(key), m.bytes_sent) for key, m in methods])
+        family("in_flight", "gauge", "Calls in progress.",
+               [("", _labels(key), m.in_flight) for key, m in methods])
+        for phase in ("latency",) + PHASES:
+            samples = []
+            for key, m in methods:
+                histogram = getattr(m, phase)
+                if not histogram.count:
+                    continue
+                labels = _labels(key)
+                for q in (0.5, 0.9, 0.99, 0.999):
+                    samples.append(("", labels + [("quantile", str(q))],
+                                    histogram.percentile(q * 100)))
+                samples.append(("_sum", labels, histogram.sum / 1e6))
+                samples.append(("_count", labels, histogram.count))
+            family("%s_seconds" % phase, "summary",
+                   "Time spent in %s." % (
+                       "the whole call" if phase == "latency" else phase),
+                   samples)
+        return "\n".join(lines) + "\n"
+
+
+def _labels(key):
+    side, name = key
+    return [("side", side), ("method", name)]
+
+
+def _code_name(code):
+    if code == LOCAL_ERROR:
+        return "local"
+    for name, value in vars(RpcErrors).items():
+        if value == code and name.isupper():
+            return name
+    return str(code)
+
+
+def _format(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
@@ -0,0 +1,251 @@
+"""Pre-forked multi-process serving for the gevent backend.
+
+A Supervisor forks ``workers`` processes that each run a GeventTCPServer
+on the same address, so a service can use every core instead of one::
+
+    Supervisor(("0.0.0.0", 8080), [TestService(), MathService()],
+               workers=4).serve_forever()
+
+Workers either accept on one listening socket created by the supervisor
+before forking, or, with ``reuse_port``, each bind their own socket with
+SO_REUSEPORT and let the kernel balance connections between them.
+Workers that die are restarted; SIGTERM or SIGINT makes every worker stop
+accepting and finish in-flight requests for up to ``drain_timeout``
+seconds before the supervisor exits. Each worker reports its server stats
+to the supervisor every ``stats_interval`` seconds, see Supervisor.stats.
+"""
+
+import errno
+import json
+import os
+import select
+import signal
+import socket
+import time
+import traceback
+
+__all__ = ["Supervisor"]
+
+# Linux value, for Pythons whose socket module does not define it.
+SO_REUSEPORT = getattr(socket, "SO_REUSEPORT", 15)
+
+
+class Supervisor(object):
+    # Minimum delay between two restarts of a crashing worker slot.
+    restart_delay = 1.0
+
+    def __init__(self, addr, services, workers=None, reuse_port=False,
+                 backlog=1024, drain_timeout=10.0, stats_interval=1.0,
+                 **server_options):
+        """
+        :param services: passed to GeventTCPServer in every worker
+        :param server_options: further GeventTCPServer keyword arguments
+        """
+        if workers is None:
+            import multiprocessing
+            workers = multiprocessing.cpu_count()
+        if reuse_port and not addr[1]:
+            raise ValueError("reuse_port needs an explicit port")
+        self.addr = addr
+        self.services = services
+        self.workers = workers
+        self.reuse_port = reuse_port
+        self.backlog = backlog
+        self.drain_timeout = drain_timeout
+        self.stats_interval = stats_interval
+        self.server_options = server_options
+        self._listener = None
+        self._children = {}
+        """:type _children: dict[int, (int, float)] pid -> stats pipe, start"""
+        self._buffers = {}
+        self._stats = {}
+        # Counters of the workers that have exited, still part of the totals.
+        self._retired = {}
+        self._stopping = False
+
+    def listen(self, reuse_port=False):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        sock.bind(self.addr)
+        sock.listen(self.backlog)
+        return sock
+
+    def serve_forever(self):
+        if not self.reuse_port:
+            self._listener = self.listen()
+            self.addr = self._listener.getsockname()
+        signal.signal(signal.SIGTERM, self._request_stop)
+        signal.signal(signal.SIGINT, self._request_stop)
+        try:
+            for _ in range(self.workers):
+                self._spawn()
+            self._supervise()
+        finally:
+            self._shutdown()
+
+    def stop(self):
+        self._stopping = True
+
+    def stats(self):
+        """
+        Server stats summed over the workers that have reported, including
+        those that have since exited, plus the latest report of each live
+        worker under "workers".
+        """
+        total = dict(self._retired)
+        total["workers"] = dict(self._stats)
+        for report in self._stats.itervalues():
+            for key, value in report.iteritems():
+                total[key] = total.get(key, 0) + value
+        return total
+
+    def _request_stop(self, signum, frame):
+        self._stopping = True
+
+    def _spawn(self):
+        stats_r, stats_w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(stats_r)
+            try:
+                self._run_worker(stats_w)
+            except BaseException:
+                traceback.print_exc()
+                os._exit(1)
+            os._exit(0)
+        os.close(stats_w)
+        self._children[pid] = (stats_r, time.time())
+        self._buffers[stats_r] = ""
+        return pid
+
+    def _run_worker(self, stats_fd):
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        import gevent
+        import gevent.socket
+        from protobufrpc.synchronous import GeventTCPServer
+        gevent.reinit()
+
+        if self.reuse_port:
+            listener = self.listen(reuse_port=True)
+        else:
+            listener = self._listener
+        listener = gevent.socket.socket(_sock=listener._sock)
+        server = GeventTCPServer(listener, self.services,
+                                 **self.server_options)
+
+        def report():
+            line = json.dumps(server.stats) + "\n"
+            try:
+                os.write(stats_fd, line)
+            except OSError:
+                pass
+
+        def reporter():
+            while True:
+                gevent.sleep(self.stats_interval)
+                report()
+
+        gevent.signal(signal.SIGTERM, server.drain, self.drain_timeout)
+        reporting = gevent.spawn(reporter)
+        server.serve_forever()
+        reporting.kill()
+        report()
+
+    def _supervise(self):
+        restarts = []
+        while not self._stopping:
+            self._read_stats(self.stats_interval)
+            for pid, started in self._reap():
+                # Back off a worker that dies right after starting, so a
+                # broken service does not fork in a tight loop.
+                restarts.append(max(time.time(),
+                                    started + self.restart_delay))
+            now = time.time()
+            while restarts and not self._stopping and min(restarts) <= now:
+                restarts.remove(min(restarts))
+                self._spawn()
+
+    def _read_stats(self, timeout):
+        fds = [fd for fd, _ in self._children.itervalues()]
+        try:
+            readable = select.select(fds, [], [], timeout)[0] if fds else []
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return
+        if not fds:
+            time.sleep(timeout)
+        for fd in readable:
+            self._read_report(fd, self._pid_for(fd))
+
+    def _read_report(self, fd, pid):
+        try:
+            data = os.read(fd, 65536)
+        except OSError:
+            return
+        lines = (self._buffers.get(fd, "") + data).split("\n")
+        self._buffers[fd] = lines.pop()
+        if lines and pid is not None:
+            self._stats[pid] = json.loads(lines[-1])
+
+    def _pid_for(self, fd):
+        for pid, (stats_fd, _) in self._children.iteritems():
+            if stats_fd == fd:
+                return pid
+        return None
+
+    def _reap(self, block=False):
+        """Collect exited workers, returning (pid, start time) pairs."""
+        reaped = []
+        while self._children:
+            try:
+                pid, _ = os.waitpid(-1, 0 if block else os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                break
+            if not pid:
+                break
+            child = self._children.pop(pid, None)
+            if child is None:
+                continue
+            fd, started = child
+            # The final report the worker wrote before exiting.
+            if select.select([fd], [], [], 0)[0]:
+                self._read_report(fd, pid)
+            os.close(fd)
+            del self._buffers[fd]
+            self._retire(self._stats.pop(pid, {}))
+            reaped.append((pid, started))
+            if block:
+                break
+        return reaped
+
+    def _retire(self, report):
+        for key, value in report.iteritems():
+            # Its connections closed with it.
+            if key != "active":
+                self._retired[key] = self._retired.get(key, 0) + value
+
+    def _shutdown(self):
+        for pid in list(self._children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        deadline = time.time() + self.drain_timeout + 1
+        while self._children and time.time() < deadline:
+            if not self._reap():
+                time.sleep(0.05)
+        for pid in list(self._children):
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+        while self._children:
+            self._reap(block=True)
+        if self._listener is not None:
+            self._listener.close()
@@ -17,7 +17,7 @@ DESCRIPTOR = _descriptor.FileDescriptor(
     name='protobufrpc.proto',
     package='',
     serialized_pb=_b(
-        '\n\x11protobufrpc.proto\"=\n\x03Rpc\x12\x19\n\x07request\x18\x01 \x03(\x0b\x32\x08.Request\x12\x1b\n\x08response\x18\x02 \x03(\x0b\x32\t.Response\"A\n\x07Request\x12\x0e\n\x06method\x18\x01 \x02(\t\x12\x1a\n\x12serialized_request\x18\x02 \x01(\x0c\x12\n\n\x02id\x18\x03 \x01(\r\"#\n\x05\x45rror\x12\x0c\n\x04\x63ode\x18\x01 \x02(\x11\x12\x0c\n\x04text\x18\x02 \x01(\t\"J\n\x08Response\x12\x1b\n\x13serialized_response\x18\x01 \x01(\x0c\x12\x15\n\x05\x65rror\x18\x02 \x01(\x0b\x32\x06.Error\x12\n\n\x02id\x18\x03 \x02(\r'))
+        '\n\x11protobufrpc.proto\"=\n\x03Rpc\x12\x19\n\x07request\x18\x01 \x03(\x0b\x32\x08.Request\x12\x1b\n\x08response\x18\x02 \x03(\x0b\x32\t.Response\"\xfb\x01\n\x07Request\x12\x0e\n\x06method\x18\x01 \x01(\t\x12\x1a\n\x12serialized_request\x18\x02 \x01(\x0c\x12\n\n\x02id\x18\x03 \x01(\r\x12\x11\n\tmethod_id\x18\x04 \x01(\r\x12\x12\n\ntimeout_ms\x18\x05 \x01(\r\x12\x13\n\x0b\x63ompression\x18\x06 \x01(\r\x12\x1a\n\x12\x61\x63\x63\x65pt_compression\x18\x07 \x01(\r\x12\x10\n\x08trace_id\x18\x08 \x01(\x0c\x12\x16\n\x0eparent_span_id\x18\t \x01(\x04\x12\x0f\n\x07sampled\x18\n \x01(\x08\x12\x15\n\rend_of_stream\x18\x0b \x01(\x08\x12\x0e\n\x06window\x18\x0c \x01(\r\"#\n\x05\x45rror\x12\x0c\n\x04\x63ode\x18\x01 \x02(\x11\x12\x0c\n\x04text\x18\x02 \x01(\t\"\xc6\x01\n\x08Response\x12\x1b\n\x13serialized_response\x18\x01 \x01(\x0c\x12\x15\n\x05\x65rror\x18\x02 \x01(\x0b\x32\x06.Error\x12\n\n\x02id\x18\x03 \x02(\r\x12\x11\n\tmethod_id\x18\x04 \x01(\r\x12\x13\n\x0b\x63ompression\x18\x05 \x01(\r\x12\x1a\n\x12\x61\x63\x63\x65pt_compression\x18\x06 \x01(\r\x12\x0f\n\x07span_id\x18\x07 \x01(\x04\x12\x15\n\rend_of_stream\x18\x08 \x01(\x08\x12\x0e\n\x06window\x18\t \x01(\r'))
 _sym_db.RegisterFileDescriptor(DESCRIPTOR)
 
 _RPC = _descriptor.Descriptor(
@@ -78,7 +78,7 @@ _REQUEST = _descriptor.Descriptor(
                                         number=1,
                                         type=9,
                                         cpp_type=9,
-                                        label=2,
+                                        label=1,
                                         has_default_value=False,
                                         default_value=_b("").decode('utf-8'),
                                         message_type=None,
@@ -116,6 +116,141 @@ _REQUEST = _descriptor.Descriptor(
                                         containing_type=None,
                                         is_extension=False,
                                         extension_scope=None,
+                                        options=None),
+            _descriptor.FieldDescriptor(name='method_id',
+                                        full_name='Request.method_id',
+                                        index=3,
+                                        number=4,
+                                        type=13,
+                                        cpp_type=3,
+                                        label=1,
+                                        has_default_value=False,
+                                        default_value=0,
+                                        message_type=None,
+                                        enum_type=None,
+                                        containing_type=None,
+                                        is_extension=False,
+                                        extension_scope=None,
+                                        options=None),
+            _descriptor.FieldDescriptor(name='timeout_ms',
+                                        full_name='Request.timeout_ms',
+                                        index=4,
+                                        number=5,
+                                        type=13,
+                                        cpp_type=3,
+                                        label=1,
+                                        has_default_value=False,
+                                        default_value=0,
+                                        message_type=None,
+                                        enum_type=None,
+                                        containing_type=None,
+                                        is_extension=False,
+                                        extension_scope=None,
+                                        options=None),
+            _descriptor.FieldDescriptor(name='compression',
+                                        full_name='Request.compression',
+                                        index=5,
+                                        number=6,
+                                        type=13,
+                                        cpp_type=3,
+                                        label=1,
+                                        has_default_value=False,
+                                        default_value=0,
+                                        message_type=None,
+                                        enum_type=None,
+                                        containing_type=None,
+                                        is_extension=False,
+                                        extension_scope=None,
+                                        options=None),
+            _descriptor.FieldDescriptor(name='accept_compression',
+                                        full_name='Request.accept_compression',
+                                        index=6,
+                                        number=7,
+                                        type=13,
+                                        cpp_type=3,
+                                        label=1,
+                                        has_default_value=False,
+                                        default_value=0,
+                                        message_type=None,
+                                        enum_type=None,
+                                        containing_type=None,
+                                        is_extension=False,
+                                        extension_scope=None,
+                                        options=None),
+            _descriptor.FieldDescriptor(name='trace_id',
+                                        full_name='Request.trace_id',
+                                        index=7,
+                                        number=8,
+                                        type=12,
+                                        cpp_type=9,
+                                        label=1,
+                                        has_default_value=False,
+                                        default_value=_b(""),
+                                        message_type=None,
+                                        enum_type=None,
+                                        containing_type=None,
+                                        is_extension=False,
+                                        extension_scope=None,
+                                        options=None),
+            _descriptor.FieldDescriptor(name='parent_span_id',
+                                        full_name='Request.parent_span_id',
+                                        index=8,
+                                        number=9,
+                                        type=4,
+                                        cpp_type=4,
+                                        label=1,
+                                        has_default_value=False,
+                                        default_value=0,
+                                        message_type=None,
+                                        enum_type=None,
+                                        containing_type=None,
+                                        is_extension=False,
+                                        extension_scope=None,
+                                        options=None),
+            _descriptor.FieldDescriptor(name='sampled',
+                                        full_name='Request.sampled',
+                                        index=9,
+                                        number=10,
+                                        type=8,
+                                        cpp_type=7,
+                                        label=1,
+                                        has_default_value=False,
+                                        default_value=False,
+                                        message_type=None,
+                                        enum_type=None,
+                                        containing_type=None,
+                                        is_extension=False,
+                                        extension_scope=None,
+                                        options=None),
+            _descriptor.FieldDescriptor(name='end_of_stream',
+                                        full_name='Request.end_of_stream',
+                                        index=10,
+                                        number=11,
+                                        type=8,
+                                        cpp_type=7,
+                                        label=1,
+                                        has_default_value=False,
+                                        default_value=False,
+                                        message_type=None,
+                                        enum_type=None,
+                                        containing_type=None,
+                                        is_extension=False,
+                                        extension_scope=None,
+                                        options=None),
+            _descriptor.FieldDescriptor(name='window',
+                                        full_name='Request.window',
+                                        index=11,
+                                        number=12,
+                                        type=13,
+                                        cpp_type=3,
+                                        label=1,
+                                        has_default_value=False,
+                                        default_value=0,
+                                        message_type=None,
+                                        enum_type=None,
+                                        containing_type=None,
+                                        is_extension=False,
+                                        extension_scope=None,
                                         options=None),],
     extensions=[],
     nested_types=[],
@@ -124,8 +259,8 @@ _REQUEST = _descriptor.Descriptor(
     is_extendable=False,
     extension_ranges=[],
     oneofs=[],
-    serialized_start=84,
-    serialized_end=149,)
+    serialized_start=85,
+    serialized_end=336,)
 
 _ERROR = _descriptor.Descriptor(
     name='Error',
@@ -170,8 +305,8 @@ _ERROR = _descriptor.Descriptor(
     is_extendable=False,
     extension_ranges=[],
     oneofs=[],
-    serialized_start=151,
-    serialized_end=186,)
+    serialized_start=338,
+    serialized_end=373,)
 
 _RESPONSE = _descriptor.Descriptor(
     name='Response',
@@ -225,6 +360,96 @@ _RESPONSE = _descriptor.Descriptor(
                                     is_extension=False,
                                     extension_scope=None,
                                     options=None),
+        _descriptor.FieldDescriptor(name='method_id',
+                                    full_name='Response.method_id',
+                                    index=3,
+                                    number=4,
+                                    type=13,
+                                    cpp_type=3,
+                                    label=1,
+                                    has_default_value=False,
+                                    default_value=0,
+                                    message_type=None,
+                                    enum_type=None,
+                                    containing_type=None,
+                                    is_extension=False,
+                                    extension_scope=None,
+                                    options=None),
+        _descriptor.FieldDescriptor(name='compression',
+                                    full_name='Response.compression',
+                                    index=4,
+                                    number=5,
+                                    type=13,
+                                    cpp_type=3,
+                                    label=1,
+                                    has_default_value=False,
+                                    default_value=0,
+                                    message_type=None,
+                                    enum_type=None,
+                                    containing_type=None,
+                                    is_extension=False,
+                                    extension_scope=None,
+                                    options=None),
+        _descriptor.FieldDescriptor(name='accept_compression',
+                                    full_name='Response.accept_compression',
+                                    index=5,
+                                    number=6,
+                                    type=13,
+                                    cpp_type=3,
+                                    label=1,
+                                    has_default_value=False,
+                                    default_value=0,
+                                    message_type=None,
+                                    enum_type=None,
+                                    containing_type=None,
+                                    is_extension=False,
+                                    extension_scope=None,
+                                    options=None),
+        _descriptor.FieldDescriptor(name='span_id',
+                                    full_name='Response.span_id',
+                                    index=6,
+                                    number=7,
+                                    type=4,
+                                    cpp_type=4,
+                                    label=1,
+                                    has_default_value=False,
+                                    default_value=0,
+                                    message_type=None,
+                                    enum_type=None,
+                                    containing_type=None,
+                                    is_extension=False,
+                                    extension_scope=None,
+                                    options=None),
+        _descriptor.FieldDescriptor(name='end_of_stream',
+                                    full_name='Response.end_of_stream',
+                                    index=7,
+                                    number=8,
+                                    type=8,
+                                    cpp_type=7,
+                                    label=1,
+                                    has_default_value=False,
+                                    default_value=False,
+                                    message_type=None,
+                                    enum_type=None,
+                                    containing_type=None,
+                                    is_extension=False,
+                                    extension_scope=None,
+                                    options=None),
+        _descriptor.FieldDescriptor(name='window',
+                                    full_name='Response.window',
+                                    index=8,
+                                    number=9,
+                                    type=13,
+                                    cpp_type=3,
+                                    label=1,
+                                    has_default_value=False,
+                                    default_value=0,
+                                    message_type=None,
+                                    enum_type=None,
+                                    containing_type=None,
+                                    is_extension=False,
+                                    extension_scope=None,
+                                    options=None),
     ],
     extensions=[],
     nested_types=[],
@@ -233,8 +458,8 @@ _RESPONSE = _descriptor.Descriptor(
     is_extendable=False,
     extension_ranges=[],
     oneofs=[],
-    serialized_start=188,
-    serialized_end=262,)
+    serialized_start=376,
+    serialized_end=574,)
 
 _RPC.fields_by_name['request'].message_type = _REQUEST
 _RPC.fields_by_name['response'].message_type = _RESPONSE
@@ -0,0 +1,99 @@
+"""Streaming methods.
+
+A unary method answers its request with a single response. A
+server-streaming method answers it with any number of responses, yielded
+by the handler as a generator::
+
+    class Store(StoreService):
+        @server_streaming
+        def List(self, controller, request, done):
+            for item in self.items(request.prefix):
+                yield Item(name=item)
+
+On tx channels the generator may also yield Deferreds, firing with the
+next response, to produce them asynchronously.
+
+A client-streaming method reads any number of requests before answering
+with one response, through ``done`` as usual::
+
+    class Store(StoreService):
+        @client_streaming
+        def Upload(self, controller, requests, done):
+            # synchronous servers: requests is an iterator
+            size = sum(len(chunk.data) for chunk in requests)
+            done(Stored(size=size))
+
+On tx channels ``requests`` is a tx.RequestStream instead, whose ``get()``
+returns a Deferred firing with the next request, or None at the end.
+
+Clients name the methods that stream, and how, to their Proxy::
+
+    proxy = Proxy(Store_Stub(channel),
+                  streaming={"Store.List": SERVER, "Store.Upload": CLIENT})
+    for item in proxy.Store.List(request):   # tx: a tx.ResponseStream
+        ...
+    stored = proxy.Store.Upload(chunks)      # an iterable of requests
+
+On the wire every message of a stream shares the id of its call. The
+responses of a server stream are Responses with a payload each, followed by
+one with ``end_of_stream`` set; a Request with ``end_of_stream`` set from
+the client cancels the stream. The requests of a client stream follow the
+one naming the method, each carrying a message, then one with
+``end_of_stream`` set. An error response ends either kind of stream.
+
+Streams are flow controlled: the receiving side grants credit, in messages,
+with the ``window`` field, and the sending side never has more messages in
+flight than it was granted. A server stream starts with the credit in the
+``window`` of its request, a client stream with INITIAL_WINDOW; receivers
+grant more as they consume messages (see ReceiveWindow), so a slow
+consumer holds its producer back instead of buffering the whole stream.
+
+Streams need a connection (tx.TcpChannel, the synchronous TcpChannel and
+GeventTCPServer). Their messages are not compressed, cached or offloaded.
+"""
+
+__all__ = ["SERVER", "CLIENT", "INITIAL_WINDOW", "server_streaming",
+           "client_streaming", "ReceiveWindow"]
+
+# How a method streams
+SERVER = "server"
+CLIENT = "client"
+
+# Messages a stream may send before the receiver grants more credit.
+INITIAL_WINDOW = 16
+
+
+def server_streaming(func):
+    """Decorator for methods answering with a generator of responses."""
+    func.streaming = SERVER
+    return func
+
+
+def client_streaming(func):
+    """Decorator for methods reading a stream of requests."""
+    func.streaming = CLIENT
+    return func
+
+
+class ReceiveWindow(object):
+    """
+    The credit the receiver of a stream grants back as it consumes
+    messages: once half of a window of ``size`` messages is consumed, so
+    that the sender need not wait for credit while the rest is in flight.
+    """
+
+    def __init__(self, size=INITIAL_WINDOW):
+        self.size = size
+        self._consumed = 0
+
+    def consumed(self):
+        """
+        Count one more message consumed.
+
+        :return: the credit to grant the sender now, or 0
+        """
+        self._consumed += 1
+        if self._consumed * 2 < self.size:
+            return 0
+        credit, self._consumed = self._consumed, 0
+        return credit
@@ -20,12 +20,29 @@
 
 import socket
 import google.protobuf.service
-from protobufrpc.common import Controller
-from protobufrpc.protobufrpc_pb2 import Rpc, Request, Response, Error
-import struct
+from google.protobuf.message import DecodeError
+from protobufrpc.common import INLINE, PROCESS, Controller, MethodIds, \
+    PendingCalls, ResponseCoalescer, RPCException, RpcErrors, TimerWheel, \
+    acknowledge_method_id, call_in_worker, \
+    call_method, dispatch_error, expired, index_service, lookup_method, \
+    process_pool, request_deadline, serves_streams, set_timeout, \
+    unless_expired
+from protobufrpc.cache import caches_method, copy_message
+from protobufrpc.compression import decompress, decompress_request, \
+    decompression_limit, fill_request, fill_response, method_compression
+from protobufrpc.envelope import ErrorRecord, ResponseRecord, decode_rpc
+from protobufrpc.framing import FrameReader, FrameTooLarge, write_frame
+from protobufrpc.metrics import CLIENT, LOCAL_ERROR, SERVER
+from protobufrpc.streaming import INITIAL_WINDOW, ReceiveWindow
+from protobufrpc import streaming
+from protobufrpc.tracing import activate, current, extract, inject
+from protobufrpc.protobufrpc_pb2 import Rpc
+import time
 import SocketServer
 from gevent.server import StreamServer
 from gevent.lock import Semaphore
+from gevent.event import AsyncResult, Event
+from gevent.queue import Empty, Queue
 import gevent
 
 #import gevent.monkey
@@ -34,111 +51,696 @@ import gevent
 #else:
 #    import SocketServer
 
-__all__ = ["TcpChannel", "TcpServer", "Proxy"]
+__all__ = ["TcpChannel", "TcpChannelPool", "TcpServer", "Proxy"]
 
 
-class RPCException(Exception):
-    pass
+class ResponseStream(object):
+    """
+    The responses of a server-streaming call, as an iterator; see the
+    streaming module. Closing it before the end cancels the call.
+    """
 
+    def __init__(self, channel, _id, responseClass, rpcController,
+                 window=INITIAL_WINDOW):
+        self._channel = channel
+        self._id = _id
+        self._responseClass = responseClass
+        self._controller = rpcController
+        self._window = ReceiveWindow(window)
+        self._responses = Queue()
+        self._done = False
 
-class RpcErrors:
-    SUCCESS = 0
-    UNSERIALIZE_RPC = 1
-    SERVICE_NOT_FOUND = 2
-    METHOD_NOT_FOUND = 3
-    CANNOT_DESERIALIZE_REQUEST = 4
-    METHOD_ERROR = 5
+    def received(self, serializedResponse):
+        self._responses.put(serializedResponse)
 
-    msgs = ['Success', 'Error when unserializing Rpc message',
-            'Service not found', 'Method not found',
-            'Cannot deserialized request', 'Method Error']
+    def failed(self, exception):
+        self._responses.put(exception)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._done:
+            raise StopIteration
+        try:
+            serializedResponse = self._responses.get(
+                timeout=self._controller.TimeRemaining())
+        except Empty:
+            self.close()
+            raise RPCException(RpcErrors.msgs[RpcErrors.DEADLINE_EXCEEDED])
+        if isinstance(serializedResponse, Exception):
+            self._finish()
+            raise serializedResponse
+        if serializedResponse.HasField('error'):
+            self._finish()
+            raise RPCException(serializedResponse.error.text)
+        if serializedResponse.end_of_stream:
+            self._finish()
+            raise StopIteration
+        credit = self._window.consumed()
+        if credit:
+            self._channel.send_stream_message(self._id, window=credit)
+        return self._channel.unserialize_response(serializedResponse,
+                                                  self._responseClass)
+
+    __next__ = next
+
+    def close(self):
+        """Cancel the call, unless it is over."""
+        if self._done:
+            return
+        self._finish()
+        # Wakes up a reader waiting for the next response.
+        self._responses.put(RPCException("Cancelled"))
+        try:
+            self._channel.send_stream_message(self._id, end_of_stream=True)
+        except (RPCException, socket.error):
+            pass
+
+    def _finish(self):
+        self._done = True
+        self._channel._streams.pop(self._id, None)
+
+
+class _Upload(object):
+    """A client-streaming call: the credit granted for its requests."""
+
+    def __init__(self):
+        self.credit = INITIAL_WINDOW
+        self.granted = Event()
+        self.result = AsyncResult()
+
+    def received(self, serializedResponse):
+        if serializedResponse.HasField('serialized_response') or \
+                serializedResponse.HasField('error'):
+            self.result.set(serializedResponse)
+        else:
+            self.credit += serializedResponse.window
+        self.granted.set()
+
+    def failed(self, exception):
+        if not self.result.ready():
+            self.result.set_exception(exception)
+        self.granted.set()
 
 
 class TcpChannel(google.protobuf.service.RpcChannel):
+    """Multiplexed client channel.
+
+    Any number of greenlets may call methods on the same channel
+    concurrently: requests are written as they come and a single reader
+    greenlet dispatches every incoming response to its caller by id.
+
+    With ``batch_window`` set (in seconds, ``0`` meaning the next turn of
+    the event loop) requests are not written immediately but coalesced into
+    one ``Rpc`` frame, which is sent when the window elapses or once it
+    holds ``batch_size`` requests.
+
+    With ``method_ids`` set, methods are named by a small integer bound on
+    the connection instead of their full name once the server agrees.
+
+    A call whose controller has a deadline (Controller.SetTimeout) fails
+    once it passes, as does one whose controller is cancelled.
+
+    With ``max_in_flight`` set, callers beyond that many outstanding calls
+    block until one completes (or their deadline passes).
+
+    ``compression``, a compression.Compression, enables compressing
+    requests and accepting compressed responses.
+
+    ``metrics``, a metrics.Registry, records every call made.
+    """
     id = 0
 
-    def __init__(self, addr):
+    def __init__(self, addr, batch_window=None, batch_size=64,
+                 method_ids=False, max_in_flight=None, compression=None,
+                 metrics=None):
         google.protobuf.service.RpcChannel.__init__(self)
-        self._pending = {}
+        self.batch_window = batch_window
+        self.batch_size = batch_size
+        self.method_ids = method_ids
+        self.compression = compression
+        self.metrics = metrics
+        self._method_ids = None
+        self._peer_accepts = 0
+        self._pending = PendingCalls()
+        self._streams = {}
+        self._slots = Semaphore(max_in_flight) if max_in_flight else None
+        self._waiting = 0
+        self._batch = Rpc()
+        self._flusher = None
+        self._timers = TimerWheel()
+        self._expirer = None
         self._tcpSocket = None
-        self.connect(addr)
+        self._reader = None
         self._wlock = Semaphore()
-        self._rlock = Semaphore()
+        self.connect(addr)
 
     def connect(self, addr):
         self._tcpSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._tcpSocket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         self._tcpSocket.connect(addr)
+        self._peer_accepts = 0
+        if self.method_ids:
+            self._method_ids = MethodIds()
+        self._reader = gevent.spawn(self._read_loop)
 
-    def send_string(self, buffer):
-        networkOrderBufferLen = struct.pack("!I", len(buffer))
+    def close(self):
+        if self._flusher is not None:
+            self._flusher.kill(block=False)
+            self._flusher = None
+        if self._reader is not None:
+            self._reader.kill(block=False)
+            self._reader = None
+        if self._expirer is not None:
+            self._expirer.kill(block=False)
+            self._expirer = None
+        if self._tcpSocket is not None:
+            self._tcpSocket.close()
+        self._fail_pending(RPCException("channel closed"))
+
+    @property
+    def connected(self):
+        return self._reader is not None
 
-        buffer = networkOrderBufferLen + buffer
+    @property
+    def in_flight(self):
+        return len(self._pending)
+
+    def pending_stats(self):
+        """Size and age histogram of the calls waiting for a response."""
+        stats = self._pending.stats()
+        stats["waiting"] = self._waiting
+        return stats
+
+    def send_string(self, buffer):
         with self._wlock:
-            sent = self._tcpSocket.sendall(buffer)
-        if sent == 0:
-            raise RPCException("socket connection broken")
+            write_frame(self._tcpSocket, buffer)
+
+    def _read_loop(self):
+        sock = self._tcpSocket
+        reason = RPCException("connection closed by peer")
+        reader = FrameReader()
+        try:
+            while reader.read(sock, self.string_received):
+                pass
+        except (socket.error, FrameTooLarge, DecodeError) as e:
+            reason = RPCException("connection error: %s" % e)
+        except gevent.GreenletExit:
+            # killed by close(), which cleans up itself
+            return
+        except Exception as e:
+            reason = RPCException("reader failed: %s" % e)
+            raise
+        finally:
+            # Whatever ended the loop, nothing more will be read: the
+            # connection is unusable and the calls waiting on it are lost.
+            if self._reader is gevent.getcurrent():
+                self._reader = None
+                sock.close()
+                self._fail_pending(reason)
+
+    def _fail_pending(self, exception):
+        self._timers = TimerWheel()
+        for result in self._pending.clear():
+            result.set_exception(exception)
+        streams, self._streams = self._streams, {}
+        for stream in streams.values():
+            stream.failed(exception)
+
+    def _fail_call(self, _id, exception):
+        self._timers.cancel(_id)
+        result = self._pending.pop(_id)
+        if result is not None:
+            result.set_exception(exception)
+
+    def _expire_loop(self):
+        try:
+            while self._timers:
+                gevent.sleep(self._timers.resolution)
+                for _id in self._timers.expire():
+                    self._fail_call(_id, RPCException(
+                        RpcErrors.msgs[RpcErrors.DEADLINE_EXCEEDED]))
+        finally:
+            self._expirer = None
 
     def CallMethod(self, methodDescriptor, rpcController, request,
                    responseClass,
                    done=None):
+        call = None
+        if self.metrics is not None:
+            call = self.metrics.start(
+                CLIENT, methodDescriptor.containing_service.name + '.' +
+                methodDescriptor.name)
+        try:
+            error = self._acquire_and_call(methodDescriptor, rpcController,
+                                           request, responseClass, done,
+                                           call)
+        except:
+            if call is not None:
+                call.finish(LOCAL_ERROR)
+            raise
+        if call is not None:
+            call.finish(error)
+
+    def _acquire_and_call(self, methodDescriptor, rpcController, request,
+                          responseClass, done, call):
+        if self._slots is None:
+            return self._call_method(methodDescriptor, rpcController,
+                                     request, responseClass, done, call)
+
+        self._waiting += 1
+        try:
+            acquired = self._slots.acquire(
+                timeout=rpcController.TimeRemaining())
+        finally:
+            self._waiting -= 1
+        if not acquired:
+            rpcController.SetFailed(
+                RpcErrors.msgs[RpcErrors.DEADLINE_EXCEEDED])
+            return RpcErrors.DEADLINE_EXCEEDED
+        if call is not None:
+            call.lap("queue")
+        try:
+            return self._call_method(methodDescriptor, rpcController,
+                                     request, responseClass, done, call)
+        finally:
+            self._slots.release()
+
+    def _call_method(self, methodDescriptor, rpcController, request,
+                     responseClass, done, call=None):
+        """
+        :return: the RpcErrors code the call failed with, LOCAL_ERROR if it
+            failed on this side, or None
+        """
+        if self._reader is None:
+            rpcController.SetFailed("channel is not connected")
+            return LOCAL_ERROR
+
+        if rpcController.IsCancelled():
+            rpcController.SetFailed("Cancelled")
+            return LOCAL_ERROR
+
         self.id += 1
-        self._pending[self.id] = (responseClass, done)
+        _id = self.id
+
+        if self.batch_window is None:
+            rpc = Rpc()
+            rpcRequest = rpc.request.add()
+        else:
+            rpc = None
+            rpcRequest = self._batch.request.add()
+        methodName = methodDescriptor.containing_service.name + '.' + methodDescriptor.name
+        if self._method_ids is not None:
+            self._method_ids.fill(rpcRequest, methodName)
+        else:
+            rpcRequest.method = methodName
+        fill_request(self.compression, rpcRequest, methodName,
+                     request.SerializeToString(), self._peer_accepts)
+        rpcRequest.id = _id
+        inject(rpcRequest, rpcController.trace or current())
+        if not set_timeout(rpcRequest, rpcController):
+            if rpc is None:
+                del self._batch.request[-1]
+            rpcController.SetFailed(
+                RpcErrors.msgs[RpcErrors.DEADLINE_EXCEEDED])
+            return RpcErrors.DEADLINE_EXCEEDED
+        if call is not None:
+            call.lap("serialize")
+            call.sent(len(rpcRequest.serialized_request))
+
+        result = AsyncResult()
+        self._pending.add(_id, result)
+        if rpcController.deadline is not None:
+            self._timers.add(_id, rpcController.deadline)
+            if self._expirer is None:
+                self._expirer = gevent.spawn(self._expire_loop)
+        rpcController.NotifyOnCancel(
+            lambda: self._fail_call(_id, RPCException("Cancelled")))
+        try:
+            if rpc is not None:
+                self.send_string(rpc.SerializeToString())
+            elif len(self._batch.request) >= self.batch_size:
+                self.flush()
+            elif self._flusher is None:
+                self._flusher = gevent.spawn_later(self.batch_window,
+                                                   self.flush)
+            serializedResponse = result.get()
+        except (RPCException, socket.error) as e:
+            self._fail_call(_id, e)
+            rpcController.SetFailed(str(e))
+            if expired(rpcController.deadline):
+                return RpcErrors.DEADLINE_EXCEEDED
+            return LOCAL_ERROR
+
+        if serializedResponse.HasField('error'):
+            rpcController.SetFailed(serializedResponse.error.text)
+            return serializedResponse.error.code
+
+        if call is not None:
+            call.mark()
+            call.received(len(serializedResponse.serialized_response))
+        response = self.unserialize_response(serializedResponse, responseClass)
+        if call is not None:
+            call.lap("deserialize")
+        if done is not None:
+            done(response)
+
+    def flush(self):
+        """Send the requests coalesced so far in a single frame."""
+        flusher, self._flusher = self._flusher, None
+        if flusher is not None and flusher is not gevent.getcurrent():
+            flusher.kill(block=False)
 
+        rpc, self._batch = self._batch, Rpc()
+        if not rpc.request:
+            return
+        try:
+            self.send_string(rpc.SerializeToString())
+        except (RPCException, socket.error) as e:
+            for rpcRequest in rpc.request:
+                result = self._pending.pop(rpcRequest.id)
+                if result is not None:
+                    result.set_exception(RPCException(str(e)))
+
+    def string_received(self, data):
+        _, responses = decode_rpc(data)
+        for serializedResponse in responses:
+            if serializedResponse.method_id and self._method_ids is not None:
+                self._method_ids.acknowledged(serializedResponse.method_id)
+            if serializedResponse.accept_compression:
+                self._peer_accepts = serializedResponse.accept_compression
+            stream = self._streams.get(serializedResponse.id)
+            if stream is not None:
+                stream.received(serializedResponse)
+                continue
+            result = self._pending.pop(serializedResponse.id)
+            if result is not None:
+                self._timers.cancel(serializedResponse.id)
+                result.set(serializedResponse)
+
+    def _open_stream(self, methodDescriptor, rpcController):
+        """
+        The Rpc frame opening a stream, and the stream's id.
+
+        :raises RPCException: if the call cannot be made
+        """
+        if self._reader is None:
+            raise RPCException("channel is not connected")
+        if rpcController.IsCancelled():
+            raise RPCException("Cancelled")
+        self.id += 1
         rpc = Rpc()
         rpcRequest = rpc.request.add()
-        rpcRequest.method = methodDescriptor.containing_service.name + '.' + methodDescriptor.name
-        rpcRequest.serialized_request = request.SerializeToString()
+        methodName = methodDescriptor.containing_service.name + '.' + \
+            methodDescriptor.name
+        if self._method_ids is not None:
+            self._method_ids.fill(rpcRequest, methodName)
+        else:
+            rpcRequest.method = methodName
         rpcRequest.id = self.id
-        self.send_string(rpc.SerializeToString())
+        inject(rpcRequest, rpcController.trace or current())
+        if not set_timeout(rpcRequest, rpcController):
+            raise RPCException(RpcErrors.msgs[RpcErrors.DEADLINE_EXCEEDED])
+        return rpc, self.id
+
+    def call_stream(self, methodDescriptor, rpcController, request,
+                    responseClass, window=INITIAL_WINDOW):
+        """
+        Call a server-streaming method.
 
-        with self._rlock:
-            buffer = self._tcpSocket.recv(struct.calcsize("!I"))
-            bufferLen = int(struct.unpack("!I", buffer)[0])
-            buffer = self._tcpSocket.recv(bufferLen)
+        :param int window: responses the server may send ahead of those
+            read
+        :rtype: ResponseStream
+        :raises RPCException: if the call cannot be made
+        """
+        rpc, _id = self._open_stream(methodDescriptor, rpcController)
+        rpc.request[0].serialized_request = request.SerializeToString()
+        rpc.request[0].window = window
+        stream = self._streams[_id] = ResponseStream(
+            self, _id, responseClass, rpcController, window)
+        rpcController.NotifyOnCancel(stream.close)
+        try:
+            self.send_string(rpc.SerializeToString())
+        except socket.error as e:
+            self._streams.pop(_id, None)
+            raise RPCException(str(e))
+        return stream
+
+    def call_upload(self, methodDescriptor, rpcController, requests,
+                    responseClass, done=None):
+        """
+        Call a client-streaming method with the requests ``requests``
+        iterates over, sent as the server grants credit for them, and
+        block until its response, passed to ``done``, arrives.
+        """
+        try:
+            rpc, _id = self._open_stream(methodDescriptor, rpcController)
+        except RPCException as e:
+            rpcController.SetFailed(str(e))
+            return
+        upload = self._streams[_id] = _Upload()
+        rpcController.NotifyOnCancel(
+            lambda: upload.failed(RPCException("Cancelled")))
+        try:
+            self.send_string(rpc.SerializeToString())
+            for request in requests:
+                while not upload.credit and not upload.result.ready():
+                    upload.granted.clear()
+                    if not upload.granted.wait(
+                            rpcController.TimeRemaining()):
+                        upload.failed(RPCException(
+                            RpcErrors.msgs[RpcErrors.DEADLINE_EXCEEDED]))
+                if upload.result.ready():
+                    # Answered, or failed, before the end of the requests.
+                    break
+                upload.credit -= 1
+                self.send_stream_message(
+                    _id, serialized_request=request.SerializeToString())
+            else:
+                self.send_stream_message(_id, end_of_stream=True)
+            serializedResponse = upload.result.get(
+                timeout=rpcController.TimeRemaining())
+        except gevent.Timeout:
+            rpcController.SetFailed(
+                RpcErrors.msgs[RpcErrors.DEADLINE_EXCEEDED])
+            return
+        except (RPCException, socket.error) as e:
+            rpcController.SetFailed(str(e))
+            return
+        finally:
+            self._streams.pop(_id, None)
 
-        self.string_received(buffer, rpcController)
+        if serializedResponse.HasField('error'):
+            rpcController.SetFailed(serializedResponse.error.text)
+            return
+        response = self.unserialize_response(serializedResponse, responseClass)
+        if done is not None:
+            done(response)
 
-    def string_received(self, data, rpcController):
+    def send_stream_message(self, _id, **fields):
+        """Send a Request of the stream ``_id``, with ``fields`` set."""
         rpc = Rpc()
-        rpc.ParseFromString(data)
-        for serializedResponse in rpc.response:
-            id = serializedResponse.id
-            if id in self._pending and self._pending[id] is not None:
-                if serializedResponse.HasField('error'):
-                    rpcController.SetFailed(serializedResponse.error.text)
-                    return
-
-                responseClass = self._pending[id][0]
-                done = self._pending[id][1]
-                done(self.unserialize_response(serializedResponse,
-                                               responseClass))
+        rpc.request.add(id=_id, **fields)
+        self.send_string(rpc.SerializeToString())
 
     def unserialize_response(self, serializedResponse, responseClass):
         response = responseClass()
-        response.ParseFromString(serializedResponse.serialized_response)
+        response.ParseFromString(decompress(
+            serializedResponse.serialized_response,
+            serializedResponse.compression,
+            decompression_limit(self.compression)))
         return response
 
     def serialize_response(self, response, serializedRequest):
-        serializedResponse = Response()
-        serializedResponse.id = serializedRequest.id
-        serializedResponse.serialized_response = response.SerializeToString()
-        return serializedResponse
+        return ResponseRecord(id=serializedRequest.id,
+                              serialized_response=response.SerializeToString())
 
     def serialize_rpc(self, serializedResponse):
-        rpc = Rpc()
-        rpcResponse = rpc.response.add()
-        rpcResponse.serialized_response = serializedResponse.serialized_response
-        rpcResponse.id = serializedResponse.id
-        return rpc
+        """The Rpc frame carrying ``serializedResponse`` alone."""
+        return serializedResponse.encode()
+
+
+class TcpChannelPool(google.protobuf.service.RpcChannel):
+    """A pool of multiplexed TcpChannels to a single endpoint.
+
+    Connections are opened lazily. Each call goes to the least loaded
+    channel; a new connection is opened instead while every existing one
+    already has ``busy_threshold`` calls in flight and the pool holds fewer
+    than ``max_size`` connections. Connections idle for more than
+    ``idle_timeout`` seconds are closed down to ``min_size``.
+
+    :param (TcpChannel) -> bool probe: optional liveness check run on idle
+        connections every ``probe_interval`` seconds; channels for which it
+        returns False (or raises) are dropped from the pool.
+    :param channel_options: passed on to each TcpChannel, e.g.
+        ``method_ids=True``
+    """
+
+    def __init__(self, addr, min_size=0, max_size=4, busy_threshold=1,
+                 idle_timeout=60.0, probe=None, probe_interval=30.0,
+                 **channel_options):
+        google.protobuf.service.RpcChannel.__init__(self)
+        if max_size < 1 or min_size > max_size:
+            raise ValueError("invalid pool size: min=%r max=%r" %
+                             (min_size, max_size))
+        self.addr = addr
+        self.min_size = min_size
+        self.max_size = max_size
+        self.busy_threshold = busy_threshold
+        self.idle_timeout = idle_timeout
+        self.probe = probe
+        self.probe_interval = probe_interval
+        self.channel_options = channel_options
+        self._channels = []
+        self._last_used = {}
+        self._connecting = 0
+        self._connected = Event()
+        self._maintainer = None
+
+    @property
+    def size(self):
+        return len(self._channels) + self._connecting
+
+    def _connect(self):
+        self._connecting += 1
+        try:
+            channel = TcpChannel(self.addr, **self.channel_options)
+        finally:
+            self._connecting -= 1
+            self._connected.set()
+            self._connected.clear()
+        self._channels.append(channel)
+        self._last_used[channel] = time.time()
+        return channel
+
+    def _discard(self, channel):
+        if channel in self._last_used:
+            self._channels.remove(channel)
+            del self._last_used[channel]
+        channel.close()
+
+    def checkout(self):
+        """Return the channel the next call should be sent on."""
+        if self._maintainer is None:
+            self._maintainer = gevent.spawn(self._maintain)
+
+        while True:
+            best = None
+            for channel in list(self._channels):
+                if not channel.connected:
+                    self._discard(channel)
+                elif best is None or channel.in_flight < best.in_flight:
+                    best = channel
+
+            if self.size < self.max_size and (
+                    best is None or best.in_flight >= self.busy_threshold):
+                best = self._connect()
+            if best is not None:
+                break
+            # Every slot is taken by a connection still being set up.
+            self._connected.wait()
+        self._last_used[best] = time.time()
+        return best
+
+    def CallMethod(self, methodDescriptor, rpcController, request,
+                   responseClass, done=None):
+        try:
+            channel = self.checkout()
+        except socket.error as e:
+            rpcController.SetFailed("cannot connect to %s:%s: %s" %
+                                    (self.addr[0], self.addr[1], e))
+            return
+        channel.CallMethod(methodDescriptor, rpcController, request,
+                           responseClass, done)
+
+    def call_stream(self, methodDescriptor, rpcController, request,
+                    responseClass, window=INITIAL_WINDOW):
+        """See TcpChannel.call_stream."""
+        try:
+            channel = self.checkout()
+        except socket.error as e:
+            raise RPCException("cannot connect to %s:%s: %s" %
+                               (self.addr[0], self.addr[1], e))
+        return channel.call_stream(methodDescriptor, rpcController, request,
+                                   responseClass, window)
+
+    def call_upload(self, methodDescriptor, rpcController, requests,
+                    responseClass, done=None):
+        """See TcpChannel.call_upload."""
+        try:
+            channel = self.checkout()
+        except socket.error as e:
+            rpcController.SetFailed("cannot connect to %s:%s: %s" %
+                                    (self.addr[0], self.addr[1], e))
+            return
+        channel.call_upload(methodDescriptor, rpcController, requests,
+                            responseClass, done)
+
+    def _maintain(self):
+        interval = min(self.idle_timeout, self.probe_interval)
+        last_probe = time.time()
+        while True:
+            gevent.sleep(interval)
+            now = time.time()
+            probing = self.probe is not None and \
+                now - last_probe >= self.probe_interval
+            if probing:
+                last_probe = now
+            for channel in list(self._channels):
+                if channel.in_flight:
+                    continue
+                if not channel.connected:
+                    self._discard(channel)
+                elif (len(self._channels) > self.min_size and
+                      now - self._last_used[channel] > self.idle_timeout):
+                    self._discard(channel)
+                elif probing and not self._probe(channel):
+                    self._discard(channel)
+
+    def _probe(self, channel):
+        try:
+            return bool(self.probe(channel))
+        except Exception:
+            return False
+
+    def close(self):
+        if self._maintainer is not None:
+            self._maintainer.kill(block=False)
+            self._maintainer = None
+        for channel in list(self._channels):
+            self._discard(channel)
 
 
 class Proxy(object):
+    """
+    Call methods of ``stubs`` as ``proxy.Service.Method(request)``. The
+    ``timeout`` keyword, in seconds, bounds every call; a call may pass
+    its own ``timeout`` instead.
+
+    With a ``cache`` (a cache.Cache), responses to the methods named in
+    ``cached``, or to every method when it is None, are served from it;
+    see the cache module.
+
+    ``streaming`` maps the "Service.Method" names of streaming methods to
+    how they stream (streaming.SERVER or streaming.CLIENT). Calls to a
+    server-streaming method return a ResponseStream, an iterator of
+    responses; calls to a client-streaming one take an iterable of
+    requests. See the streaming module.
+    """
+
     class _Proxy(object):
-        def __init__(self, stub):
+        def __init__(self, stub, timeout=None, cache=None, cached=None,
+                     streaming=None):
             self._stub = stub
+            self._name = stub.GetDescriptor().name
+            self._timeout = timeout
+            self._cache = cache
+            self._cached = cached
+            self._streaming = streaming or {}
 
         def __getattr__(self, key):
-            def call(method, request):
+            def call(method, request, timeout):
                 class callbackClass(object):
                     def __init__(self):
                         self.response = None
@@ -146,49 +748,313 @@ class Proxy(object):
                     def __call__(self, response):
                         self.response = response
 
-                controller = Controller()
+                controller = Controller(timeout=timeout)
                 callback = callbackClass()
                 method(controller, request, callback)
                 if controller.Failed():
                     raise RPCException(controller.ErrorText())
                 return callback.response
 
-            return lambda request: call(getattr(self._stub, key), request)
+            method = getattr(self._stub, key)
+            name = self._name + '.' + key
+            kind = self._streaming.get(name)
+            if kind is not None:
+                return lambda request, timeout=self._timeout: \
+                    self._streamed_call(kind, key, request, timeout)
+            if self._cache is not None and caches_method(self._cached, name):
+                return lambda request, timeout=self._timeout: \
+                    self._cached_call(name, call, method, request, timeout)
+            return lambda request, timeout=self._timeout: call(
+                method, request, timeout)
 
-    def __init__(self, *stubs):
+        def _streamed_call(self, kind, key, request, timeout):
+            channel = self._stub.rpc_channel
+            method = self._stub.GetDescriptor().FindMethodByName(key)
+            responseClass = self._stub.GetResponseClass(method)
+            controller = Controller(timeout=timeout)
+            if kind == streaming.SERVER:
+                return channel.call_stream(method, controller, request,
+                                           responseClass)
+            responses = []
+            channel.call_upload(method, controller, request, responseClass,
+                                responses.append)
+            if controller.Failed():
+                raise RPCException(controller.ErrorText())
+            return responses[0]
+
+        def _cached_call(self, name, call, method, request, timeout):
+            cache = self._cache
+            serialized = request.SerializeToString()
+            key = (name, serialized)
+            response = cache.get(key)
+            if response is not None:
+                return copy_message(response)
+
+            flight = cache.in_flight.get(key)
+            if flight is not None:
+                try:
+                    response = flight.get(timeout=timeout)
+                except gevent.Timeout:
+                    raise RPCException(
+                        RpcErrors.msgs[RpcErrors.DEADLINE_EXCEEDED])
+                return response and copy_message(response)
+
+            flight = cache.in_flight[key] = AsyncResult()
+            try:
+                response = call(method, request, timeout)
+            except Exception as e:
+                flight.set_exception(e)
+                raise
+            finally:
+                del cache.in_flight[key]
+            if response is not None:
+                cache.put(key, copy_message(response),
+                          len(serialized) + response.ByteSize())
+            flight.set(response)
+            return response
+
+    def __init__(self, *stubs, **options):
+        timeout = options.pop("timeout", None)
+        cache = options.pop("cache", None)
+        cached = options.pop("cached", None)
+        streaming = options.pop("streaming", None)
+        if options:
+            raise TypeError("unexpected options %s" % ", ".join(options))
         self._stubs = {}
         for s in stubs:
-            self._stubs[s.GetDescriptor().name] = self._Proxy(s)
+            self._stubs[s.GetDescriptor().name] = self._Proxy(
+                s, timeout, cache, cached, streaming)
 
     def __getattr__(self, key):
         return self._stubs[key]
 
 
+class Scheduler(object):
+    """
+    Admission control for request greenlets: at most ``size`` of them run
+    at once and at most ``max_queue`` more may wait for a slot. Either
+    limit may be None for no limit; without ``size``, nothing waits and
+    ``max_queue`` bounds the requests running.
+    """
+
+    def __init__(self, size=None, max_queue=None):
+        self.size = size
+        self.max_queue = max_queue
+        self._slots = Semaphore(size) if size else None
+        self.waiting = 0
+        self.running = 0
+
+    def reserve(self):
+        """Accept one more job, unless the queue is full."""
+        if self.max_queue is not None and self.running + self.waiting >= \
+                (self.size or 0) + self.max_queue:
+            return False
+        self.waiting += 1
+        return True
+
+    def cancel(self):
+        """Give back a reservation that will not be run."""
+        self.waiting -= 1
+
+    def acquire(self):
+        """Wait for a slot for a reserved job."""
+        try:
+            if self._slots is not None:
+                self._slots.acquire()
+        finally:
+            self.waiting -= 1
+        self.running += 1
+
+    def release(self):
+        self.running -= 1
+        if self._slots is not None:
+            self._slots.release()
+
+
+class _ServedStream(object):
+    """
+    A stream served on a connection: the credit its client granted for
+    responses and the requests it sent.
+    """
+
+    def __init__(self, window):
+        self.credit = window
+        self.requests = Queue()
+        # The client has nothing more to send: the end of a client stream,
+        # the cancellation of a server stream.
+        self.ended = False
+        self.lost = False
+        self._granted = Event()
+
+    def received(self, serializedRequest):
+        if serializedRequest.window:
+            self.credit += serializedRequest.window
+            self._granted.set()
+        if serializedRequest.HasField('serialized_request'):
+            self.requests.put(serializedRequest.serialized_request)
+        if serializedRequest.end_of_stream:
+            self.end()
+
+    def end(self, lost=False):
+        self.ended = True
+        self.lost = lost
+        self.requests.put(None)
+        self._granted.set()
+
+    def take_credit(self):
+        """
+        Wait for credit to send one more response.
+
+        :return: False if the stream was cancelled instead
+        """
+        while self.credit <= 0 and not self.ended:
+            self._granted.clear()
+            self._granted.wait()
+        if self.ended:
+            return False
+        self.credit -= 1
+        return True
+
+
+class RequestStream(object):
+    """
+    The requests of a client-streaming call, as an iterator for its
+    handler; see the streaming module.
+    """
+
+    def __init__(self, handler, _id, request_class, stream, controller):
+        self._handler = handler
+        self._id = _id
+        self._request_class = request_class
+        self._stream = stream
+        self._controller = controller
+        self._window = ReceiveWindow()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        try:
+            serialized = self._stream.requests.get(
+                timeout=self._controller.TimeRemaining())
+        except Empty:
+            raise RPCException(RpcErrors.msgs[RpcErrors.DEADLINE_EXCEEDED])
+        if serialized is None:
+            # Stay at the end.
+            self._stream.requests.put(None)
+            if self._stream.lost:
+                raise RPCException("connection lost")
+            raise StopIteration
+        credit = self._window.consumed()
+        if credit:
+            self._handler.send_response(ResponseRecord(id=self._id,
+                                                       window=credit))
+        request = self._request_class()
+        request.ParseFromString(serialized)
+        return request
+
+    __next__ = next
+
+
+def new_server_stats():
+    """Counters a server keeps about its connections and requests."""
+    return dict.fromkeys(("accepted", "active", "requests", "errors",
+                          "paused"), 0)
+
+
 class TcpServer(SocketServer.TCPServer):
+    # Per-connection limits, see Scheduler.
+    max_connection_concurrency = None
+    max_connection_queue = None
+    # Default compression.Compression for responses.
+    compression = None
+    # metrics.Registry the handlers record their calls in.
+    metrics = None
+    # hooks.Hooks following the requests served.
+    hooks = None
+    # tracing.Tracer recording the calls served.
+    tracer = None
+
     def __init__(self, host, *services):
         self.services = {}
+        self.methods = {}
         for s in services:
             self.services[s.GetDescriptor().name] = s
+            index_service(self.methods, s)
+        self.streaming = serves_streams(self.methods)
+        self.scheduler = Scheduler()
+        self.stats = new_server_stats()
         SocketServer.TCPServer.__init__(self, host, TcpRequestHandler)
 
 
 class GeventTCPServer(StreamServer):
-    def __init__(self, addr, services):
+    def __init__(self, addr, services, max_concurrency=None, max_queue=None,
+                 max_connection_concurrency=None, max_connection_queue=None,
+                 compression=None, metrics=None, hooks=None, tracer=None):
         """
-        >>> GeventTCPServer(('127.0.0.1', 1234), GeventTCPHandler())
+        >>> GeventTCPServer(('127.0.0.1', 1234), [TestService()])
+
+        ``max_concurrency`` bounds the requests served at once by the whole
+        server and ``max_queue`` how many more may wait; the
+        ``max_connection_*`` pair does the same for each connection.
+        Requests beyond a queue limit fail with RpcErrors.OVERLOADED.
+
+        ``compression`` is the default compression.Compression for
+        responses, see that module.
+
+        ``metrics``, a metrics.Registry, records every call served, and
+        ``hooks``, a hooks.Hooks, is told about the requests it samples.
+        ``tracer``, a tracing.Tracer, records them as spans.
         """
         handle = handle_wrapper(self)
 
         self.services = {}
+        self.methods = {}
         for s in services:
             self.services[s.GetDescriptor().name] = s
+            index_service(self.methods, s)
+        self.streaming = serves_streams(self.methods)
+        self.scheduler = Scheduler(max_concurrency, max_queue)
+        self.max_connection_concurrency = max_connection_concurrency
+        self.max_connection_queue = max_connection_queue
+        self.compression = compression
+        self.metrics = metrics
+        self.hooks = hooks
+        self.tracer = tracer
+        self.stats = new_server_stats()
 
         handle.server = self
 
         super(GeventTCPServer, self).__init__(addr, handle)
 
+    def drain(self, timeout=None):
+        """
+        Stop accepting connections, give requests in flight up to
+        ``timeout`` seconds to complete and then stop the server.
+        """
+        self.stop_accepting()
+        deadline = None if timeout is None else time.time() + timeout
+        while self.scheduler.running + self.scheduler.waiting:
+            if deadline is not None and time.time() >= deadline:
+                break
+            gevent.sleep(0.05)
+        # Let the last coalesced responses reach their sockets.
+        gevent.sleep(0)
+        self.stop(0)
+
 
 class TcpRequestHandler(SocketServer.BaseRequestHandler):
+    # Responses finished within one turn of the event loop are written as a
+    # single frame of at most this many responses / payload bytes.
+    coalesce_count = 64
+    coalesce_bytes = 64 * 1024
+    # Reading (and so dispatching) requests from the connection pauses
+    # while more than high_watermark bytes of responses wait to be written
+    # to it, until they are down to low_watermark: a client that does not
+    # read its responses holds that much memory at most.
+    high_watermark = 256 * 1024
+    low_watermark = 64 * 1024
+
     class callbackClass(object):
         def __init__(self):
             self.response = None
@@ -196,86 +1062,403 @@ class TcpRequestHandler(SocketServer.BaseRequestHandler):
         def __call__(self, response):
             self.response = response
 
+    def setup(self):
+        self._wlock = Semaphore()
+        self._backlog = 0
+        self._writable = Event()
+        self._method_ids = {}
+        self._streams = {}
+        self._scheduler = Scheduler(self.server.max_connection_concurrency,
+                                    self.server.max_connection_queue)
+        self._coalescer = ResponseCoalescer(self.send_string, gevent.spawn,
+                                            self.coalesce_count,
+                                            self.coalesce_bytes)
+        self.server.stats["accepted"] += 1
+        self.server.stats["active"] += 1
+
+    def finish(self):
+        self.server.stats["active"] -= 1
+
     def handle(self):
-        while True:
-            buffer = self.request.recv(struct.calcsize("!I"))
-            if not buffer:
-                break
-            bufferLen = int(struct.unpack("!I", buffer)[0])
-            buffer = self.request.recv(bufferLen)
-            if not buffer:
-                break
-            gevent.spawn(self.string_received, buffer)
+        reader = FrameReader()
+        try:
+            while reader.read(self.request, self.string_received):
+                pass
+        except (socket.error, FrameTooLarge):
+            pass
+        finally:
+            for stream in self._streams.values():
+                stream.end(lost=True)
 
     def send_string(self, buffer):
-        networkOrderBufferLen = struct.pack("!I", len(buffer))
-        print "send string", [ord(i) for i in networkOrderBufferLen]
-
-        buffer = networkOrderBufferLen + buffer
-        bytesSent = 0
-        while bytesSent < len(buffer):
+        size = len(buffer)
+        self._backlog += size
+        try:
             with self._wlock:
-                sent = self.request.send(buffer[bytesSent:])
-            if sent == 0:
-                raise RPCException("socket connection broken")
-            bytesSent += sent
+                write_frame(self.request, buffer)
+        finally:
+            self._backlog -= size
+            if self._backlog <= self.low_watermark:
+                self._writable.set()
+
+    def wait_writable(self):
+        """Wait for the responses backlog to drain down to low_watermark."""
+        self.server.stats["paused"] += 1
+        while self._backlog > self.low_watermark:
+            self._writable.clear()
+            self._writable.wait()
 
     def string_received(self, data):
-        rpc = Rpc()
-        rpc.ParseFromString(data)
-        for serializedRequest in rpc.request:
-            service = self.server.services.get(
-                serializedRequest.method.split('.')[0])
-            if not service:
-                self.send_error(serializedRequest.id,
-                                RpcErrors.SERVICE_NOT_FOUND)
+        if self._backlog > self.high_watermark:
+            self.wait_writable()
+        try:
+            requests, _ = decode_rpc(data)
+        except DecodeError:
+            return
+        received = None
+        if self.server.metrics is not None or self.server.hooks is not None:
+            received = time.time()
+        # A frame may carry a whole batch of requests; serve them
+        # concurrently, each in its own greenlet.
+        for serializedRequest in requests:
+            if self.server.streaming and self.stream_received(
+                    serializedRequest):
+                continue
+            if not self._scheduler.reserve():
+                self.reject(serializedRequest, RpcErrors.OVERLOADED)
+                continue
+            if not self.server.scheduler.reserve():
+                self._scheduler.cancel()
+                self.reject(serializedRequest, RpcErrors.OVERLOADED)
+                continue
+            if self.server.streaming:
+                self.open_stream(serializedRequest)
+            gevent.spawn(self.scheduled, serializedRequest,
+                         request_deadline(serializedRequest), received)
+
+    def stream_received(self, serializedRequest):
+        """
+        Pass on a request continuing a stream.
+
+        :return: whether ``serializedRequest`` was one
+        """
+        stream = self._streams.get(serializedRequest.id)
+        if stream is not None:
+            stream.received(serializedRequest)
+            return True
+        # Neither a call nor part of a stream still open: the last messages
+        # of a stream that has ended.
+        return not serializedRequest.method and \
+            not serializedRequest.method_id
+
+    def open_stream(self, serializedRequest):
+        """
+        Set up the stream a request starts, if it calls a streaming method,
+        before any request continuing it can arrive.
+        """
+        entry = lookup_method(self.server.methods, self._method_ids,
+                              serializedRequest)
+        if entry is not None and entry.streaming:
+            self._streams[serializedRequest.id] = _ServedStream(
+                serializedRequest.window or INITIAL_WINDOW)
+
+    def scheduled(self, serializedRequest, deadline=None, received=None):
+        # Wait for the connection's slot first so a busy connection does
+        # not hold server-wide slots while queueing behind itself.
+        try:
+            self._scheduler.acquire()
+        except:
+            self.server.scheduler.cancel()
+            raise
+        try:
+            self.server.scheduler.acquire()
+            try:
+                self.request_received(serializedRequest, deadline, received)
+            finally:
+                self.server.scheduler.release()
+        finally:
+            self._scheduler.release()
+            if self._streams:
+                self._streams.pop(serializedRequest.id, None)
+
+    def request_received(self, serializedRequest, deadline=None,
+                         received=None):
+        self.server.stats["requests"] += 1
+        # The caller has given up on a request that waited too long for a
+        # slot: answering it would be wasted work.
+        if expired(deadline):
+            self.reject(serializedRequest, RpcErrors.DEADLINE_EXCEEDED)
+            return
+
+        entry = lookup_method(self.server.methods, self._method_ids,
+                              serializedRequest)
+        if entry is None:
+            self.reject(serializedRequest,
+                        dispatch_error(self.server.services,
+                                       serializedRequest.method))
+            return
+
+        if entry.streaming:
+            self.serve_stream(entry, serializedRequest, deadline)
+            return
+
+        try:
+            decompress_request(serializedRequest,
+                               decompression_limit(self.server.compression))
+        except Exception:
+            self.reject(serializedRequest,
+                        RpcErrors.CANNOT_DESERIALIZE_REQUEST, entry)
+            return
+
+        call = None
+        if self.server.metrics is not None:
+            call = self.server.metrics.start(SERVER, entry.name, received)
+            call.lap("queue")
+            call.received(len(serializedRequest.serialized_request))
+        event = None
+        hooks = self.server.hooks
+        if hooks is not None:
+            event = hooks.start(entry.name, serializedRequest.id,
+                                self.client_address, received)
+            if event is not None:
+                hooks.dispatched(event)
+        # Without a tracer the caller's context is passed on as it is.
+        span = None
+        trace = extract(serializedRequest)
+        if self.server.tracer is not None:
+            span = self.server.tracer.start_span(
+                entry.name, trace, self.client_address, received)
+            trace = span and span.context
+
+        try:
+            with activate(trace):
+                if entry.cache is not None:
+                    serialized, error = self.memoized(
+                        entry, serializedRequest, deadline, call)
+                else:
+                    serialized, error = self.execute(
+                        entry, serializedRequest, deadline, call)
+        except Exception as e:
+            # Answered like any other failure of the method: the request
+            # runs in a greenlet of its own, where nobody else would.
+            serialized, error = None, "%s: %s" % (type(e).__name__, e)
+        except BaseException as e:
+            # GreenletExit, KeyboardInterrupt, SystemExit
+            if call is not None:
+                call.finish(RpcErrors.METHOD_ERROR)
+            if event is not None:
+                hooks.failed(event, RpcErrors.METHOD_ERROR, str(e))
+            if span is not None:
+                self.server.tracer.finish(span, RpcErrors.METHOD_ERROR)
+            raise
+
+        if error is not None:
+            self.send_error(serializedRequest.id, RpcErrors.METHOD_ERROR,
+                            error)
+            if call is not None:
+                call.finish(RpcErrors.METHOD_ERROR)
+            if event is not None:
+                hooks.failed(event, RpcErrors.METHOD_ERROR, error)
+            if span is not None:
+                self.server.tracer.finish(span, RpcErrors.METHOD_ERROR)
+            return
+
+        serializedResponse = self.encode_response(serialized,
+                                                  serializedRequest, entry)
+        if span is not None and span.context.sampled:
+            serializedResponse.span_id = span.context.span_id
+        self.send_response(serializedResponse)
+        if call is not None:
+            call.sent(len(serialized))
+            call.finish()
+        if event is not None:
+            hooks.sent(event)
+        if span is not None:
+            self.server.tracer.finish(span)
+
+    def execute(self, entry, serializedRequest, deadline=None, call=None):
+        """
+        Run the method a request calls.
+
+        :param metrics.Call call: where to record the time each step takes
+        :return: (serialized response, None) or (None, error text)
+        """
+        if entry.execution != INLINE:
+            result = self.offload(entry, serializedRequest, deadline)
+            if call is not None:
+                call.lap("handler")
+            return result
+
+        service, method, request_class = entry[:3]
+        request = request_class()
+        request.ParseFromString(serializedRequest.serialized_request)
+        controller = Controller()
+        controller.deadline = deadline
+        controller.trace = current()
+        if call is not None:
+            call.lap("deserialize")
+
+        callback = self.callbackClass()
+        service.CallMethod(method, controller, request, callback)
+        if call is not None:
+            call.lap("handler")
+
+        if controller.Failed():
+            return None, controller.ErrorText()
+        serialized = callback.response.SerializeToString()
+        if call is not None:
+            call.lap("serialize")
+        return serialized, None
+
+    def serve_stream(self, entry, serializedRequest, deadline=None):
+        """Run a streaming method, see the streaming module."""
+        _id = serializedRequest.id
+        stream = self._streams[_id]
+        service, method, request_class = entry[:3]
+        controller = Controller()
+        controller.deadline = deadline
+        callback = self.callbackClass()
+        with activate(extract(serializedRequest)):
+            controller.trace = current()
+            try:
+                if entry.streaming == streaming.CLIENT:
+                    service.CallMethod(method, controller, RequestStream(
+                        self, _id, request_class, stream, controller),
+                        callback)
+                    if not controller.Failed():
+                        self.send_response(self.serialize_response(
+                            callback.response, serializedRequest))
+                else:
+                    request = request_class()
+                    try:
+                        request.ParseFromString(
+                            serializedRequest.serialized_request)
+                    except Exception:
+                        self.reject(serializedRequest,
+                                    RpcErrors.CANNOT_DESERIALIZE_REQUEST,
+                                    entry)
+                        return
+                    self.send_stream(_id, stream, service.CallMethod(
+                        method, controller, request, callback), controller)
+            except Exception as e:
+                self.send_error(_id, RpcErrors.METHOD_ERROR, str(e))
                 return
+        if controller.Failed():
+            self.send_error(_id, RpcErrors.METHOD_ERROR,
+                            controller.ErrorText())
 
-            method = service.GetDescriptor().FindMethodByName(
-                serializedRequest.method.split('.')[1])
-            if not method:
-                self.send_error(serializedRequest.id,
-                                RpcErrors.METHOD_NOT_FOUND)
+    def send_stream(self, _id, stream, responses, controller):
+        """
+        Send the ``responses`` a server-streaming method yields as the
+        client grants credit for them, then the end of the stream.
+        """
+        for response in responses or ():
+            if not stream.take_credit():
+                # Cancelled by the client, or the connection is gone.
                 return
+            self.send_response(ResponseRecord(
+                id=_id, serialized_response=response.SerializeToString()))
+        if not controller.Failed():
+            self.send_response(ResponseRecord(id=_id, end_of_stream=True))
 
-            request = service.GetRequestClass(method)()
-            request.ParseFromString(serializedRequest.serialized_request)
-            controller = Controller()
+    def memoized(self, entry, serializedRequest, deadline=None, call=None):
+        """
+        execute, through the method's cache: duplicates of a request being
+        executed wait for its result.
+        """
+        cache = entry.cache
+        key = (entry.method.full_name, serializedRequest.serialized_request)
+        serialized = cache.get(key)
+        if serialized is not None:
+            return serialized, None
 
-            callback = self.callbackClass()
-            service.CallMethod(method, controller, request, callback)
+        flight = cache.in_flight.get(key)
+        if flight is not None:
+            # Wait no longer than this request's own deadline, however
+            # long the first one takes.
+            timeout = None
+            if deadline is not None:
+                timeout = max(deadline - time.time(), 0)
+            try:
+                return flight.get(timeout=timeout)
+            except gevent.Timeout:
+                return None, RpcErrors.msgs[RpcErrors.DEADLINE_EXCEEDED]
 
-            if controller.Failed():
-                self.send_error(serializedRequest.id, RpcErrors.METHOD_ERROR,
-                                controller.ErrorText())
-                return
+        flight = cache.in_flight[key] = AsyncResult()
+        try:
+            result = self.execute(entry, serializedRequest, deadline, call)
+        except Exception as e:
+            flight.set_exception(e)
+            raise
+        finally:
+            del cache.in_flight[key]
+        serialized, error = result
+        if error is None:
+            cache.put(key, serialized, len(key[1]) + len(serialized))
+        flight.set(result)
+        return result
+
+    def offload(self, entry, serializedRequest, deadline=None):
+        # The hub's thread pool also waits on the process pool, so neither
+        # kind of work blocks the event loop.
+        threadpool = gevent.get_hub().threadpool
+        args = (entry.service, entry.method.name,
+                serializedRequest.serialized_request)
+        if entry.execution == PROCESS:
+            pool = process_pool()
+            workers = pool.idle(Queue)
+            worker = workers.get()
+            try:
+                return threadpool.apply(
+                    unless_expired, (deadline, call_in_worker, worker) + args)
+            finally:
+                workers.put(pool.respawned(worker))
+        return threadpool.apply(unless_expired, (deadline, call_method) + args)
 
-            serialized_response = self.serialize_response(callback.response,
-                                                          serializedRequest)
-            response_rpc = self.serialize_rpc(serialized_response)
-            self.send_string(response_rpc.SerializeToString())
+    def send_response(self, serializedResponse):
+        self._coalescer.add(serializedResponse)
 
-    def serialize_response(self, response, serialized_request):
-        serializedResponse = Response()
-        serializedResponse.id = serialized_request.id
-        serializedResponse.serialized_response = response.SerializeToString()
+    def serialize_response(self, response, serialized_request, entry=None):
+        return self.encode_response(response.SerializeToString(),
+                                    serialized_request, entry)
+
+    def encode_response(self, serialized, serialized_request, entry=None):
+        serializedResponse = ResponseRecord(id=serialized_request.id)
+        compression = None
+        if entry is not None:
+            compression = method_compression(
+                entry.compression, self.server.compression, entry.name)
+        fill_response(compression, serializedResponse, serialized_request,
+                      serialized)
+        acknowledge_method_id(serializedResponse, serialized_request,
+                              self._method_ids)
         return serializedResponse
 
     def serialize_rpc(self, serializedResponse):
-        rpc = Rpc()
-        rpc.response.extend([serializedResponse])
-        return rpc
+        """The Rpc frame carrying ``serializedResponse`` alone."""
+        return serializedResponse.encode()
+
+    def reject(self, serializedRequest, code, entry=None):
+        """Answer a request that will not be run with error ``code``."""
+        metrics, hooks = self.server.metrics, self.server.hooks
+        if metrics is not None or hooks is not None:
+            if entry is None:
+                entry = self.server.methods.get(serializedRequest.method)
+            name = entry.name if entry is not None else "unknown"
+            if metrics is not None:
+                metrics.rejected(SERVER, name, code)
+            if hooks is not None:
+                event = hooks.start(name, serializedRequest.id,
+                                    self.client_address)
+                if event is not None:
+                    hooks.failed(event, code, RpcErrors.msgs[code])
+        self.send_error(serializedRequest.id, code)
 
     def send_error(self, _id, code, msg=None):
-        rpc = Rpc()
-        rpcResponse = rpc.response.add()
-        rpcResponse.id = _id
-        rpcResponse.error.code = code
-        if not msg:
-            rpcResponse.error.text = RpcErrors.msgs[code]
-        else:
-            rpcResponse.error.text = msg
-        self.send_string(rpc.SerializeToString())
+        self.server.stats["errors"] += 1
+        self.send_response(ResponseRecord(
+            id=_id, error=ErrorRecord(code=code,
+                                      text=msg or RpcErrors.msgs[code])))
 
 
 class handle_wrapper(object):
@@ -284,7 +1467,10 @@ class handle_wrapper(object):
 
     def __call__(self, socket, address):
         handle = GeventTCPHandler(socket, address, self.server)
-        handle.handle()
+        try:
+            handle.handle()
+        finally:
+            handle.finish()
 
 
 # Ensure self.request and self.server exists
@@ -292,4 +1478,5 @@ class GeventTCPHandler(TcpRequestHandler):
     def __init__(self, socket, address, server):
         self.server = server
         self.request = socket
-        self._wlock = Semaphore()
+        self.client_address = address
+        self.setup()
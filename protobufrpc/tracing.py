@@ -0,0 +1,144 @@
+"""Distributed tracing: trace context in the envelope and server spans.
+
+Requests carry the id of the trace they belong to, the span of the caller
+and whether the trace is sampled. A server given a Tracer records each call
+it serves as a Span, a child of the caller's, and hands sampled spans to the
+tracer's exporter::
+
+    tracer = Tracer(MemoryExporter(), sample_rate=0.01)
+    server = GeventTCPServer(addr, services, tracer=tracer)
+
+Handlers see their span's context as ``controller.trace``. It is also the
+current context while they run, so calls they make through a Proxy carry
+it on to the next service. Under gevent that holds for the whole request,
+which runs in its own greenlet; with Twisted only for calls made before
+the method returns, others may restore it with ``activate``::
+
+    with activate(controller.trace):
+        d = proxy.Store.Get(request)
+
+Requests for methods run in a thread or process pool are traced, but the
+pool does not see the context.
+"""
+
+import os
+import random
+import time
+from collections import deque, namedtuple
+from contextlib import contextmanager
+
+try:
+    from gevent.local import local
+except ImportError:
+    from threading import local
+
+__all__ = ["SpanContext", "Span", "Tracer", "MemoryExporter", "activate",
+           "current"]
+
+SpanContext = namedtuple("SpanContext", ["trace_id", "span_id", "sampled"])
+
+_current = local()
+
+
+def current():
+    """The SpanContext calls made now belong to, or None."""
+    return getattr(_current, "context", None)
+
+
+@contextmanager
+def activate(context):
+    """Make ``context`` current within the block."""
+    previous = current()
+    _current.context = context
+    try:
+        yield context
+    finally:
+        _current.context = previous
+
+
+def new_span_id():
+    return random.getrandbits(64) or 1
+
+
+def inject(rpcRequest, context):
+    """Mark a request as made from ``context``, which may be None."""
+    if context is not None:
+        rpcRequest.trace_id = context.trace_id
+        rpcRequest.parent_span_id = context.span_id
+        if context.sampled:
+            rpcRequest.sampled = True
+
+
+def extract(serializedRequest):
+    """The caller's SpanContext, or None for an untraced request."""
+    if not serializedRequest.trace_id:
+        return None
+    return SpanContext(serializedRequest.trace_id,
+                       serializedRequest.parent_span_id,
+                       serializedRequest.sampled)
+
+
+class Span(object):
+    """
+    A call served. Times are time.time() values; ``error`` is the RpcErrors
+    code the call failed with, if it did.
+    """
+
+    __slots__ = ("name", "context", "parent_id", "peer", "start", "end",
+                 "error")
+
+    def __init__(self, name, context, parent_id=None, peer=None, start=None):
+        self.name = name
+        self.context = context
+        self.parent_id = parent_id
+        self.peer = peer
+        self.start = time.time() if start is None else start
+        self.end = None
+        self.error = None
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+
+class Tracer(object):
+    """
+    :param exporter: object whose ``export(span)`` receives the finished
+        sampled spans
+    :param float sample_rate: fraction of the traces started here (for
+        requests that carry none) that are sampled
+    """
+
+    def __init__(self, exporter, sample_rate=1.0):
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+
+    def start_span(self, name, parent, peer=None, start=None):
+        """
+        The Span of a call to ``name`` made from ``parent``, a SpanContext
+        or None; None when such a call starts no trace.
+        """
+        if parent is not None:
+            context = SpanContext(parent.trace_id, new_span_id(),
+                                  parent.sampled)
+            return Span(name, context, parent.span_id, peer, start)
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return None
+        context = SpanContext(os.urandom(16), new_span_id(), True)
+        return Span(name, context, None, peer, start)
+
+    def finish(self, span, error=None):
+        span.end = time.time()
+        span.error = error
+        if span.context.sampled:
+            self.exporter.export(span)
+
+
+class MemoryExporter(object):
+    """Keeps the last ``size`` spans in ``spans``."""
+
+    def __init__(self, size=1000):
+        self.spans = deque(maxlen=size)
+
+    def export(self, span):
+        self.spans.append(span)
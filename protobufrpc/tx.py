@@ -19,171 +19,996 @@
 # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
+import time
+from contextlib import contextmanager
 from twisted.internet.address import _IPAddress
 
 import twisted.internet.protocol
-from twisted.internet.defer import Deferred
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, DeferredQueue, fail, succeed
 from twisted.protocols.basic import Int32StringReceiver
 from twisted.internet.protocol import DatagramProtocol
 from twisted.internet.protocol import connectionDone
+from twisted.internet.threads import deferToThread
 from twisted.protocols.policies import ProtocolWrapper
+from twisted.internet.interfaces import IPushProducer
+from zope.interface import implementer
 import google.protobuf.service
 from twisted.python.failure import Failure
-from protobufrpc_pb2 import Rpc, Request, Response, Error
-from common import Controller
+from protobufrpc_pb2 import Rpc
+from cache import caches_method, copy_message
+from metrics import CLIENT, LOCAL_ERROR, SERVER
+from streaming import INITIAL_WINDOW, ReceiveWindow
+import streaming
+from tracing import activate, current, extract, inject
+from compression import decompress, decompress_request, \
+    decompression_limit, fill_request, fill_response, method_compression
+from envelope import ErrorRecord, ResponseRecord, decode_rpc, payload_bytes
+from common import INLINE, PROCESS, Controller, MethodIds, PendingCalls, \
+    ResponseCoalescer, RPCException, RpcErrors, TimerWheel, \
+    acknowledge_method_id, call_in_worker, call_method, dispatch_error, \
+    index_service, lookup_method, process_pool, expired, request_deadline, \
+    serves_streams, set_timeout, unless_expired
 
 __all__ = ["TcpChannel", "UdpChannel", "Proxy", "Factory"]
 
 
-class RPCException(Exception):
-    pass
+def _lap(result, call, phase):
+    call.lap(phase)
+    return result
+
+
+def _measure_response(serializedResponse, call):
+    if serializedResponse.HasField('error'):
+        call.finish(serializedResponse.error.code)
+    else:
+        call.mark()
+        call.received(len(serializedResponse.serialized_response))
+    return serializedResponse
+
+
+def _measure_result(result, call, controller):
+    if isinstance(result, Failure):
+        call.finish(RpcErrors.DEADLINE_EXCEEDED
+                    if expired(controller.deadline) else LOCAL_ERROR)
+    else:
+        call.lap("deserialize")
+        call.finish()
+    return result
+
+
+def _follow_sent(serializedResponse, hooks, event):
+    if isinstance(serializedResponse, Failure):
+        hooks.failed(event, RpcErrors.METHOD_ERROR,
+                     serializedResponse.getErrorMessage())
+    elif serializedResponse.error.code:
+        hooks.failed(event, serializedResponse.error.code,
+                     serializedResponse.error.text)
+    else:
+        hooks.sent(event)
+    return serializedResponse
+
+
+def _trace_sent(serializedResponse, tracer, span):
+    if isinstance(serializedResponse, Failure):
+        tracer.finish(span, RpcErrors.METHOD_ERROR)
+    elif serializedResponse.error.code:
+        tracer.finish(span, serializedResponse.error.code)
+    else:
+        if span.context.sampled:
+            serializedResponse.span_id = span.context.span_id
+        tracer.finish(span)
+    return serializedResponse
+
+
+def _measure_sent(serializedResponse, call):
+    if isinstance(serializedResponse, Failure):
+        call.finish(RpcErrors.METHOD_ERROR)
+    elif serializedResponse.error.code:
+        call.finish(serializedResponse.error.code)
+    else:
+        call.sent(len(serializedResponse.serialized_response))
+        call.finish()
+    return serializedResponse
+
+
+class _Pump(object):
+    """
+    The sending side of a stream: sends each message ``messages`` iterates
+    over, or each a Deferred it yields fires with, by ``send(message)`` as
+    the receiver grants credit. Then calls ``end()``, or ``fail(failure)``
+    if producing a message fails; ``stopped()`` if the receiver cancels
+    the stream.
+    """
+
+    def __init__(self, messages, send, end, fail, credit, stopped=None):
+        self.credit = credit
+        self.done = False
+        self._messages = iter(messages)
+        self._send = send
+        self._end = end
+        self._fail = fail
+        self._stopped = stopped
+        # Deferred of the message being produced
+        self._waiting = None
+        self._running = False
+
+    def received(self, message):
+        """Take a Request or Response from the receiver of the stream."""
+        if message.end_of_stream:
+            # The receiver wants nothing more.
+            self.stop()
+            if self._stopped is not None:
+                self._stopped()
+        elif message.window:
+            self.credit += message.window
+            self.resume()
+
+    def stop(self):
+        self.done = True
+        self._messages = iter(())
+
+    def failed(self, exception):
+        self.stop()
+
+    def resume(self):
+        """Send as many messages as credit allows."""
+        if self._running:
+            return
+        self._running = True
+        try:
+            while self.credit > 0 and self._waiting is None and \
+                    not self.done:
+                try:
+                    message = next(self._messages)
+                except StopIteration:
+                    self.done = True
+                    self._end()
+                    return
+                except Exception:
+                    self.done = True
+                    self._fail(Failure())
+                    return
+                if isinstance(message, Deferred):
+                    # One that has fired already is sent by addBoth.
+                    self._waiting = message
+                    message.addBoth(self._produced)
+                else:
+                    self.credit -= 1
+                    self._send(message)
+        finally:
+            self._running = False
+
+    def _produced(self, result):
+        self._waiting = None
+        if self.done:
+            return
+        if isinstance(result, Failure):
+            self.done = True
+            self._fail(result)
+            return
+        self.credit -= 1
+        self._send(result)
+        self.resume()
+
+
+class ResponseStream(object):
+    """
+    The responses of a server-streaming call, see the streaming module.
+    ``get()`` returns a Deferred firing with the next response, or with None
+    once the stream has ended. Closing it before the end cancels the call.
+    """
+
+    def __init__(self, channel, _id, responseClass, window=INITIAL_WINDOW):
+        self._channel = channel
+        self._id = _id
+        self._responseClass = responseClass
+        self._window = ReceiveWindow(window)
+        self._responses = DeferredQueue()
+        self._done = False
+        # Once done: the Failure the stream ended with, if any.
+        self._failure = None
+
+    def get(self):
+        if self._done:
+            return succeed(None) if self._failure is None \
+                else fail(self._failure)
+        d = self._responses.get()
+        d.addCallback(self._next)
+        d.addErrback(self._failed)
+        return d
+
+    def _next(self, serializedResponse):
+        if serializedResponse is None:
+            return None
+        if serializedResponse.HasField('error'):
+            raise RPCException(serializedResponse.error.text)
+        if serializedResponse.end_of_stream:
+            self._finish()
+            return None
+        credit = self._window.consumed()
+        if credit:
+            self._channel.send_stream_message(self._id, window=credit)
+        return self._channel.unserialize_response(
+            serializedResponse, self._responseClass, None)
+
+    def _failed(self, failure):
+        self._finish(failure)
+        return failure
+
+    def received(self, serializedResponse):
+        self._responses.put(serializedResponse)
+
+    def failed(self, exception):
+        """End the stream with ``exception``, cancelling the call."""
+        if self._done:
+            return
+        self._finish(Failure(exception))
+        self._channel.send_stream_message(self._id, end_of_stream=True)
+
+    def close(self):
+        """Cancel the call, unless it is over."""
+        self.failed(RPCException("Cancelled"))
+
+    def _finish(self, failure=None):
+        if self._done:
+            return
+        self._done = True
+        self._failure = failure
+        self._channel._timers.cancel(self._id)
+        self._channel._streams.pop(self._id, None)
+        # Readers still waiting get what later ones will.
+        while self._responses.waiting:
+            self._responses.put(failure)
+
+
+class _Upload(object):
+    """A client-streaming call: its requests and its response."""
+
+    def __init__(self, channel, _id, requests, d):
+        self._channel = channel
+        self._id = _id
+        self._d = d
+        self.pump = _Pump(requests, self._send, self._end, self._failed,
+                          INITIAL_WINDOW)
+
+    def _send(self, request):
+        self._channel.send_stream_message(
+            self._id, serialized_request=request.SerializeToString())
+
+    def _end(self):
+        self._channel.send_stream_message(self._id, end_of_stream=True)
+
+    def _failed(self, failure):
+        self._channel._streams.pop(self._id, None)
+        self._channel._timers.cancel(self._id)
+        self._d.errback(failure)
+
+    def received(self, serializedResponse):
+        if serializedResponse.HasField('serialized_response') or \
+                serializedResponse.HasField('error'):
+            self.pump.stop()
+            self._channel._streams.pop(self._id, None)
+            self._channel._timers.cancel(self._id)
+            self._d.callback(serializedResponse)
+        else:
+            self.pump.received(serializedResponse)
+
+    def failed(self, exception):
+        self.pump.stop()
+        self._failed(Failure(exception))
+
+
+class RequestStream(object):
+    """
+    The requests of a client-streaming call, for its handler; see the
+    streaming module. ``get()`` returns a Deferred firing with the next
+    request, or with None once the stream has ended.
+    """
+
+    def __init__(self, channel, _id, request_class):
+        self._channel = channel
+        self._id = _id
+        self._request_class = request_class
+        self._window = ReceiveWindow()
+        # Serialized requests, then None at the end or the Failure the
+        # stream ended with.
+        self._requests = DeferredQueue()
+
+    def get(self):
+        d = self._requests.get()
+        d.addCallback(self._next)
+        return d
+
+    def _next(self, serialized):
+        if serialized is None:
+            # Stay at the end.
+            self._requests.put(None)
+            return None
+        credit = self._window.consumed()
+        if credit:
+            self._channel._coalescer.add(ResponseRecord(id=self._id,
+                                                        window=credit))
+        request = self._request_class()
+        request.ParseFromString(serialized)
+        return request
+
+    def received(self, serializedRequest):
+        if serializedRequest.HasField('serialized_request'):
+            self._requests.put(serializedRequest.serialized_request)
+        if serializedRequest.end_of_stream:
+            self._requests.put(None)
+
+    def failed(self, exception):
+        self._requests.put(Failure(exception))
 
 
 class BaseChannel(google.protobuf.service.RpcChannel):
     id = 0
 
-    def __init__(self):
+    def __init__(self, method_ids=False, max_in_flight=None,
+                 compression=None, metrics=None, hooks=None, tracer=None):
+        """
+        :param bool method_ids: name methods by an id bound on the
+            connection, rather than by their full name, once the server
+            acknowledges it
+        :param int max_in_flight: calls beyond this many outstanding ones
+            are held back, and sent as earlier ones complete
+        :param compression.Compression compression: how to compress the
+            requests, and by default the responses, sent on the channel
+        :param metrics.Registry metrics: records the calls made and served
+        :param hooks.Hooks hooks: told about the requests served
+        :param tracing.Tracer tracer: records the calls served
+        """
         google.protobuf.service.RpcChannel.__init__(self)
-        self._pending = {}
+        self.compression = compression
+        self.metrics = metrics
+        self.hooks = hooks
+        self.tracer = tracer
+        self._peer_accepts = 0
+        self._pending = PendingCalls(max_in_flight)
+        self._lost = None
         self._services = {}
+        self._methods = {}
+        self._method_ids = MethodIds() if method_ids else None
+        self._method_bindings = {}
+        self._batch = None
+        self._timers = TimerWheel()
+        self._expiry = None
+        # Streams called and served on the channel, by id.
+        self._streams = {}
+        self._served = {}
 
     def add_service(self, service):
         self._services[service.GetDescriptor().name] = service
+        index_service(self._methods, service)
 
     def unserialize_response(self, serializedResponse, responseClass,
                              rpcController):
-        print "unserialize_response"
         response = responseClass()
         if serializedResponse.HasField('error'):
             #rpcController.setFailed(serializedResponse.error.text)
             raise RPCException(serializedResponse.error.text)
         else:
-            response.ParseFromString(serializedResponse.serialized_response)
+            response.ParseFromString(decompress(
+                serializedResponse.serialized_response,
+                serializedResponse.compression,
+                decompression_limit(self.compression)))
 
         return response
 
-    def serialize_response(self, response, serializedRequest, controller):
-        serializedResponse = Response()
-        serializedResponse.id = serializedRequest.id
+    def _response_compression(self, entry):
+        return method_compression(entry.compression, self.compression,
+                                  entry.name)
+
+    def serialize_response(self, response, serializedRequest, controller,
+                           entry):
+        serializedResponse = ResponseRecord(id=serializedRequest.id)
 
         if controller.Failed():
-            serializedResponse.error.code = 1
-            serializedResponse.error.text = controller.ErrorText()
+            serializedResponse.error = ErrorRecord(
+                code=RpcErrors.METHOD_ERROR, text=controller.ErrorText())
         else:
-            serializedResponse.serialized_response = response.SerializeToString()
+            fill_response(self._response_compression(entry),
+                          serializedResponse, serializedRequest,
+                          response.SerializeToString())
+        acknowledge_method_id(serializedResponse, serializedRequest,
+                              self._method_bindings)
+
+        return serializedResponse
 
+    def offloaded_response(self, result, serializedRequest, entry):
+        serialized, error = result
+        serializedResponse = ResponseRecord(id=serializedRequest.id)
+        if error is not None:
+            serializedResponse.error = ErrorRecord(
+                code=RpcErrors.METHOD_ERROR, text=error)
+        else:
+            fill_response(self._response_compression(entry),
+                          serializedResponse, serializedRequest, serialized)
+        acknowledge_method_id(serializedResponse, serializedRequest,
+                              self._method_bindings)
         return serializedResponse
 
+    def _call_worker(self, worker, pool, deadline, args):
+        d = deferToThread(unless_expired, deadline, call_in_worker, worker,
+                          *args)
+        d.addBoth(lambda result: (
+            pool.idle(DeferredQueue).put(pool.respawned(worker)),
+            result)[1])
+        return d
+
+    def dispatch(self, entry, serializedRequest, controller, received=None):
+        """
+        Run the method a request calls.
+
+        :param float received: when the request was read, for the metrics
+        :rtype: Deferred firing with the Response to send back
+        """
+        try:
+            decompress_request(serializedRequest,
+                               decompression_limit(self.compression))
+        except Exception:
+            code = RpcErrors.CANNOT_DESERIALIZE_REQUEST
+            serializedResponse = ResponseRecord(
+                id=serializedRequest.id,
+                error=ErrorRecord(code=code, text=RpcErrors.msgs[code]))
+            self.reject(serializedRequest, controller,
+                        RpcErrors.CANNOT_DESERIALIZE_REQUEST, entry)
+            return succeed(serializedResponse)
+
+        call = None
+        if self.metrics is not None:
+            call = self.metrics.start(SERVER, entry.name, received)
+            call.lap("queue")
+            call.received(len(serializedRequest.serialized_request))
+        event = None
+        if self.hooks is not None:
+            event = self.hooks.start(entry.name, serializedRequest.id,
+                                     controller.peer, received)
+            if event is not None:
+                self.hooks.dispatched(event)
+        # Without a tracer the caller's context is passed on as it is.
+        span = None
+        controller.trace = extract(serializedRequest)
+        if self.tracer is not None:
+            span = self.tracer.start_span(entry.name, controller.trace,
+                                          controller.peer, received)
+            controller.trace = span and span.context
+
+        with activate(controller.trace):
+            if entry.cache is not None or entry.execution != INLINE:
+                if entry.cache is not None:
+                    d = self.memoized(entry, serializedRequest, controller,
+                                      call)
+                else:
+                    d = self.execute(entry, serializedRequest, controller,
+                                     call)
+                d.addCallback(self.offloaded_response, serializedRequest,
+                              entry)
+            else:
+                service, method, request_class = entry[:3]
+                request = request_class()
+                request.ParseFromString(serializedRequest.serialized_request)
+                d = Deferred()
+                if call is not None:
+                    call.lap("deserialize")
+                    d.addCallback(_lap, call, "handler")
+                d.addCallback(self.serialize_response, serializedRequest,
+                              controller, entry)
+                if call is not None:
+                    d.addCallback(_lap, call, "serialize")
+                service.CallMethod(method, controller, request, d.callback)
+
+        if span is not None:
+            d.addBoth(_trace_sent, self.tracer, span)
+        if call is not None:
+            d.addBoth(_measure_sent, call)
+        if event is not None:
+            d.addBoth(_follow_sent, self.hooks, event)
+        return d
+
+    def offload(self, entry, serializedRequest, controller):
+        args = (entry.service, entry.method.name,
+                payload_bytes(serializedRequest.serialized_request))
+        if entry.execution == PROCESS:
+            pool = process_pool()
+            d = pool.idle(DeferredQueue).get()
+            d.addCallback(self._call_worker, pool, controller.deadline, args)
+            return d
+        return deferToThread(unless_expired, controller.deadline,
+                             call_method, *args)
+
+    def execute(self, entry, serializedRequest, controller, call=None):
+        """
+        Run the method a request calls.
+
+        :param metrics.Call call: where to record the time each step takes
+        :rtype: Deferred firing with (serialized response, None) or
+            (None, error text)
+        """
+        if entry.execution != INLINE:
+            d = self.offload(entry, serializedRequest, controller)
+            if call is not None:
+                d.addCallback(_lap, call, "handler")
+            return d
+
+        def serialized(response):
+            if controller.Failed():
+                return None, controller.ErrorText()
+            return response.SerializeToString(), None
+
+        service, method, request_class = entry[:3]
+        request = request_class()
+        request.ParseFromString(serializedRequest.serialized_request)
+        d = Deferred()
+        if call is not None:
+            call.lap("deserialize")
+            d.addCallback(_lap, call, "handler")
+        d.addCallback(serialized)
+        if call is not None:
+            d.addCallback(_lap, call, "serialize")
+        service.CallMethod(method, controller, request, d.callback)
+        return d
+
+    def memoized(self, entry, serializedRequest, controller, call=None):
+        """
+        execute, through the method's cache: duplicates of a request being
+        executed wait for its result.
+        """
+        cache = entry.cache
+        key = (entry.method.full_name,
+               payload_bytes(serializedRequest.serialized_request))
+        serialized = cache.get(key)
+        if serialized is not None:
+            return succeed((serialized, None))
+
+        waiters = cache.in_flight.get(key)
+        if waiters is not None:
+            d = Deferred()
+            waiters.append(d)
+            return d
+
+        waiters = cache.in_flight[key] = []
+
+        def done(result):
+            del cache.in_flight[key]
+            if isinstance(result, Failure):
+                for d in waiters:
+                    d.errback(result)
+                return result
+            serialized, error = result
+            if error is None:
+                cache.put(key, serialized, len(key[1]) + len(serialized))
+            for d in waiters:
+                d.callback(result)
+            return result
+
+        d = self.execute(entry, serializedRequest, controller, call)
+        d.addBoth(done)
+        return d
+
     def serialize_rpc(self, serializedResponse):
-        rpc = Rpc()
-        rpcResponse = rpc.response.add()
-        rpcResponse.serialized_response = serializedResponse.serialized_response
-        rpcResponse.id = serializedResponse.id
-        if serializedResponse.error.code != 0:
-            rpcResponse.error.code = serializedResponse.error.code
-            rpcResponse.error.text = serializedResponse.error.text
-        return rpc
+        """The Rpc frame carrying ``serializedResponse`` alone."""
+        return serializedResponse.encode()
 
     def _call_method(self, methodDescriptor, rpcController, request,
-                     responseClass, done):
+                     responseClass, done, rpc=None, call=None):
         self.id += 1
+        _id = self.id
         d = Deferred()
+        if call is not None:
+            call.lap("queue")
+            d.addCallback(_measure_response, call)
         d.addCallback(self.unserialize_response, responseClass, rpcController)
+        if call is not None:
+            d.addBoth(_measure_result, call, rpcController)
         d.chainDeferred(done)
-        self._pending[self.id] = d
-        rpc = Rpc()
+        if rpc is None:
+            rpc = Rpc()
         rpcRequest = rpc.request.add()
-        rpcRequest.method = methodDescriptor.containing_service.name + '.' + methodDescriptor.name
-        rpcRequest.serialized_request = request.SerializeToString()
-        rpcRequest.id = self.id
+        methodName = methodDescriptor.containing_service.name + '.' + methodDescriptor.name
+        if self._method_ids is not None:
+            self._method_ids.fill(rpcRequest, methodName)
+        else:
+            rpcRequest.method = methodName
+        fill_request(self.compression, rpcRequest, methodName,
+                     request.SerializeToString(), self._peer_accepts)
+        rpcRequest.id = _id
+        inject(rpcRequest, rpcController.trace or current())
+        if call is not None:
+            call.lap("serialize")
+            call.sent(len(rpcRequest.serialized_request))
+
+        error = None
+        if self._lost is not None:
+            error = self._lost
+        elif rpcController.IsCancelled():
+            error = RPCException("Cancelled")
+        elif not set_timeout(rpcRequest, rpcController):
+            error = RPCException(RpcErrors.msgs[RpcErrors.DEADLINE_EXCEEDED])
+        if error is not None:
+            del rpc.request[-1]
+            d.errback(error)
+            return rpc
+
+        self._pending.add(_id, d)
+        if rpcController.deadline is not None:
+            self._timers.add(_id, rpcController.deadline)
+            self._schedule_expiry()
+        rpcController.NotifyOnCancel(
+            lambda: self._fail_call(_id, RPCException("Cancelled")))
         return rpc
 
     def CallMethod(self, methodDescriptor, rpcController, request,
                    responseClass, done):
+        call = None
+        if self.metrics is not None:
+            call = self.metrics.start(
+                CLIENT, methodDescriptor.containing_service.name + '.' +
+                methodDescriptor.name)
+        self._pending.admit(lambda: self._start_call(
+            methodDescriptor, rpcController, request, responseClass, done,
+            call))
+
+    def _start_call(self, methodDescriptor, rpcController, request,
+                    responseClass, done, call=None):
+        if self._batch is not None:
+            self._call_method(methodDescriptor, rpcController, request,
+                              responseClass, done, self._batch, call)
+            return
+        rpc = self._call_method(methodDescriptor, rpcController, request,
+                                responseClass, done, call=call)
+        if rpc.request:
+            self.send_rpc(rpc)
+
+    def _fail_call(self, _id, exception):
+        self._timers.cancel(_id)
+        d = self._pending.pop(_id)
+        if d is not None:
+            d.errback(exception)
+        elif _id in self._streams:
+            self._streams.pop(_id).failed(exception)
+
+    def _fail_pending(self, exception):
+        if self._expiry is not None:
+            self._expiry.cancel()
+            self._expiry = None
+        self._timers = TimerWheel()
+        # Calls still waiting for room start, and fail, as these leave.
+        self._lost = exception
+        for d in self._pending.clear():
+            d.errback(exception)
+        for streams in (self._streams, self._served):
+            for stream in streams.values():
+                stream.failed(exception)
+            streams.clear()
+
+    @property
+    def in_flight(self):
+        return len(self._pending)
+
+    def pending_stats(self):
+        """Size and age histogram of the calls waiting for a response."""
+        return self._pending.stats()
+
+    def _schedule_expiry(self):
+        if self._expiry is None and self._timers:
+            self._expiry = reactor.callLater(self._timers.resolution,
+                                             self._expire)
+
+    def _expire(self):
+        self._expiry = None
+        for _id in self._timers.expire():
+            self._fail_call(_id, RPCException(
+                RpcErrors.msgs[RpcErrors.DEADLINE_EXCEEDED]))
+        self._schedule_expiry()
+
+    def send_rpc(self, rpc):
         # This method must be overridden.
         pass
 
+    def reject(self, serializedRequest, controller, code, entry=None):
+        """Record a request that will not be run, failing with ``code``."""
+        name = entry.name if entry is not None else "unknown"
+        if self.metrics is not None:
+            self.metrics.rejected(SERVER, name, code)
+        if self.hooks is not None:
+            event = self.hooks.start(name, serializedRequest.id,
+                                     controller.peer)
+            if event is not None:
+                self.hooks.failed(event, code, RpcErrors.msgs[code])
+
+    def response_received(self, serializedResponse):
+        if serializedResponse.method_id and self._method_ids is not None:
+            self._method_ids.acknowledged(serializedResponse.method_id)
+        if serializedResponse.accept_compression:
+            self._peer_accepts = serializedResponse.accept_compression
+        stream = self._streams.get(serializedResponse.id)
+        if stream is not None:
+            stream.received(serializedResponse)
+            return
+        d = self._pending.pop(serializedResponse.id)
+        if d is not None:
+            self._timers.cancel(serializedResponse.id)
+            d.callback(serializedResponse)
+
+    def send_stream_message(self, _id, **fields):
+        """Send a Request of the stream ``_id``, with ``fields`` set."""
+        rpc = Rpc()
+        rpc.request.add(id=_id, **fields)
+        self.send_rpc(rpc)
 
-class RpcErrors:
-    SUCCESS = 0
-    UNSERIALIZE_RPC = 1
-    SERVICE_NOT_FOUND = 2
-    METHOD_NOT_FOUND = 3
-    CANNOT_DESERIALIZE_REQUEST = 4
-    METHOD_ERROR = 5
+    @contextmanager
+    def batch(self):
+        """
+        Collect every call made inside the block into one Rpc frame, sent
+        when the block exits::
 
-    msgs = ['Success', 'Error when unserializing Rpc message',
-            'Service not found', 'Method not found',
-            'Cannot deserialized request', 'Method Error']
+            with channel.batch():
+                d1 = proxy.Test.Echo(request)
+                d2 = proxy.Math.Add(operands)
+        """
+        if self._batch is not None:
+            # Nested: the outermost block sends the frame.
+            yield
+            return
+        self._batch = Rpc()
+        try:
+            yield
+        finally:
+            rpc, self._batch = self._batch, None
+            if rpc.request:
+                self.send_rpc(rpc)
 
 
+@implementer(IPushProducer)
 class TcpChannel(BaseChannel, Int32StringReceiver):
-    def __init__(self, lost_cb=None):
+    """
+    Channel over a TCP connection, making calls and serving them.
+
+    Serving requests, the channel is the producer of its transport: while
+    the transport holds more than its ``bufferSize`` of data to write it
+    pauses the channel, which stops reading and dispatching requests until
+    the responses are written. A client that does not read its responses
+    holds the server back rather than making it buffer them.
+    """
+
+    # Responses finished within one reactor iteration are written as a
+    # single frame of at most this many responses / payload bytes.
+    coalesce_count = 64
+    coalesce_bytes = 64 * 1024
+
+    def __init__(self, lost_cb=None, method_ids=False, max_in_flight=None,
+                 compression=None, metrics=None, hooks=None, tracer=None):
         """
         :param (_IPAddress, Failure) -> None lost_cb: Tcp connection lost cb func
+        :param bool method_ids: see BaseChannel
+        :param int max_in_flight: see BaseChannel
+        :param compression.Compression compression: see BaseChannel
+        :param metrics.Registry metrics: see BaseChannel
+        :param hooks.Hooks hooks: see BaseChannel
+        :param tracing.Tracer tracer: see BaseChannel
         :return:
         """
         self._lost_cb = lost_cb
-        super(TcpChannel, self).__init__()
+        self._coalescer = ResponseCoalescer(
+            self.sendString, lambda flush: reactor.callLater(0, flush),
+            self.coalesce_count, self.coalesce_bytes)
+        super(TcpChannel, self).__init__(method_ids, max_in_flight,
+                                         compression, metrics, hooks,
+                                         tracer)
 
-    def CallMethod(self, methodDescriptor, rpcController, request,
-                   responseClass, done):
-        rpc = self._call_method(methodDescriptor, rpcController, request,
-                                responseClass, done)
+    def send_rpc(self, rpc):
         self.sendString(rpc.SerializeToString())
 
+    def connectionMade(self):
+        # Only where requests are served: a client pausing as its requests
+        # pile up would stop reading the responses that relieve them.
+        if self._methods:
+            self.transport.registerProducer(self, True)
+
     def stringReceived(self, data):
-        rpc = Rpc()
-        rpc.ParseFromString(data)
+        received = None
+        if self.metrics is not None or self.hooks is not None:
+            received = time.time()
+        # Twisted hands over bytes of its own: payloads may stay views of
+        # them for as long as needed.
+        requests, responses = decode_rpc(data, views=True)
+
+        for serializedRequest in requests:
+            if self._served:
+                stream = self._served.get(serializedRequest.id)
+                if stream is not None:
+                    stream.received(serializedRequest)
+                    continue
+            entry = lookup_method(self._methods, self._method_bindings,
+                                  serializedRequest)
+            controller = Controller(peer=self.transport.getPeer())
+            if entry is None:
+                if not serializedRequest.method and \
+                        not serializedRequest.method_id and \
+                        serves_streams(self._methods):
+                    # The last messages of a stream that has ended.
+                    continue
+                code = dispatch_error(self._services,
+                                      serializedRequest.method)
+                self.reject(serializedRequest, controller, code)
+                self.sendError(serializedRequest.id, code)
+                continue
+
+            controller.deadline = request_deadline(serializedRequest)
+            if entry.streaming:
+                self.serve_stream(entry, serializedRequest, controller)
+                continue
+            d = self.dispatch(entry, serializedRequest, controller, received)
+            d.addCallback(self._coalescer.add)
+
+        for serializedResponse in responses:
+            self.response_received(serializedResponse)
 
-        for serializedRequest in rpc.request:
-            service = self._services[serializedRequest.method.split('.')[0]]
-            if not service:
-                self.sendError(serializedRequest.id,
-                               RpcErrors.SERVICE_NOT_FOUND)
+    def sendError(self, id, code, text=None):
+        self._coalescer.add(ResponseRecord(
+            id=id, error=ErrorRecord(code=code,
+                                     text=text or RpcErrors.msgs[code])))
+
+    def serve_stream(self, entry, serializedRequest, controller):
+        """Run a streaming method, see the streaming module."""
+        _id = serializedRequest.id
+        service, method, request_class = entry[:3]
+        controller.trace = extract(serializedRequest)
+
+        def failed(failure):
+            self._served.pop(_id, None)
+            self.sendError(_id, RpcErrors.METHOD_ERROR,
+                           failure.getErrorMessage())
+
+        with activate(controller.trace):
+            if entry.streaming == streaming.CLIENT:
+                requests = self._served[_id] = RequestStream(
+                    self, _id, request_class)
+                d = Deferred()
+                d.addCallback(self._upload_served, _id, controller)
+                d.addErrback(failed)
+                try:
+                    result = service.CallMethod(method, controller,
+                                                requests, d.callback)
+                except Exception:
+                    failed(Failure())
+                    return
+                # As returned by handlers running as inlineCallbacks.
+                if isinstance(result, Deferred):
+                    result.addErrback(failed)
                 return
 
-            method = service.GetDescriptor().FindMethodByName(
-                serializedRequest.method.split('.')[1])
-            if not method:
-                self.sendError(serializedRequest.id, RpcErrors.METHOD_NOT_FOUND)
+            request = request_class()
+            try:
+                request.ParseFromString(serializedRequest.serialized_request)
+            except Exception:
+                code = RpcErrors.CANNOT_DESERIALIZE_REQUEST
+                self.reject(serializedRequest, controller, code, entry)
+                self.sendError(_id, code)
+                return
+            try:
+                responses = service.CallMethod(method, controller, request,
+                                               lambda response: None)
+            except Exception:
+                failed(Failure())
                 return
 
-            request = service.GetRequestClass(method)()
-            request.ParseFromString(serializedRequest.serialized_request)
-            controller = Controller(peer=self.transport.getPeer())
-            d = Deferred()
-            d.addCallback(self.serialize_response, serializedRequest,
-                          controller)
-            d.addCallback(self.serialize_rpc)
-            d.addCallback(lambda rpc: self.sendString(rpc.SerializeToString()))
-            service.CallMethod(method, controller, request, d.callback)
+        def send(response):
+            self._coalescer.add(ResponseRecord(
+                id=_id, serialized_response=response.SerializeToString()))
+
+        def end():
+            self._served.pop(_id, None)
+            if controller.Failed():
+                self.sendError(_id, RpcErrors.METHOD_ERROR,
+                               controller.ErrorText())
+            else:
+                self._coalescer.add(ResponseRecord(id=_id,
+                                                   end_of_stream=True))
+
+        pump = self._served[_id] = _Pump(
+            responses or (), send, end, failed,
+            serializedRequest.window or INITIAL_WINDOW,
+            lambda: self._served.pop(_id, None))
+        pump.resume()
 
-        for serializedResponse in rpc.response:
-            _id = serializedResponse.id
-            if _id in self._pending:
-                self._pending[_id].callback(serializedResponse)
+    def _upload_served(self, response, _id, controller):
+        self._served.pop(_id, None)
+        if controller.Failed():
+            self.sendError(_id, RpcErrors.METHOD_ERROR,
+                           controller.ErrorText())
+        else:
+            self._coalescer.add(ResponseRecord(
+                id=_id, serialized_response=response.SerializeToString()))
 
-    def sendError(self, id, code):
+    def _open_stream(self, methodDescriptor, rpcController):
+        """
+        The Rpc frame opening a stream, and the stream's id.
+
+        :raises RPCException: if the call cannot be made
+        """
+        if self._lost is not None:
+            raise self._lost
+        if rpcController.IsCancelled():
+            raise RPCException("Cancelled")
+        self.id += 1
         rpc = Rpc()
-        rpcResponse = rpc.response.add()
-        rpcResponse.id = id
-        rpcResponse.error.code = code
-        rpcResponse.error.text = RpcErrors.msgs[code]
-        self.sendString(rpc.SerializeToString())
+        rpcRequest = rpc.request.add()
+        methodName = methodDescriptor.containing_service.name + '.' + \
+            methodDescriptor.name
+        if self._method_ids is not None:
+            self._method_ids.fill(rpcRequest, methodName)
+        else:
+            rpcRequest.method = methodName
+        rpcRequest.id = self.id
+        inject(rpcRequest, rpcController.trace or current())
+        if not set_timeout(rpcRequest, rpcController):
+            raise RPCException(RpcErrors.msgs[RpcErrors.DEADLINE_EXCEEDED])
+        if rpcController.deadline is not None:
+            self._timers.add(self.id, rpcController.deadline)
+            self._schedule_expiry()
+        _id = self.id
+        rpcController.NotifyOnCancel(
+            lambda: self._fail_call(_id, RPCException("Cancelled")))
+        return rpc, _id
+
+    def call_stream(self, methodDescriptor, rpcController, request,
+                    responseClass, window=INITIAL_WINDOW):
+        """
+        Call a server-streaming method.
+
+        :param int window: responses the server may send ahead of those
+            read
+        :rtype: ResponseStream
+        :raises RPCException: if the call cannot be made
+        """
+        rpc, _id = self._open_stream(methodDescriptor, rpcController)
+        rpc.request[0].serialized_request = request.SerializeToString()
+        rpc.request[0].window = window
+        stream = self._streams[_id] = ResponseStream(self, _id,
+                                                     responseClass, window)
+        self.send_rpc(rpc)
+        return stream
+
+    def call_upload(self, methodDescriptor, rpcController, requests,
+                    responseClass):
+        """
+        Call a client-streaming method with the requests ``requests``
+        iterates over, or Deferreds firing with them, sent as the server
+        grants credit for them.
+
+        :rtype: Deferred firing with the response
+        """
+        d = Deferred()
+        d.addCallback(self.unserialize_response, responseClass, rpcController)
+        try:
+            rpc, _id = self._open_stream(methodDescriptor, rpcController)
+        except RPCException as e:
+            d.errback(e)
+            return d
+        upload = self._streams[_id] = _Upload(self, _id, requests, d)
+        self.send_rpc(rpc)
+        upload.pump.resume()
+        return d
 
     def connectionLost(self, reason=connectionDone):
+        self._fail_pending(RPCException("connection lost"))
         if self._lost_cb is not None:
             addr = self.transport.getPeer()
             self._lost_cb(addr, reason)
 
 
 class UdpChannel(BaseChannel, DatagramProtocol):
-    def __init__(self, host=None, port=None):
+    def __init__(self, host=None, port=None, metrics=None, hooks=None,
+                 tracer=None):
         self._host = host
         self._port = port
         self.connected = False
-        BaseChannel.__init__(self)
+        BaseChannel.__init__(self, metrics=metrics, hooks=hooks,
+                             tracer=tracer)
 
     def startProtocol(self):
         if self._host and self._port:
@@ -191,37 +1016,32 @@ class UdpChannel(BaseChannel, DatagramProtocol):
             self.connected = True
 
     def datagramReceived(self, data, (host, port)):
-        rpc = Rpc()
-        rpc.ParseFromString(data)
-        for serializedRequest in rpc.request:
-            service = self._services[serializedRequest.method.split('.')[0]]
-
-            if not service:
-                self.sendError(serializedRequest.id,
-                               RpcErrors.SERVICE_NOT_FOUND, host, port)
-                return
-
-            method = service.GetDescriptor().FindMethodByName(
-                serializedRequest.method.split('.')[1])
-            if not method:
-                self.sendError(serializedRequest.id,
-                               RpcErrors.METHOD_NOT_FOUND, host, port)
-                return
+        received = None
+        if self.metrics is not None or self.hooks is not None:
+            received = time.time()
+        requests, responses = decode_rpc(data, views=True)
+        for serializedRequest in requests:
+            # Without a connection there is nothing to bind method ids to.
+            entry = lookup_method(self._methods, None, serializedRequest)
+            controller = Controller(peer=(host, port))
+            if entry is None:
+                code = dispatch_error(self._services,
+                                      serializedRequest.method)
+                self.reject(serializedRequest, controller, code)
+                self.sendError(serializedRequest.id, code, host, port)
+                continue
+            if entry.streaming:
+                self.sendError(serializedRequest.id, RpcErrors.METHOD_ERROR,
+                               host, port, "Streams need a connection")
+                continue
 
-            request = service.GetRequestClass(method)()
-            request.ParseFromString(serializedRequest.serialized_request)
-            controller = Controller()
-            d = Deferred()
-            d.addCallback(self.serialize_response, serializedRequest)
+            controller.deadline = request_deadline(serializedRequest)
+            d = self.dispatch(entry, serializedRequest, controller, received)
             d.addCallback(self.serialize_rpc)
-            d.addCallback(lambda rpc: self.send_string(rpc.SerializeToString(),
-                                                       host, port))
-            service.CallMethod(method, controller, request, d.callback)
+            d.addCallback(self.send_string, host, port)
 
-        for serializedResponse in rpc.response:
-            id = serializedResponse.id
-            if self._pending.has_key(id):
-                self._pending[id].callback(serializedResponse)
+        for serializedResponse in responses:
+            self.response_received(serializedResponse)
 
     def send_string(self, data, host=None, port=None):
         if host and port:
@@ -229,39 +1049,52 @@ class UdpChannel(BaseChannel, DatagramProtocol):
         else:
             self.transport.write(data)
 
-    def CallMethod(self, methodDescriptor, rpcController, request,
-                   responseClass, done):
-        rpc = self._call_method(methodDescriptor, request, responseClass, done)
+    def send_rpc(self, rpc):
         self.send_string(rpc.SerializeToString())
 
-    def sendError(self, id, code, host, port):
-        rpc = Rpc()
-        rpcResponse = rpc.response.add()
-        rpcResponse.id = id
-        rpcResponse.error.code = code
-        rpcResponse.error.text = RpcErrors.msgs[code]
-        self.sendString(rpc.SerializeToString(), host, port)
+    def sendError(self, id, code, host, port, text=None):
+        rpcResponse = ResponseRecord(
+            id=id, error=ErrorRecord(code=code,
+                                     text=text or RpcErrors.msgs[code]))
+        self.send_string(self.serialize_rpc(rpcResponse), host, port)
 
 
 class Factory(twisted.internet.protocol.Factory):
     protocol = TcpChannel
 
-    def __init__(self, services, conn_lost_cb=None):
+    def __init__(self, services, conn_lost_cb=None, compression=None,
+                 metrics=None, hooks=None, tracer=None):
         """
         :param (_IPAddress, ProtocolWrapper) -> None conn_lost_cb: connection lost cb func
+        :param compression.Compression compression: default compression of
+            the responses, see the compression module
+        :param metrics.Registry metrics: records the calls served
+        :param hooks.Hooks hooks: told about the requests served
+        :param tracing.Tracer tracer: records the calls served
         :return:
         """
         self._conn_lost_cb = conn_lost_cb
+        self._compression = compression
+        self.metrics = metrics
+        self.hooks = hooks
+        self.tracer = tracer
         self._protocols = {}
         """:type _protocols: dict[ProtocolWrapper, _IPAddress]"""
         self._services = {}
+        self._methods = {}
         for s in services:
             self._services[s.GetDescriptor().name] = s
+            index_service(self._methods, s)
 
     def buildProtocol(self, addr):
-        p = ProtocolWrapper(self, self.protocol())
-        p._services = self._services
-        return p
+        protocol = self.protocol()
+        protocol._services = self._services
+        protocol._methods = self._methods
+        protocol.compression = self._compression
+        protocol.metrics = self.metrics
+        protocol.hooks = self.hooks
+        protocol.tracer = self.tracer
+        return ProtocolWrapper(self, protocol)
 
     def registerProtocol(self, p):
         """
@@ -294,23 +1127,107 @@ class Factory(twisted.internet.protocol.Factory):
 
 
 class Proxy(object):
+    """
+    Call methods of ``stubs`` as ``proxy.Service.Method(request)``. The
+    ``timeout`` keyword, in seconds, bounds every call; a call may pass
+    its own ``timeout`` instead.
+
+    With a ``cache`` (a cache.Cache), responses to the methods named in
+    ``cached``, or to every method when it is None, are served from it;
+    see the cache module. Calls joining one already in flight share its
+    timeout.
+
+    ``streaming`` maps the "Service.Method" names of streaming methods to
+    how they stream (streaming.SERVER or streaming.CLIENT). Calls to a
+    server-streaming method return a ResponseStream; calls to a
+    client-streaming one take an iterable of requests, or of Deferreds
+    firing with them. See the streaming module.
+    """
+
     class _Proxy(object):
-        def __init__(self, stub):
+        def __init__(self, stub, timeout=None, cache=None, cached=None,
+                     streaming=None):
             self._stub = stub
+            self._name = stub.GetDescriptor().name
+            self._timeout = timeout
+            self._cache = cache
+            self._cached = cached
+            self._streaming = streaming or {}
 
         def __getattr__(self, key):
-            def call(method, request):
+            def call(method, request, timeout):
                 d = Deferred()
-                controller = Controller()
+                controller = Controller(timeout=timeout)
                 method(controller, request, d)
                 return d
 
-            return lambda request: call(getattr(self._stub, key), request)
+            method = getattr(self._stub, key)
+            name = self._name + '.' + key
+            kind = self._streaming.get(name)
+            if kind is not None:
+                return lambda request, timeout=self._timeout: \
+                    self._streamed_call(kind, key, request, timeout)
+            if self._cache is not None and caches_method(self._cached, name):
+                return lambda request, timeout=self._timeout: \
+                    self._cached_call(name, call, method, request, timeout)
+            return lambda request, timeout=self._timeout: call(
+                method, request, timeout)
+
+        def _streamed_call(self, kind, key, request, timeout):
+            channel = self._stub.rpc_channel
+            method = self._stub.GetDescriptor().FindMethodByName(key)
+            responseClass = self._stub.GetResponseClass(method)
+            controller = Controller(timeout=timeout)
+            if kind == streaming.SERVER:
+                return channel.call_stream(method, controller, request,
+                                           responseClass)
+            return channel.call_upload(method, controller, request,
+                                       responseClass)
+
+        def _cached_call(self, name, call, method, request, timeout):
+            cache = self._cache
+            serialized = request.SerializeToString()
+            key = (name, serialized)
+            response = cache.get(key)
+            if response is not None:
+                return succeed(copy_message(response))
+
+            waiters = cache.in_flight.get(key)
+            if waiters is not None:
+                d = Deferred()
+                waiters.append(d)
+                return d
+
+            waiters = cache.in_flight[key] = []
+
+            def done(result):
+                del cache.in_flight[key]
+                if isinstance(result, Failure):
+                    for d in waiters:
+                        d.errback(result)
+                    return result
+                if result is not None:
+                    cache.put(key, copy_message(result),
+                              len(serialized) + result.ByteSize())
+                for d in waiters:
+                    d.callback(result and copy_message(result))
+                return result
+
+            d = call(method, request, timeout)
+            d.addBoth(done)
+            return d
 
-    def __init__(self, *stubs):
+    def __init__(self, *stubs, **options):
+        timeout = options.pop("timeout", None)
+        cache = options.pop("cache", None)
+        cached = options.pop("cached", None)
+        streaming = options.pop("streaming", None)
+        if options:
+            raise TypeError("unexpected options %s" % ", ".join(options))
         self._stubs = {}
         for s in stubs:
-            self._stubs[s.GetDescriptor().name] = self._Proxy(s)
+            self._stubs[s.GetDescriptor().name] = self._Proxy(
+                s, timeout, cache, cached, streaming)
 
     def __getattr__(self, key):
         return self._stubs[key]
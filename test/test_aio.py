@@ -0,0 +1,97 @@
+"""Tests of the asyncio backend, which needs Python 3."""
+
+from twisted.trial import unittest
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+else:
+    from protobufrpc import aio
+
+from protobufrpc.common import THREAD, execution
+from test_suite_pb2 import Test, Test_Stub, EchoRequest, EchoResponse
+
+
+class AioTestService(Test):
+    def Echo(self, rpc_controller, request, done):
+        if request.text == "fail":
+            raise ValueError("failed on purpose")
+        response = EchoResponse()
+        response.text = request.text
+        # Answer from a later turn of the loop, as most handlers do.
+        asyncio.get_event_loop().call_soon(done, response)
+
+
+class OffloadedTestService(Test):
+    @execution(THREAD)
+    def Echo(self, rpc_controller, request, done):
+        response = EchoResponse()
+        if request.text != "unset":
+            response.text = request.text
+        # Without its required text, the response cannot be serialized in
+        # the executor.
+        done(response)
+
+
+class AioTestCase(unittest.TestCase):
+    if asyncio is None:
+        skip = "asyncio needs Python 3"
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.server = None
+        self.channel = None
+
+    def tearDown(self):
+        if self.channel is not None:
+            self.channel.close()
+        if self.server is not None:
+            self.server.close()
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def _proxy(self, service):
+        self.server = aio.TcpServer([service])
+        self.loop.run_until_complete(self.server.start("127.0.0.1", 0))
+        port = self.server.server.sockets[0].getsockname()[1]
+        self.channel = aio.TcpChannel()
+        self.loop.run_until_complete(self.channel.connect("127.0.0.1", port))
+        return aio.Proxy(Test_Stub(self.channel))
+
+    def _echo(self, proxy, *texts):
+        calls = []
+        for text in texts:
+            request = EchoRequest()
+            request.text = text
+            calls.append(proxy.Test.Echo(request))
+        return self.loop.run_until_complete(
+            asyncio.gather(*calls, return_exceptions=True))
+
+    def testRpc(self):
+        proxy = self._proxy(AioTestService())
+        texts = ["one", "two", "three"]
+        responses = self._echo(proxy, *texts)
+        self.assertEqual([r.text for r in responses], texts)
+        self.assertEqual(self.channel.in_flight, 0)
+
+    def testError(self):
+        proxy = self._proxy(AioTestService())
+        failed, answered = self._echo(proxy, "fail", "after")
+        self.assertIsInstance(failed, aio.RPCException)
+        self.assertEqual(str(failed), "ValueError: failed on purpose")
+        self.assertEqual(answered.text, "after")
+
+    def testOffloaded(self):
+        proxy = self._proxy(OffloadedTestService())
+        response, = self._echo(proxy, "offloaded")
+        self.assertEqual(response.text, "offloaded")
+
+    def testOffloadedFailure(self):
+        proxy = self._proxy(OffloadedTestService())
+        failed, answered = self._echo(proxy, "unset", "after")
+        self.assertIsInstance(failed, aio.RPCException)
+        self.assertTrue(str(failed).startswith("EncodeError"), str(failed))
+        self.assertEqual(answered.text, "after")
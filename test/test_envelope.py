@@ -0,0 +1,103 @@
+from google.protobuf.message import DecodeError
+from twisted.trial import unittest
+from protobufrpc import envelope
+from protobufrpc.envelope import ErrorRecord, ResponseRecord, decode_rpc, \
+    payload_bytes
+from protobufrpc.protobufrpc_pb2 import Rpc
+from test_suite_pb2 import EchoRequest
+
+
+class EnvelopeTestCase(unittest.TestCase):
+    def setUp(self):
+        # Decode by hand whatever the protobuf backend.
+        self.patch(envelope, "NATIVE", False)
+
+    def testEncodeMatchesProtobuf(self):
+        records = [
+            ResponseRecord(id=1, serialized_response="x" * 300),
+            ResponseRecord(id=2 ** 32 - 1, serialized_response="",
+                           method_id=7, compression=1,
+                           accept_compression=6, span_id=2 ** 64 - 1),
+            ResponseRecord(id=3, error=ErrorRecord(code=5, text=u"\xe9t\xe9")),
+            ResponseRecord(id=4, window=16),
+            ResponseRecord(id=5, end_of_stream=True),
+        ]
+        rpc = Rpc()
+        response = rpc.response.add()
+        response.id = 1
+        response.serialized_response = "x" * 300
+        response = rpc.response.add()
+        response.id = 2 ** 32 - 1
+        response.serialized_response = ""
+        response.method_id = 7
+        response.compression = 1
+        response.accept_compression = 6
+        response.span_id = 2 ** 64 - 1
+        response = rpc.response.add()
+        response.id = 3
+        response.error.code = 5
+        response.error.text = u"\xe9t\xe9"
+        rpc.response.add(id=4, window=16)
+        rpc.response.add(id=5, end_of_stream=True)
+        self.assertEquals("".join(r.encode() for r in records),
+                          rpc.SerializeToString())
+
+    def testDecode(self):
+        rpc = Rpc()
+        request = rpc.request.add()
+        request.method = "Test.Echo"
+        request.serialized_request = "payload"
+        request.id = 4
+        request.trace_id = "t" * 16
+        request.sampled = True
+        response = rpc.response.add()
+        response.id = 5
+        response.error.code = 2
+        response.error.text = "Service not found"
+        data = rpc.SerializeToString()
+
+        for frame in (data, memoryview(data)):
+            (request,), (response,) = decode_rpc(frame)
+            self.assertEquals(request.method, "Test.Echo")
+            self.assertEquals(request.serialized_request, "payload")
+            self.assertEquals(request.id, 4)
+            self.assertEquals(request.trace_id, "t" * 16)
+            self.assertTrue(request.sampled)
+            self.assertFalse(request.HasField("timeout_ms"))
+            self.assertEquals(request.timeout_ms, 0)
+            self.assertTrue(response.HasField("error"))
+            self.assertEquals(response.error.code, 2)
+            self.assertEquals(response.error.text, "Service not found")
+
+    def testRoundTrip(self):
+        record = ResponseRecord(id=9, serialized_response="\x00\xff" * 100,
+                                span_id=3)
+        _, (decoded,) = decode_rpc(record.encode())
+        self.assertEquals(decoded.id, 9)
+        self.assertEquals(decoded.serialized_response, "\x00\xff" * 100)
+        self.assertEquals(decoded.span_id, 3)
+        self.assertFalse(decoded.HasField("error"))
+        self.assertEquals(decoded.error.code, 0)
+
+    def testTruncated(self):
+        data = ResponseRecord(id=1, serialized_response="abc").encode()
+        for end in range(1, len(data)):
+            self.assertRaises(DecodeError, decode_rpc, data[:end])
+
+    def testViews(self):
+        request = EchoRequest()
+        request.text = "x" * envelope.VIEW_THRESHOLD
+        rpc = Rpc()
+        rpc.request.add(id=1, serialized_request=request.SerializeToString())
+        rpc.request.add(id=2, serialized_request="small")
+        data = rpc.SerializeToString()
+
+        (large, small), _ = decode_rpc(data, views=True)
+        if envelope.PARSES_VIEWS:
+            self.assertIsInstance(large.serialized_request, memoryview)
+        self.assertEquals(small.serialized_request, "small")
+        self.assertEquals(payload_bytes(large.serialized_request),
+                          request.SerializeToString())
+        parsed = EchoRequest()
+        parsed.ParseFromString(large.serialized_request)
+        self.assertEquals(parsed, request)
@@ -0,0 +1,44 @@
+from twisted.trial import unittest
+from protobufrpc.framing import FrameReader, FrameTooLarge, HEADER
+
+
+class ChunkedSocket(object):
+    """Hands out the given data a few bytes per recv_into call."""
+
+    def __init__(self, data, chunk):
+        self.data = data
+        self.chunk = chunk
+
+    def recv_into(self, buffer):
+        n = min(self.chunk, len(buffer), len(self.data))
+        buffer[:n] = self.data[:n]
+        self.data = self.data[n:]
+        return n
+
+
+def frame(payload):
+    return HEADER.pack(len(payload)) + payload
+
+
+class FrameReaderTestCase(unittest.TestCase):
+    def readAll(self, sock, reader):
+        frames = []
+        while reader.read(sock, lambda view: frames.append(view.tobytes())):
+            pass
+        return frames
+
+    def testPartialReads(self):
+        payloads = ["a", "", "b" * 300, "c" * 17]
+        sock = ChunkedSocket("".join(frame(p) for p in payloads), 7)
+        self.assertEquals(self.readAll(sock, FrameReader(size=16)), payloads)
+
+    def testFrameLargerThanBuffer(self):
+        payload = "x" * 10000
+        sock = ChunkedSocket(frame(payload) + frame("y"), 4096)
+        self.assertEquals(self.readAll(sock, FrameReader(size=64)),
+                          [payload, "y"])
+
+    def testMaxFrameSize(self):
+        sock = ChunkedSocket(frame("z" * 100), 1024)
+        reader = FrameReader(max_frame_size=10)
+        self.assertRaises(FrameTooLarge, self.readAll, sock, reader)
@@ -0,0 +1,44 @@
+from twisted.trial import unittest
+from protobufrpc.common import RpcErrors
+from protobufrpc.metrics import SERVER, Histogram, Registry
+
+
+class HistogramTestCase(unittest.TestCase):
+    def testPercentiles(self):
+        histogram = Histogram()
+        for micros in range(1, 1001):
+            histogram.record(micros / 1e6)
+        self.assertEquals(histogram.count, 1000)
+        for q in (50, 90, 99):
+            # Within the 12.5% a bucket spans.
+            self.assertApproximates(histogram.percentile(q), q / 1e5,
+                                    q / 1e5 * 0.125)
+        self.assertEquals(histogram.percentile(100), 0.001)
+
+    def testBucketBounds(self):
+        histogram = Histogram()
+        for micros in (15, 16, 17, 31, 32):
+            histogram.record(micros / 1e6)
+        self.assertEquals([count for _, count in histogram.buckets()],
+                          [1, 2, 1, 1])
+
+
+class RegistryTestCase(unittest.TestCase):
+    def testPrometheus(self):
+        registry = Registry()
+        call = registry.start(SERVER, "Test.Echo")
+        call.lap("handler")
+        call.finish(RpcErrors.METHOD_ERROR)
+        call.finish()
+        registry.rejected(SERVER, "Test.Echo", RpcErrors.OVERLOADED)
+        text = registry.prometheus()
+        labels = 'side="server",method="Test.Echo"'
+        self.assertIn('protobufrpc_calls_total{%s} 2' % labels, text)
+        self.assertIn('protobufrpc_in_flight{%s} 0' % labels, text)
+        self.assertIn('protobufrpc_errors_total{%s,code="OVERLOADED"} 1'
+                      % labels, text)
+        self.assertIn('protobufrpc_handler_seconds_count{%s} 1' % labels,
+                      text)
+        snapshot = registry.snapshot()[SERVER]["Test.Echo"]
+        self.assertEquals(snapshot["errors"], {RpcErrors.METHOD_ERROR: 1,
+                                               RpcErrors.OVERLOADED: 1})
@@ -18,26 +18,128 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import struct
+import threading
 from protobufrpc import tx
+from protobufrpc.cache import Cache, memoized
+from protobufrpc.common import THREAD, ResponseCoalescer, RpcErrors, execution
+from protobufrpc.compression import ZLIB, Compression
+from protobufrpc.hooks import Hooks
+from protobufrpc.metrics import CLIENT, SERVER, Registry
+from protobufrpc.envelope import decode_rpc
+from protobufrpc.protobufrpc_pb2 import Rpc
+from protobufrpc.streaming import CLIENT as CLIENT_STREAMING, \
+    INITIAL_WINDOW, SERVER as SERVER_STREAMING, client_streaming, \
+    server_streaming
+from protobufrpc.tracing import MemoryExporter, Tracer
 from twisted.trial import unittest
-from twisted.internet import reactor
+from twisted.internet import defer, reactor, task
 from twisted.internet.protocol import ClientCreator
+from twisted.test.proto_helpers import StringTransport
 from test_suite_pb2 import Test, Test_Stub, EchoRequest, EchoResponse
 
 
 class TestService(Test):
     def Echo(self, rpc_controller, request, done):
+        if request.text == "fail":
+            rpc_controller.SetFailed("failed on purpose")
+            done(None)
+            return
         response = EchoResponse()
         response.text = request.text
         done(response)
 
 
+class ThreadedTestService(Test):
+    @execution(THREAD)
+    def Echo(self, rpc_controller, request, done):
+        response = EchoResponse()
+        response.text = "%s from %s" % (request.text,
+                                        threading.current_thread().name)
+        done(response)
+
+
+class SilentTestService(Test):
+    def Echo(self, rpc_controller, request, done):
+        self.deadline = rpc_controller.deadline
+
+
+class MemoizedTestService(Test):
+    calls = 0
+
+    @memoized(Cache())
+    def Echo(self, rpc_controller, request, done):
+        self.calls += 1
+        response = EchoResponse()
+        response.text = request.text
+        reactor.callLater(0, done, response)
+
+
+class RelayTestService(Test):
+    """Echoes through another server, from within the handler."""
+
+    def __init__(self, proxy):
+        self.proxy = proxy
+
+    def Echo(self, rpc_controller, request, done):
+        self.proxy.Test.Echo(request).addCallback(done)
+
+
+class StreamingTestService(Test):
+    """Echoes the request's text one character at a time."""
+
+    produced = 0
+
+    @server_streaming
+    def Echo(self, rpc_controller, request, done):
+        for c in request.text:
+            self.produced += 1
+            response = EchoResponse()
+            response.text = c
+            yield response
+
+
+class UploadTestService(Test):
+    """Echoes the text of every request streamed, joined."""
+
+    @client_streaming
+    @defer.inlineCallbacks
+    def Echo(self, rpc_controller, requests, done):
+        texts = []
+        while True:
+            request = yield requests.get()
+            if request is None:
+                break
+            texts.append(request.text)
+        response = EchoResponse()
+        response.text = "".join(texts)
+        done(response)
+
+
+class RecordingHooks(Hooks):
+    def __init__(self, sample_rate=1.0):
+        Hooks.__init__(self, sample_rate)
+        self.seen = []
+
+    def on_request_start(self, event):
+        self.seen.append(("start", event.method))
+
+    def on_dispatch(self, event):
+        self.seen.append(("dispatch", event.method))
+
+    def on_response_sent(self, event):
+        self.seen.append(("sent", event.method))
+
+    def on_error(self, event):
+        self.seen.append(("error", event.error))
+
+
 class ServiceTestCase(unittest.TestCase):
     def setUp(self):
         self.service = TestService()
         self.udp_proto = tx.UdpChannel()
         self.udp_proto.add_service(self.service)
-        self.factory = tx.Factory(self.service)
+        self.factory = tx.Factory([self.service])
         self.tcp_listener = reactor.listenTCP(0, self.factory)
         self.udp_listener = reactor.listenUDP(0, self.udp_proto)
         self.udp_proxy_port = None
@@ -51,6 +153,33 @@ class ServiceTestCase(unittest.TestCase):
         self.tcp_listener.stopListening()
         self.udp_listener.stopListening()
 
+    def _connect(self, factory=None, **channel_options):
+        """
+        Connect a TcpChannel, made with ``channel_options``, to the test
+        server, after replacing it with one serving ``factory`` if given.
+
+        :rtype: Deferred firing with the connected TcpChannel
+        """
+        if factory is not None:
+            self.tcp_listener.stopListening()
+            self.tcp_listener = reactor.listenTCP(0, factory)
+        client = ClientCreator(reactor, tx.TcpChannel, **channel_options)
+        d = client.connectTCP(self.tcp_listener.getHost().host,
+                              self.tcp_listener.getHost().port)
+
+        def connected(protocol):
+            self.tcp_proxy_proto = protocol
+            return protocol
+        d.addCallback(connected)
+        return d
+
+    def _recordSent(self, protocol):
+        """:return: a list every frame ``protocol`` sends is appended to"""
+        sent = []
+        protocol.sendString = lambda data: (
+            sent.append(data), tx.TcpChannel.sendString(protocol, data))
+        return sent
+
     def testTcpRpc(self):
         def connected(protocol):
             self.tcp_proxy_proto = protocol
@@ -68,6 +197,376 @@ class ServiceTestCase(unittest.TestCase):
         d.addCallback(connected)
         return d
 
+    def testTcpBatch(self):
+        def connected(protocol):
+            proxy = tx.Proxy(Test_Stub(protocol))
+            texts = ["one", "two", "three"]
+            sent = self._recordSent(protocol)
+            with protocol.batch():
+                calls = []
+                for text in texts:
+                    request = EchoRequest()
+                    request.text = text
+                    calls.append(proxy.Test.Echo(request))
+            self.assertEquals(len(sent), 1)
+            d = defer.gatherResults(calls)
+            d.addCallback(lambda rs: self.assertEquals(
+                [r.text for r in rs], texts))
+            return d
+
+        d = self._connect()
+        d.addCallback(connected)
+        return d
+
+    def testTcpMethodIds(self):
+        def call(proxy, text):
+            request = EchoRequest()
+            request.text = text
+            d = proxy.Test.Echo(request)
+            d.addCallback(lambda r: self.assertEquals(r.text, text))
+            return d
+
+        def connected(protocol):
+            proxy = tx.Proxy(Test_Stub(protocol))
+            sent = self._recordSent(protocol)
+
+            def checkWire(_):
+                first, second = [Rpc.FromString(data).request[0]
+                                 for data in sent]
+                self.assertEquals(first.method, "Test.Echo")
+                self.assertFalse(second.HasField("method"))
+                self.assertEquals(second.method_id, first.method_id)
+
+            d = call(proxy, "bind")
+            d.addCallback(lambda _: call(proxy, "by id"))
+            d.addCallback(checkWire)
+            return d
+
+        d = self._connect(method_ids=True)
+        d.addCallback(connected)
+        return d
+
+    def testTcpCompression(self):
+        text = "compressible " * 100
+
+        def call(proxy):
+            request = EchoRequest()
+            request.text = text
+            d = proxy.Test.Echo(request)
+            d.addCallback(lambda r: self.assertEquals(r.text, text))
+            return d
+
+        def connected(protocol):
+            proxy = tx.Proxy(Test_Stub(protocol))
+            sent = self._recordSent(protocol)
+
+            def checkWire(_):
+                first, second = [Rpc.FromString(data).request[0]
+                                 for data in sent]
+                # Nothing is compressed before the server says it can cope.
+                self.assertEquals(first.compression, 0)
+                self.assertEquals(second.compression, ZLIB)
+                self.assertTrue(len(second.serialized_request) < len(text))
+
+            d = call(proxy)
+            d.addCallback(lambda _: call(proxy))
+            d.addCallback(checkWire)
+            return d
+
+        compression = Compression(codecs=[ZLIB], threshold=0)
+        d = self._connect(
+            tx.Factory([self.service], compression=compression),
+            compression=compression)
+        d.addCallback(connected)
+        return d
+
+    def testTcpDecompressionBound(self):
+        request = EchoRequest()
+        request.text = "compressible " * 100
+
+        def connected(protocol):
+            proxy = tx.Proxy(Test_Stub(protocol))
+            # The first request goes uncompressed, the second inflates
+            # beyond what the server accepts.
+            d = proxy.Test.Echo(request)
+            d.addCallback(lambda _: self.assertFailure(
+                proxy.Test.Echo(request), tx.RPCException))
+            d.addCallback(lambda e: self.assertEquals(
+                str(e), RpcErrors.msgs[RpcErrors.CANNOT_DESERIALIZE_REQUEST]))
+            return d
+
+        d = self._connect(
+            tx.Factory([self.service],
+                       compression=Compression(codecs=[ZLIB], max_size=100)),
+            compression=Compression(codecs=[ZLIB], threshold=0))
+        d.addCallback(connected)
+        return d
+
+    def testTcpCachedProxy(self):
+        def connected(protocol):
+            cache = Cache(ttl=60)
+            proxy = tx.Proxy(Test_Stub(protocol), cache=cache)
+            sent = self._recordSent(protocol)
+            request = EchoRequest()
+            request.text = "cached"
+            # The second call joins the first one in flight.
+            calls = [proxy.Test.Echo(request), proxy.Test.Echo(request)]
+            self.assertEquals(len(sent), 1)
+            d = defer.gatherResults(calls)
+            d.addCallback(lambda rs: self.assertEquals(
+                [r.text for r in rs], ["cached", "cached"]))
+            d.addCallback(lambda _: proxy.Test.Echo(request))
+            d.addCallback(lambda r: self.assertEquals(r.text, "cached"))
+            d.addCallback(lambda _: self.assertEquals(len(sent), 1))
+            d.addCallback(lambda _: self.assertEquals(cache.hits, 1))
+            return d
+
+        d = self._connect()
+        d.addCallback(connected)
+        return d
+
+    def testTcpMemoizedMethod(self):
+        service = MemoizedTestService()
+
+        def connected(protocol):
+            proxy = tx.Proxy(Test_Stub(protocol))
+            request = EchoRequest()
+            request.text = "memoized"
+            with protocol.batch():
+                calls = [proxy.Test.Echo(request), proxy.Test.Echo(request)]
+            d = defer.gatherResults(calls)
+            d.addCallback(lambda _: proxy.Test.Echo(request))
+            d.addCallback(lambda r: self.assertEquals(r.text, "memoized"))
+            d.addCallback(lambda _: self.assertEquals(service.calls, 1))
+            return d
+
+        d = self._connect(tx.Factory([service]))
+        d.addCallback(connected)
+        return d
+
+    def testTcpMetrics(self):
+        metrics = Registry()
+
+        def connected(protocol):
+            proxy = tx.Proxy(Test_Stub(protocol))
+            request = EchoRequest()
+            request.text = "measured"
+            d = proxy.Test.Echo(request)
+            failing = EchoRequest()
+            failing.text = "fail"
+            d.addCallback(lambda _: self.assertFailure(
+                proxy.Test.Echo(failing), tx.RPCException))
+
+            def check(_):
+                snapshot = metrics.snapshot()
+                for side in (CLIENT, SERVER):
+                    echo = snapshot[side]["Test.Echo"]
+                    self.assertEquals(echo["calls"], 2)
+                    self.assertEquals(echo["in_flight"], 0)
+                    self.assertEquals(echo["latency"]["count"], 2)
+                    self.assertEquals(echo["errors"],
+                                      {RpcErrors.METHOD_ERROR: 1})
+                self.assertEquals(snapshot[SERVER]["Test.Echo"]
+                                  ["bytes_received"],
+                                  request.ByteSize() + failing.ByteSize())
+
+            d.addCallback(check)
+            return d
+
+        d = self._connect(tx.Factory([self.service], metrics=metrics),
+                          metrics=metrics)
+        d.addCallback(connected)
+        return d
+
+    def testTcpHooks(self):
+        hooks = RecordingHooks()
+        unsampled = RecordingHooks(sample_rate=0)
+
+        def connected(protocol):
+            proxy = tx.Proxy(Test_Stub(protocol))
+            request = EchoRequest()
+            request.text = "hooked"
+            d = proxy.Test.Echo(request)
+            d.addCallback(lambda _: self.assertEquals(hooks.seen, [
+                ("start", "Test.Echo"), ("dispatch", "Test.Echo"),
+                ("sent", "Test.Echo")]))
+            return d
+
+        self.udp_proto.hooks = unsampled
+        d = self._connect(tx.Factory([self.service], hooks=hooks))
+        d.addCallback(connected)
+        d.addCallback(lambda _: self.testUdpRpc())
+        d.addCallback(lambda _: self.assertEquals(unsampled.seen, []))
+        return d
+
+    def testTcpTracing(self):
+        exporter = MemoryExporter()
+        tracer = Tracer(exporter)
+        backend = reactor.listenTCP(0, tx.Factory([self.service],
+                                                  tracer=tracer))
+        self.addCleanup(backend.stopListening)
+
+        def check(_):
+            relay, echo = exporter.spans[1], exporter.spans[0]
+            self.assertEquals([relay.name, echo.name],
+                              ["Test.Echo", "Test.Echo"])
+            self.assertEquals(relay.parent_id, None)
+            self.assertEquals(echo.parent_id, relay.context.span_id)
+            self.assertEquals(echo.context.trace_id, relay.context.trace_id)
+
+        def connected(protocols):
+            backend_protocol, protocol = protocols
+            self.addCleanup(backend_protocol.transport.loseConnection)
+            request = EchoRequest()
+            request.text = "traced"
+            d = tx.Proxy(Test_Stub(protocol)).Test.Echo(request)
+            d.addCallback(check)
+            return d
+
+        relay = RelayTestService(None)
+        client = ClientCreator(reactor, tx.TcpChannel)
+        d1 = client.connectTCP(backend.getHost().host,
+                               backend.getHost().port)
+        d1.addCallback(lambda p: setattr(
+            relay, "proxy", tx.Proxy(Test_Stub(p))) or p)
+        d2 = self._connect(tx.Factory([relay], tracer=tracer))
+        d = defer.gatherResults([d1, d2])
+        d.addCallback(connected)
+        return d
+
+    def testTcpThreadedMethod(self):
+        def connected(protocol):
+            request = EchoRequest()
+            request.text = "threaded"
+            proxy = tx.Proxy(Test_Stub(protocol))
+            echoed = proxy.Test.Echo(request)
+            echoed.addCallback(lambda r: self.assertNotEquals(
+                r.text, "threaded from MainThread"))
+            return echoed
+
+        d = self._connect(tx.Factory([ThreadedTestService()]))
+        d.addCallback(connected)
+        return d
+
+    def testTcpMaxInFlight(self):
+        def connected(protocol):
+            proxy = tx.Proxy(Test_Stub(protocol))
+            texts = ["one", "two", "three"]
+            sent = self._recordSent(protocol)
+            calls = []
+            for text in texts:
+                request = EchoRequest()
+                request.text = text
+                calls.append(proxy.Test.Echo(request))
+            self.assertEquals(len(sent), 1)
+            self.assertEquals(protocol.pending_stats()["waiting"], 2)
+            d = defer.gatherResults(calls)
+            d.addCallback(lambda rs: self.assertEquals(
+                [r.text for r in rs], texts))
+            d.addCallback(lambda _: self.assertEquals(
+                protocol.pending_stats()["size"], 0))
+            return d
+
+        d = self._connect(max_in_flight=1)
+        d.addCallback(connected)
+        return d
+
+    def testTcpDeadline(self):
+        service = SilentTestService()
+
+        def connected(protocol):
+            request = EchoRequest()
+            request.text = "never answered"
+            proxy = tx.Proxy(Test_Stub(protocol), timeout=0.05)
+            d = self.assertFailure(proxy.Test.Echo(request), tx.RPCException)
+            d.addCallback(lambda e: self.assertEquals(str(e),
+                                                      "Deadline exceeded"))
+            d.addCallback(lambda _: self.assertEquals(protocol.in_flight, 0))
+            d.addCallback(lambda _: self.assertNotEquals(service.deadline,
+                                                         None))
+            return d
+
+        d = self._connect(tx.Factory([service]))
+        d.addCallback(connected)
+        return d
+
+    def testTcpServerStream(self):
+        service = StreamingTestService()
+
+        @defer.inlineCallbacks
+        def connected(protocol):
+            proxy = tx.Proxy(Test_Stub(protocol),
+                             streaming={"Test.Echo": SERVER_STREAMING})
+            request = EchoRequest()
+            request.text = "stream"
+            stream = proxy.Test.Echo(request)
+            texts = []
+            while True:
+                response = yield stream.get()
+                if response is None:
+                    break
+                texts.append(response.text)
+            self.assertEquals(texts, list("stream"))
+
+            # Responses are produced no further ahead than the window.
+            request.text = "x" * (INITIAL_WINDOW * 4)
+            service.produced = 0
+            stream = proxy.Test.Echo(request)
+            yield stream.get()
+            yield task.deferLater(reactor, 0.05, lambda: None)
+            self.assertEquals(service.produced, INITIAL_WINDOW)
+            stream.close()
+            self.assertEquals(protocol._streams, {})
+
+        d = self._connect(tx.Factory([service]))
+        d.addCallback(connected)
+        return d
+
+    def testTcpClientStream(self):
+        def connected(protocol):
+            proxy = tx.Proxy(Test_Stub(protocol),
+                             streaming={"Test.Echo": CLIENT_STREAMING})
+            requests = []
+            for i in range(INITIAL_WINDOW * 3):
+                request = EchoRequest()
+                request.text = str(i % 10)
+                requests.append(request)
+            echoed = proxy.Test.Echo(iter(requests))
+            echoed.addCallback(lambda r: self.assertEquals(
+                r.text, "".join(request.text for request in requests)))
+            return echoed
+
+        d = self._connect(tx.Factory([UploadTestService()]))
+        d.addCallback(connected)
+        return d
+
+    def testTcpBackpressure(self):
+        protocol = tx.TcpChannel()
+        protocol.add_service(self.service)
+        protocol._coalescer = ResponseCoalescer(protocol.sendString,
+                                                lambda flush: flush())
+        transport = StringTransport()
+        protocol.makeConnection(transport)
+        self.assertIdentical(transport.producer, protocol)
+        self.assertTrue(transport.streaming)
+
+        rpc = Rpc()
+        request = EchoRequest()
+        request.text = "paused"
+        rpc.request.add(id=1, method="Test.Echo",
+                        serialized_request=request.SerializeToString())
+        data = rpc.SerializeToString()
+        # What the transport does once its write buffer is full.
+        protocol.pauseProducing()
+        self.assertEquals(transport.producerState, "paused")
+        protocol.dataReceived(struct.pack("!I", len(data)) + data)
+        self.assertEquals(transport.value(), "")
+
+        protocol.resumeProducing()
+        self.assertEquals(transport.producerState, "producing")
+        _, (response,) = decode_rpc(transport.value()[4:])
+        self.assertEquals(response.id, 1)
+
     def testUdpRpc(self):
         protocol = tx.UdpChannel(self.udp_listener.getHost().host,
                                  self.udp_listener.getHost().port)
@@ -0,0 +1,390 @@
+"""Tests of the gevent channels and server, over loopback."""
+
+# The synchronous channels open their sockets with the socket module,
+# which their users make cooperative.
+from gevent import monkey
+monkey.patch_socket(dns=False)
+
+import json
+import os
+import signal
+import socket
+import time
+
+import gevent
+import gevent.server
+from twisted.trial import unittest
+from protobufrpc import common
+from protobufrpc.cache import Cache, memoized
+from protobufrpc.common import PROCESS, ProcessPool, RpcErrors, execution
+from protobufrpc.envelope import decode_rpc
+from protobufrpc.framing import FrameReader, HEADER
+from protobufrpc.prefork import Supervisor
+from protobufrpc.protobufrpc_pb2 import Rpc
+from protobufrpc.synchronous import GeventTCPHandler, GeventTCPServer, \
+    Proxy, RPCException, TcpChannel, TcpChannelPool
+from test_suite_pb2 import Test, Test_Stub, EchoRequest, EchoResponse
+
+
+class SleepingTestService(Test):
+    """
+    Echoes the request's text, first sleeping as long as it says, or
+    raises if it says so.
+    """
+
+    def Echo(self, rpc_controller, request, done):
+        delay, text = request.text.split(":", 1)
+        if delay:
+            gevent.sleep(float(delay))
+        if text == "raise":
+            raise ValueError("raised on purpose")
+        response = EchoResponse()
+        response.text = request.text
+        done(response)
+
+
+class MemoizedTestService(SleepingTestService):
+    @memoized(Cache())
+    def Echo(self, rpc_controller, request, done):
+        SleepingTestService.Echo(self, rpc_controller, request, done)
+
+
+class ExitingTestService(Test):
+    """Echoes in a worker process, which exits when asked to."""
+
+    @execution(PROCESS)
+    def Echo(self, rpc_controller, request, done):
+        if request.text == "exit":
+            os._exit(1)
+        response = EchoResponse()
+        response.text = request.text
+        done(response)
+
+
+class PidTestService(Test):
+    """Answers with the pids of the process serving it and its parent."""
+
+    def Echo(self, rpc_controller, request, done):
+        response = EchoResponse()
+        response.text = "%d %d" % (os.getpid(), os.getppid())
+        done(response)
+
+
+def echo_request(text):
+    request = EchoRequest()
+    request.text = text
+    return request
+
+
+class SynchronousTestCase(unittest.TestCase):
+    timeout = 10
+
+    def setUp(self):
+        self.server = None
+        self.channels = []
+
+    def tearDown(self):
+        for channel in self.channels:
+            channel.close()
+        if self.server is not None:
+            self.server.stop()
+
+    def _serve(self, service=None, **options):
+        self.server = GeventTCPServer(("127.0.0.1", 0),
+                                      [service or SleepingTestService()],
+                                      **options)
+        self.server.start()
+        return ("127.0.0.1", self.server.server_port)
+
+    def _channel(self, channelClass=TcpChannel, **options):
+        channel = channelClass(self.addr, **options)
+        self.channels.append(channel)
+        return channel
+
+    def _echo(self, proxy, *texts):
+        """
+        Echo ``texts`` concurrently.
+
+        :return: the responses (or RPCExceptions), and the texts in the
+            order they were answered
+        """
+        answered = []
+
+        def call(text):
+            try:
+                response = proxy.Test.Echo(echo_request(text))
+            except RPCException as e:
+                return e
+            answered.append(response.text)
+            return response
+
+        calls = [gevent.spawn(call, text) for text in texts]
+        gevent.joinall(calls, raise_error=True)
+        return [c.value for c in calls], answered
+
+    def _recordSent(self, channel):
+        sent = []
+        send_string = channel.send_string
+        channel.send_string = lambda data: (sent.append(data),
+                                            send_string(data))
+        return sent
+
+    def _recordReceived(self, channel):
+        received = []
+        string_received = channel.string_received
+        # The frames are views into the channel's buffer: copied.
+        channel.string_received = lambda data: (
+            received.append(memoryview(data).tobytes()),
+            string_received(data))
+        return received
+
+    def testMultiplexing(self):
+        self.addr = self._serve()
+        channel = self._channel()
+        responses, answered = self._echo(Proxy(Test_Stub(channel)),
+                                         "0.2:slow", "0.05:medium", ":fast")
+        self.assertEqual([r.text for r in responses],
+                         ["0.2:slow", "0.05:medium", ":fast"])
+        # Answered as they completed, on the one connection.
+        self.assertEqual(answered, [":fast", "0.05:medium", "0.2:slow"])
+        self.assertEqual(self.server.stats["accepted"], 1)
+        self.assertEqual(channel.in_flight, 0)
+
+    def testMalformedResponse(self):
+        def handle(sock, address):
+            sock.recv(4096)
+            sock.sendall(HEADER.pack(3) + b"\xff\xff\xff")
+            gevent.sleep(1)
+
+        self.server = gevent.server.StreamServer(("127.0.0.1", 0), handle)
+        self.server.start()
+        self.addr = ("127.0.0.1", self.server.server_port)
+        channel = self._channel()
+        (failed,), _ = self._echo(Proxy(Test_Stub(channel)), "lost")
+        self.assertIsInstance(failed, RPCException)
+        self.assertTrue(str(failed).startswith("connection error"))
+        self.assertFalse(channel.connected)
+
+    def testPool(self):
+        self.addr = self._serve()
+        pool = self._channel(TcpChannelPool, max_size=2)
+        texts = ["0.1:%d" % i for i in range(4)]
+        responses, _ = self._echo(Proxy(Test_Stub(pool)), *texts)
+        self.assertEqual([r.text for r in responses], texts)
+        # A second connection once the first was busy, but no more.
+        self.assertEqual(pool.size, 2)
+        self.assertEqual(self.server.stats["accepted"], 2)
+
+    def testPoolChannelOptions(self):
+        self.addr = self._serve()
+        pool = self._channel(TcpChannelPool, max_size=1, method_ids=True)
+        proxy = Proxy(Test_Stub(pool))
+        self._echo(proxy, ":bind")
+        sent = self._recordSent(pool._channels[0])
+        (response,), _ = self._echo(proxy, ":bound")
+        self.assertEqual(response.text, ":bound")
+        request, = Rpc.FromString(sent[0]).request
+        self.assertTrue(request.method_id)
+        self.assertFalse(request.HasField("method"))
+
+    def testBatchWindow(self):
+        self.addr = self._serve()
+        channel = self._channel(batch_window=0.01)
+        sent = self._recordSent(channel)
+        texts = [":one", ":two", ":three"]
+        responses, _ = self._echo(Proxy(Test_Stub(channel)), *texts)
+        self.assertEqual([r.text for r in responses], texts)
+        self.assertEqual(len(sent), 1)
+        self.assertEqual(len(Rpc.FromString(sent[0]).request), 3)
+
+    def testResponseCoalescing(self):
+        self.addr = self._serve()
+        channel = self._channel(batch_window=0.01)
+        received = self._recordReceived(channel)
+        texts = [":one", ":two", ":three"]
+        responses, _ = self._echo(Proxy(Test_Stub(channel)), *texts)
+        self.assertEqual([r.text for r in responses], texts)
+        # Completed within one turn of the loop, answered in one frame.
+        self.assertEqual(len(received), 1)
+        self.assertEqual(len(Rpc.FromString(received[0]).response), 3)
+
+    def testOverloaded(self):
+        self.addr = self._serve(max_concurrency=1, max_queue=1)
+        channel = self._channel()
+        responses, _ = self._echo(Proxy(Test_Stub(channel)),
+                                  "0.1:run", "0.1:wait", "0.1:reject")
+        self.assertEqual([r.text for r in responses[:2]],
+                         ["0.1:run", "0.1:wait"])
+        self.assertIsInstance(responses[2], RPCException)
+        self.assertEqual(str(responses[2]),
+                         RpcErrors.msgs[RpcErrors.OVERLOADED])
+
+    def testOverloadedWithoutConcurrencyLimit(self):
+        self.addr = self._serve(max_queue=2)
+        channel = self._channel()
+        responses, _ = self._echo(Proxy(Test_Stub(channel)),
+                                  "0.1:one", "0.1:two", "0.1:three")
+        self.assertEqual([r.text for r in responses[:2]],
+                         ["0.1:one", "0.1:two"])
+        self.assertEqual(str(responses[2]),
+                         RpcErrors.msgs[RpcErrors.OVERLOADED])
+
+    def testMethodRaised(self):
+        self.addr = self._serve()
+        channel = self._channel()
+        (failed, answered), _ = self._echo(Proxy(Test_Stub(channel)),
+                                           ":raise", "0.05:after")
+        self.assertEqual(str(failed), "ValueError: raised on purpose")
+        self.assertEqual(answered.text, "0.05:after")
+        self.assertTrue(channel.connected)
+
+    def testMemoizedMethodRaised(self):
+        self.addr = self._serve(MemoizedTestService())
+        channel = self._channel()
+        # The second waits for the first, which raises.
+        failed, _ = self._echo(Proxy(Test_Stub(channel)),
+                               "0.05:raise", "0.05:raise")
+        self.assertEqual([str(e) for e in failed],
+                         ["ValueError: raised on purpose"] * 2)
+
+    def testMemoizedDeadline(self):
+        self.addr = self._serve(MemoizedTestService())
+        channel = self._channel()
+        leader = gevent.spawn(Proxy(Test_Stub(channel)).Test.Echo,
+                              echo_request("0.5:slow"))
+        gevent.sleep(0.05)
+        (failed,), _ = self._echo(Proxy(Test_Stub(channel), timeout=0.1),
+                                  "0.5:slow")
+        self.assertEqual(str(failed), RpcErrors.msgs[
+            RpcErrors.DEADLINE_EXCEEDED])
+        # The duplicate gave up waiting for the leader on the server too.
+        gevent.sleep(0.1)
+        self.assertEqual(self.server.scheduler.running, 1)
+        self.assertEqual(leader.get().text, "0.5:slow")
+
+    def testWorkerExited(self):
+        pool = ProcessPool(1)
+        self.addCleanup(pool.close)
+        self.patch(common, "_process_pool", pool)
+        self.addr = self._serve(ExitingTestService())
+        proxy = Proxy(Test_Stub(self._channel()))
+        (failed,), _ = self._echo(proxy, "exit")
+        self.assertEqual(str(failed), "worker exited")
+        # The next call runs in the worker replacing it.
+        (response,), _ = self._echo(proxy, "after")
+        self.assertEqual(response.text, "after")
+
+    def testBackpressure(self):
+        self.patch(GeventTCPHandler, "high_watermark", 16 * 1024)
+        self.patch(GeventTCPHandler, "low_watermark", 4 * 1024)
+        self.addr = self._serve()
+        count = 200
+        payload = echo_request(":" + "x" * 64 * 1024).SerializeToString()
+        frames = []
+        for i in range(count):
+            rpc = Rpc()
+            rpc.request.add(id=i + 1, method="Test.Echo",
+                            serialized_request=payload)
+            frame = rpc.SerializeToString()
+            frames.append(HEADER.pack(len(frame)) + frame)
+
+        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        client.connect(self.addr)
+        try:
+            # Every request in flight, none of the responses read.
+            sender = gevent.spawn(client.sendall, b"".join(frames))
+            gevent.sleep(0.5)
+            self.assertTrue(self.server.stats["paused"] > 0)
+            self.assertTrue(self.server.stats["requests"] < count)
+
+            answered = []
+
+            def responses(frame):
+                answered.extend(decode_rpc(frame)[1])
+
+            reader = FrameReader()
+            while len(answered) < count:
+                self.assertTrue(reader.read(client, responses))
+            sender.get()
+        finally:
+            client.close()
+        self.assertEqual(sorted(r.id for r in answered),
+                         range(1, count + 1))
+
+
+class SupervisorTestCase(unittest.TestCase):
+    def testRetiredStats(self):
+        supervisor = Supervisor(("127.0.0.1", 0), [PidTestService()])
+        report = {"accepted": 2, "active": 1, "requests": 3, "errors": 1,
+                  "paused": 0}
+        # A worker that reports once and exits.
+        supervisor._run_worker = lambda stats_fd: os.write(
+            stats_fd, json.dumps(report) + "\n")
+        supervisor._spawn()
+        self.assertEqual(len(supervisor._reap(block=True)), 1)
+        self.assertEqual(supervisor.stats(), {
+            "workers": {}, "accepted": 2, "requests": 3, "errors": 1,
+            "paused": 0})
+
+
+class PreforkTestCase(unittest.TestCase):
+    timeout = 30
+
+    def setUp(self):
+        probe = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        probe.bind(("127.0.0.1", 0))
+        self.addr = probe.getsockname()
+        probe.close()
+        supervisor = Supervisor(self.addr, [PidTestService()], workers=2,
+                                drain_timeout=1)
+        supervisor.restart_delay = 0.1
+        self.supervisor = os.fork()
+        if self.supervisor == 0:
+            try:
+                supervisor.serve_forever()
+            finally:
+                os._exit(0)
+
+    def tearDown(self):
+        os.kill(self.supervisor, signal.SIGTERM)
+        os.waitpid(self.supervisor, 0)
+
+    def _worker(self):
+        """The pid of the worker answering a call on a new connection."""
+        deadline = time.time() + 10
+        while True:
+            try:
+                channel = TcpChannel(self.addr)
+            except socket.error:
+                if time.time() > deadline:
+                    raise
+                gevent.sleep(0.05)
+                continue
+            try:
+                response = Proxy(Test_Stub(channel), timeout=5).Test.Echo(
+                    echo_request("pid"))
+            finally:
+                channel.close()
+            pid, parent = [int(p) for p in response.text.split()]
+            self.assertEqual(parent, self.supervisor)
+            return pid
+
+    def _workers(self, count, excluding=()):
+        """Call until ``count`` workers not in ``excluding`` answer."""
+        seen = set()
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            seen.add(self._worker())
+            if len(seen - set(excluding)) >= count:
+                return seen - set(excluding)
+            gevent.sleep(0.01)
+        self.fail("%d workers answered, not %d" % (len(seen), count))
+
+    def testRespawn(self):
+        workers = self._workers(2)
+        dead = workers.pop()
+        os.kill(dead, signal.SIGKILL)
+        # Calls go on, to the other worker and the one replacing the dead.
+        replacement = self._workers(1, excluding=workers | set([dead]))
+        self.assertEqual(len(replacement), 1)